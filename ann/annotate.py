@@ -11,6 +11,7 @@
 __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import file_utils as fu
+import stage_metrics
 import utils as u
 
 indicesKnownGenes=[12, 1, 3] #12 for gene
@@ -107,14 +108,101 @@ def getComplementary(nuc):
         return compNuc
 
 
+"""Micro-batches concatenate the records of several jobs into one input,
+   each job preceded by a marker line. Stages pass the marker lines through
+   and snapshot their counters into the count log at every marker, so the
+   log can be split back per job.
+"""
+BATCH_MARKER = '##gas_batch_job='
+
+def isBatchMarker(line):
+    return line.startswith(BATCH_MARKER)
+
+
+"""Yields the lines of fh, calling progress with the number of records read
+   so far every PROGRESS_EVERY records and once at the end. The records
+   read are added to the records_in of the running stage's metrics
+"""
+PROGRESS_EVERY = 1000
+
+def trackProgress(fh, progress=None):
+    records = 0
+    for line in fh:
+        yield line
+        if not line.startswith('#'):
+            records = records + 1
+            if progress is not None and (records % PROGRESS_EVERY == 0):
+                progress(records)
+    stage = stage_metrics.current()
+    if stage is not None:
+        stage['records_in'] += records
+    if progress is not None:
+        progress(records)
+
+
+"""Output file of a stage, whose lines are written one at a time; the
+   records written are added to the records_out of the running stage's
+   metrics when the stage closes it
+"""
+class RecordWriter(object):
+    def __init__(self, fh):
+        self.fh = fh
+        self.records = 0
+        self.stage = stage_metrics.current()
+
+    def write(self, line):
+        if not line.startswith('#'):
+            self.records = self.records + 1
+        self.fh.write(line)
+
+    def close(self):
+        self.fh.close()
+        if self.stage is not None:
+            self.stage['records_out'] += self.records
+            self.stage = None
+
+
+"""Count log lines of getSnpsFromDbSnp
+"""
+def dbSnpCountLog(linenum, var_count):
+    ratioInDbSnp = (var_count / float(linenum)) * 100
+    return ["## Please notice that all Isoforms were counted",
+        "## Numbers may exceed number of variants in the annotated file",
+        f"Total: {str(linenum)}",
+        f"In dbSNP: {str(var_count)} ({str(ratioInDbSnp)}%)"]
+
+
+"""Count log lines of getGenes and getExonsEtAl
+"""
+def geneLocationCountLog(interGenic_count, cds_count, utr3_count, utr5_count,
+    intronic_count, non_coding_intronic_count, exonic_count,
+    non_coding_exonic_count, promoter_count):
+    return ["Variants located:",
+        f"In interGenic {str(interGenic_count)}",
+        f"In CDS {str(cds_count)}",
+        f"In \'3 UTR {str(utr3_count)}",
+        f"In \'5 UTR {str(utr5_count)}",
+        f"In Intronic {str(intronic_count)}",
+        f"In Non_coding_intronic {str(non_coding_intronic_count)}",
+        f"In Exonic {str(exonic_count)}",
+        f"In Non_coding_exonic {str(non_coding_exonic_count)}",
+        f"In Putative Promoter Region {str(promoter_count)}"]
+
+
+"""Count log line of the overlap stages
+"""
+def overlapCountLog(table, var_count, line_count):
+    return [f"In {str(table)}: {str(var_count)} in {str(line_count)} variants"]
+
+
 """"Format must be pileup or vcf
     Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
 """ 
 def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
-    varclass='SNV', sep='\t'):
+    varclass='SNV', sep='\t', progress=None):
     
     outfile = vcf + tmpextout
-    fh_out = open(outfile, "w")
+    fh_out = RecordWriter(open(outfile, "w"))
     logcountfile = vcf + '.count.log'
     fh_log = open(logcountfile, 'w')
     var_count = 0
@@ -126,7 +214,7 @@ def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
     cursor = conn.cursor()
     linenum = 1
 
-    for line in fh:
+    for line in trackProgress(fh, progress):
         line = line.strip()
         if not line.startswith("#"):
             fields = line.split(sep)
@@ -179,12 +267,11 @@ def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
 
         else:
             fh_out.write(line + '\n')
+            if isBatchMarker(line):
+                fh_log.write(line + '\n')
+                fh_log.write('\n'.join(dbSnpCountLog(linenum, var_count)) + '\n')
 
-    ratioInDbSnp = (var_count / float(linenum)) * 100
-    fh_log.write("## Please notice that all Isoforms were counted\n")
-    fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
-    fh_log.write(f"Total: {str(linenum)}\n")
-    fh_log.write(f"In dbSNP: {str(var_count)} ({str(ratioInDbSnp)}%)\n")
+    fh_log.write('\n'.join(dbSnpCountLog(linenum, var_count)) + '\n')
     fh_log.close()
 
     conn.close()
@@ -197,11 +284,12 @@ def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
     2. chrom_pos_equal_nobase
     3. chrom_pos_unequal
 """
-def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t'):
+def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t',
+    progress=None):
     basefile = vcf
     vcf = basefile + tmpextin
     outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
+    fh_out = RecordWriter(open(outfile, "w"))
     inds = getFormatSpecificIndices(format=format)
     fh = open(vcf)
 
@@ -209,7 +297,7 @@ def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t'):
     cursor = conn.cursor()
     vcf_linenum = 1
 
-    for line in fh:
+    for line in trackProgress(fh, progress):
         line = line.strip()
         if not line.startswith("#"):
             fields = line.split(sep)
@@ -305,12 +393,12 @@ def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t'):
 """Get information about location in gene structures
 """
 def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500, 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
+    tmpextin='.2', tmpextout='.3', sep='\t', progress=None):
     
     basefile = vcf
     vcf = basefile + tmpextin
     outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
+    fh_out = RecordWriter(open(outfile, "w"))
 
     logcountfile = basefile + '.count.log'
     fh_log = open(logcountfile, 'a')
@@ -331,7 +419,7 @@ def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
     cursor = conn.cursor()
     linenum = 1
 
-    for line in fh:
+    for line in trackProgress(fh, progress):
         line = line.strip()
         if not line.startswith("#"):
             fields = line.split(sep)
@@ -464,36 +552,18 @@ def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
 
         else:
             fh_out.write(line + '\n')
-
-    print("Variants located:")
-    fh_log.write("Variants located:\n")
-
-    print(f"In interGenic {str(interGenic_count)}")
-    fh_log.write(f"In interGenic {str(interGenic_count)}\n")
-
-    print(f"In CDS {str(cds_count)}")
-    fh_log.write(f"In CDS {str(cds_count)}\n")
-
-    print(f"In \'3 UTR {str(utr3_count)}")
-    fh_log.write(f"In \'3 UTR {str(utr3_count)}\n")
-
-    print(f"In \'5 UTR {str(utr5_count)}")
-    fh_log.write(f"In \'5 UTR {str(utr5_count)}\n")
-
-    print(f"In Intronic {str(intronic_count)}")
-    fh_log.write(f"In Intronic {str(intronic_count)}\n")
-
-    print(f"In Non_coding_intronic {str(non_coding_intronic_count)}")
-    fh_log.write(f"In Non_coding_intronic {str(non_coding_intronic_count)}\n")
-
-    print(f"In Exonic {str(exonic_count)}")
-    fh_log.write(f"In Exonic {str(exonic_count)}\n")
-
-    print(f"In Non_coding_exonic {str(non_coding_exonic_count)}")
-    fh_log.write(f"In Non_coding_exonic {str(non_coding_exonic_count)}\n")
-
-    print(f"In Putative Promoter Region {str(promoter_count)}")
-    fh_log.write(f"In Putative Promoter Region {str(promoter_count)}\n")
+            if isBatchMarker(line):
+                fh_log.write(line + '\n')
+                fh_log.write('\n'.join(geneLocationCountLog(interGenic_count, cds_count,
+                    utr3_count, utr5_count, intronic_count,
+                    non_coding_intronic_count, exonic_count,
+                    non_coding_exonic_count, promoter_count)) + '\n')
+
+    for log_line in geneLocationCountLog(interGenic_count, cds_count, utr3_count,
+        utr5_count, intronic_count, non_coding_intronic_count, exonic_count,
+        non_coding_exonic_count, promoter_count):
+        print(log_line)
+        fh_log.write(log_line + '\n')
 
     fh_out.close()
     fh_log.close()
@@ -504,12 +574,12 @@ def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
 """Method used in INDELS, where bigRefGeneTable is not applicable
 """
 def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500, 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
+    tmpextin='.2', tmpextout='.3', sep='\t', progress=None):
 
     basefile = vcf
     vcf = basefile + tmpextin
     outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
+    fh_out = RecordWriter(open(outfile, "w"))
 
     logcountfile = basefile + '.count.log'
     fh_log = open(logcountfile, 'a')
@@ -530,7 +600,7 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
     cursor = conn.cursor()
     linenum = 1
 
-    for line in fh:
+    for line in trackProgress(fh, progress):
         line = line.strip()
         if not line.startswith("#"):
             fields = line.split(sep)
@@ -675,36 +745,18 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
 
         else:
             fh_out.write(line + '\n')
-
-    print("Variants located:")
-    fh_log.write("Variants located:\n")
-
-    print(f"In interGenic {str(interGenic_count)}")
-    fh_log.write(f"In interGenic {str(interGenic_count)}\n")
-
-    print(f"In CDS {str(cds_count)}")
-    fh_log.write(f"In CDS {str(cds_count)}\n")
-
-    print(f"In \'3 UTR {str(utr3_count)}")
-    fh_log.write(f"In \'3 UTR {str(utr3_count)}\n")
-
-    print(f"In \'5 UTR {str(utr5_count)}")
-    fh_log.write(f"In \'5 UTR {str(utr5_count)}\n")
-
-    print(f"In Intronic {str(intronic_count)}")
-    fh_log.write(f"In Intronic "+str(intronic_count) +'\n')
-
-    print(f"In Non_coding_intronic {str(non_coding_intronic_count)}")
-    fh_log.write(f"In Non_coding_intronic {str(non_coding_intronic_count)}\n")
-
-    print(f"In Exonic {str(exonic_count)}")
-    fh_log.write(f"In Exonic {str(exonic_count)}\n")
-
-    print(f"In Non_coding_exonic {str(non_coding_exonic_count)}")
-    fh_log.write(f"In Non_coding_exonic {str(non_coding_exonic_count)}\n")
-
-    print(f"In Putative Promoter Region {str(promoter_count)}")
-    fh_log.write(f"In Putative Promoter Region {str(promoter_count)}\n")
+            if isBatchMarker(line):
+                fh_log.write(line + '\n')
+                fh_log.write('\n'.join(geneLocationCountLog(interGenic_count, cds_count,
+                    utr3_count, utr5_count, intronic_count,
+                    non_coding_intronic_count, exonic_count,
+                    non_coding_exonic_count, promoter_count)) + '\n')
+
+    for log_line in geneLocationCountLog(interGenic_count, cds_count, utr3_count,
+        utr5_count, intronic_count, non_coding_intronic_count, exonic_count,
+        non_coding_exonic_count, promoter_count):
+        print(log_line)
+        fh_log.write(log_line + '\n')
 
     fh_out.close()
     fh_log.close()
@@ -715,7 +767,7 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
 """Overlap with tfbsConsSites
 """
 def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites', 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
+    tmpextin='.2', tmpextout='.3', sep='\t', progress=None):
 
     allowed_chrom=['1','2','3','4','5','6','7','8','9','10','11','12','13',
         '14','15','16','17','18','19','20','21','22','X','Y']
@@ -724,7 +776,7 @@ def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites',
     vcf = basefile + tmpextin
     outfile = basefile + tmpextout
 
-    fh_out = open(outfile, "w")
+    fh_out = RecordWriter(open(outfile, "w"))
     fh = open(vcf)
 
     logcountfile = basefile + '.count.log'
@@ -737,11 +789,14 @@ def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites',
     cursor = conn.cursor()
 
     linenum = 1
-    for line in fh:
+    for line in trackProgress(fh, progress):
         line = line.strip()
         ## not comments
         if (line.startswith("##")):
             fh_out.write(line + '\n')
+            if isBatchMarker(line):
+                fh_log.write(line + '\n')
+                fh_log.write('\n'.join(overlapCountLog(table, var_count, line_count)) + '\n')
 
         #header line
         elif (line.startswith('#CHROM') or line.startswith('CHROM')):
@@ -795,8 +850,7 @@ def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites',
 
         linenum = linenum + 1
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
+    fh_log.write('\n'.join(overlapCountLog(table, var_count, line_count)) + '\n')
     fh_log.close()
 
     conn.close()
@@ -807,13 +861,13 @@ def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites',
 """Overlap with GadAll table
 """
 def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='', 
-    tmpextout='.1', sep='\t'):
+    tmpextout='.1', sep='\t', progress=None):
     
     basefile = vcf
     vcf = basefile + tmpextin
     outfile = basefile + tmpextout
 
-    fh_out = open(outfile, "w")
+    fh_out = RecordWriter(open(outfile, "w"))
     fh = open(vcf)
 
     logcountfile = basefile+'.count.log'
@@ -826,7 +880,7 @@ def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='',
     cursor = conn.cursor()
     linenum = 1
 
-    for line in fh:
+    for line in trackProgress(fh, progress):
         line = line.strip()
         ## not comments
         if not line.startswith("##"):
@@ -871,9 +925,11 @@ def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='',
             linenum = linenum + 1
         else:
             fh_out.write(line + '\n')
+            if isBatchMarker(line):
+                fh_log.write(line + '\n')
+                fh_log.write('\n'.join(overlapCountLog(table, var_count, line_count)) + '\n')
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
+    fh_log.write('\n'.join(overlapCountLog(table, var_count, line_count)) + '\n')
     fh_log.close()
 
     conn.close()
@@ -883,13 +939,13 @@ def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='',
 
 """ Overlap with gwasCatalog table """
 def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', \
-    tmpextin='', tmpextout='.1', sep='\t'):
+    tmpextin='', tmpextout='.1', sep='\t', progress=None):
     
     basefile = vcf
     vcf = basefile + tmpextin
     outfile = basefile + tmpextout
 
-    fh_out = open(outfile, "w")
+    fh_out = RecordWriter(open(outfile, "w"))
     fh = open(vcf)
 
     logcountfile = basefile+'.count.log'
@@ -902,7 +958,7 @@ def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', \
     cursor = conn.cursor()
     linenum = 1
 
-    for line in fh:
+    for line in trackProgress(fh, progress):
         line = line.strip()
         ## not comments
         if not line.startswith("##"):
@@ -943,9 +999,11 @@ def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', \
             linenum = linenum + 1
         else:
             fh_out.write(line + '\n')
+            if isBatchMarker(line):
+                fh_log.write(line + '\n')
+                fh_log.write('\n'.join(overlapCountLog(table, var_count, line_count)) + '\n')
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
+    fh_log.write('\n'.join(overlapCountLog(table, var_count, line_count)) + '\n')
     fh_log.close()
 
     conn.close()
@@ -956,13 +1014,13 @@ def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', \
 """Overlap with HUGO Gene Nomenclature Committee (HGNC) table
 """
 def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo', 
-    tmpextin='', tmpextout='.1', sep='\t'):
+    tmpextin='', tmpextout='.1', sep='\t', progress=None):
     
     basefile = vcf
     vcf = basefile + tmpextin
     outfile = basefile + tmpextout
 
-    fh_out = open(outfile, "w")
+    fh_out = RecordWriter(open(outfile, "w"))
     fh = open(vcf)
 
     logcountfile = basefile + '.count.log'
@@ -975,7 +1033,7 @@ def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo',
     cursor = conn.cursor()
     linenum = 1
 
-    for line in fh:
+    for line in trackProgress(fh, progress):
         line = line.strip()
         ## not comments
         if not line.startswith("##"):
@@ -1023,9 +1081,11 @@ def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo',
             linenum = linenum + 1
         else:
             fh_out.write(line + '\n')
+            if isBatchMarker(line):
+                fh_log.write(line + '\n')
+                fh_log.write('\n'.join(overlapCountLog(table, var_count, line_count)) + '\n')
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
+    fh_log.write('\n'.join(overlapCountLog(table, var_count, line_count)) + '\n')
     fh_log.close()
 
     conn.close()
@@ -1036,13 +1096,14 @@ def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo',
 """Overlap with segdup regions genomicSuperDups
 """
 def addOverlapWithGenomicSuperDups(vcf, format='vcf', 
-    table='genomicSuperDups', tmpextin='', tmpextout='.1', sep='\t'):
+    table='genomicSuperDups', tmpextin='', tmpextout='.1', sep='\t',
+    progress=None):
     
     basefile = vcf
     vcf = basefile + tmpextin
     outfile = basefile + tmpextout
 
-    fh_out = open(outfile, "w")
+    fh_out = RecordWriter(open(outfile, "w"))
     fh = open(vcf)
 
     logcountfile = basefile + '.count.log'
@@ -1055,7 +1116,7 @@ def addOverlapWithGenomicSuperDups(vcf, format='vcf',
     cursor = conn.cursor()
     linenum = 1
 
-    for line in fh:
+    for line in trackProgress(fh, progress):
         line = line.strip()
         ## not comments
         if not line.startswith("##"):
@@ -1098,9 +1159,11 @@ def addOverlapWithGenomicSuperDups(vcf, format='vcf',
             linenum = linenum + 1
         else:
             fh_out.write(line + '\n')
+            if isBatchMarker(line):
+                fh_log.write(line + '\n')
+                fh_log.write('\n'.join(overlapCountLog(table, var_count, line_count)) + '\n')
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
+    fh_log.write('\n'.join(overlapCountLog(table, var_count, line_count)) + '\n')
     fh_log.close()
 
     conn.close()
@@ -1112,12 +1175,12 @@ def addOverlapWithGenomicSuperDups(vcf, format='vcf',
    with which SNP or INDEL overlaps
 """
 def addOverlapWithRefGene(vcf, format='vcf', table='refGene', 
-    tmpextin='', tmpextout='.1', sep='\t'):
+    tmpextin='', tmpextout='.1', sep='\t', progress=None):
     
     basefile = vcf
     vcf = basefile + tmpextin
     outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
+    fh_out = RecordWriter(open(outfile, "w"))
     fh = open(vcf)
 
     logcountfile = basefile + '.count.log'
@@ -1136,7 +1199,7 @@ def addOverlapWithRefGene(vcf, format='vcf', table='refGene',
     cursor = conn.cursor()
     linenum = 1
 
-    for line in fh:
+    for line in trackProgress(fh, progress):
         line = line.strip()
         ## not comments
         if not line.startswith("##"):
@@ -1177,9 +1240,11 @@ def addOverlapWithRefGene(vcf, format='vcf', table='refGene',
             linenum = linenum + 1
         else:
             fh_out.write(line + '\n')
+            if isBatchMarker(line):
+                fh_log.write(line + '\n')
+                fh_log.write('\n'.join(overlapCountLog(table, var_count, line_count)) + '\n')
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
+    fh_log.write('\n'.join(overlapCountLog(table, var_count, line_count)) + '\n')
     fh_log.close()
 
     conn.close()
@@ -1190,12 +1255,12 @@ def addOverlapWithRefGene(vcf, format='vcf', table='refGene',
 """Method to find overlap with Cytoband table
 """
 def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand', 
-    tmpextin='', tmpextout='.1', sep='\t'):
+    tmpextin='', tmpextout='.1', sep='\t', progress=None):
     
     basefile = vcf
     vcf = basefile + tmpextin
     outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
+    fh_out = RecordWriter(open(outfile, "w"))
     fh = open(vcf)
 
     logcountfile = basefile + '.count.log'
@@ -1216,7 +1281,7 @@ def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand',
     cursor = conn.cursor()
     linenum = 1
 
-    for line in fh:
+    for line in trackProgress(fh, progress):
         line = line.strip()
         ## not comments
         if not line.startswith("##"):
@@ -1256,9 +1321,11 @@ def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand',
             linenum = linenum + 1
         else:
             fh_out.write(line + '\n')
+            if isBatchMarker(line):
+                fh_log.write(line + '\n')
+                fh_log.write('\n'.join(overlapCountLog(table, var_count, line_count)) + '\n')
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
+    fh_log.write('\n'.join(overlapCountLog(table, var_count, line_count)) + '\n')
     fh_log.close()
 
     conn.close()
@@ -1269,13 +1336,13 @@ def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand',
 """Method to find overlap with CNV tables
 """
 def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv', 
-    tmpextin='', tmpextout='.1', sep='\t'):
+    tmpextin='', tmpextout='.1', sep='\t', progress=None):
     
     basefile = vcf
     vcf = basefile + tmpextin
     outfile = basefile + tmpextout
 
-    fh_out = open(outfile, "w")
+    fh_out = RecordWriter(open(outfile, "w"))
     fh = open(vcf)
 
     logcountfile = basefile + '.count.log'
@@ -1288,7 +1355,7 @@ def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv',
     cursor = conn.cursor()
     linenum = 1
 
-    for line in fh:
+    for line in trackProgress(fh, progress):
         line = line.strip()
         ## not comments
         if not line.startswith("##"):
@@ -1324,9 +1391,11 @@ def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv',
             linenum = linenum + 1
         else:
             fh_out.write(line + '\n')
+            if isBatchMarker(line):
+                fh_log.write(line + '\n')
+                fh_log.write('\n'.join(overlapCountLog(table, var_count, line_count)) + '\n')
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
+    fh_log.write('\n'.join(overlapCountLog(table, var_count, line_count)) + '\n')
     fh_log.close()
 
     conn.close()
@@ -1337,13 +1406,13 @@ def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv',
 """Method to find overlap with targetScanS tables
 """
 def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS', 
-    tmpextin='', tmpextout='.1', sep='\t'):
+    tmpextin='', tmpextout='.1', sep='\t', progress=None):
     
     basefile = vcf
     vcf = basefile + tmpextin
     outfile = basefile + tmpextout
 
-    fh_out = open(outfile, "w")
+    fh_out = RecordWriter(open(outfile, "w"))
     fh = open(vcf)
 
     logcountfile = basefile + '.count.log'
@@ -1356,7 +1425,7 @@ def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS',
     cursor = conn.cursor()
     linenum = 1
 
-    for line in fh:
+    for line in trackProgress(fh, progress):
         line = line.strip()
         ## not comments
         if not line.startswith("##"):
@@ -1391,9 +1460,11 @@ def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS',
             linenum = linenum + 1
         else:
             fh_out.write(line + '\n')
+            if isBatchMarker(line):
+                fh_log.write(line + '\n')
+                fh_log.write('\n'.join(overlapCountLog('miRNAsites', var_count, line_count)) + '\n')
 
-    fh_log.write(f"In miRNAsites: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
+    fh_log.write('\n'.join(overlapCountLog('miRNAsites', var_count, line_count)) + '\n')
     fh_log.close()
 
     conn.close()
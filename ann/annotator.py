@@ -1,11 +1,24 @@
 import os
+import shutil
+import signal
 import subprocess
 import json
+import threading
+import time
+from concurrent.futures import Future
 
 from botocore.config import Config
 from botocore.exceptions import ClientError
 import boto3
 
+import backlog
+import lifecycle
+import metrics
+import prescan
+import run
+import stage_metrics
+import vcf_shards
+import warmup
 
 # Get configuration
 from configparser import SafeConfigParser
@@ -15,6 +28,122 @@ config.read('ann_config.ini')
 AwsRegionName = config['aws']['AwsRegionName']
 TableName = config['aws']['TableName']
 RequestsQueueURL = config['aws']['RequestsSQSURL']
+# shard sub-jobs are published to the request topic; without it, huge jobs
+# are annotated by the annotator that received them
+RequestsSNSArn = config.get('aws', 'RequestsSNSArn', fallback=None)
+
+# Size-aware routing: jobs estimated at no more than SmallJobVariants run
+# in-process, bigger ones in a run.py subprocess with one annotation
+# worker process per VariantsPerWorker estimated variants
+PrescanSampleBytes = config.getint('ann', 'PrescanSampleBytes', fallback=65536)
+SmallJobVariants = config.getint('ann', 'SmallJobVariants', fallback=5000)
+VariantsPerWorker = config.getint('ann', 'VariantsPerWorker', fallback=50000)
+MaxAnnotationWorkers = config.getint('ann', 'MaxAnnotationWorkers', fallback=os.cpu_count())
+
+# Inputs above ShardThresholdBytes are fanned out to the whole farm as
+# shard sub-jobs of about VariantsPerShard variants each
+ShardThresholdBytes = config.getint('ann', 'ShardThresholdBytes', fallback=256 * 1024 * 1024)
+VariantsPerShard = config.getint('ann', 'VariantsPerShard', fallback=200000)
+
+# Small jobs are collected for up to BatchWindowSeconds, or until there are
+# MaxBatchJobs of them, and annotated together in a single pipeline pass
+BatchWindowSeconds = config.getint('ann', 'BatchWindowSeconds', fallback=2)
+MaxBatchJobs = config.getint('ann', 'MaxBatchJobs', fallback=10)
+
+# Messages stay in the queue until their job completes; every HeartbeatSeconds
+# a background thread makes the messages of received jobs invisible for
+# VisibilityTimeoutSeconds, also while the main loop is busy handling new
+# messages. A job that failed on its MaxJobAttempts-th delivery is marked
+# FAILED and its message deleted
+HeartbeatSeconds = config.getint('ann', 'HeartbeatSeconds', fallback=60)
+VisibilityTimeoutSeconds = config.getint('ann', 'VisibilityTimeoutSeconds', fallback=300)
+MaxJobAttempts = config.getint('ann', 'MaxJobAttempts', fallback=3)
+
+# receipt handles of the messages the heartbeat keeps invisible
+HEARTBEATS = set()
+HEARTBEATS_LOCK = threading.Lock()
+
+
+# An annotator runs at most AnnotatorSlots jobs at a time, counting batched
+# jobs; metrics are served at http://MetricsHost:MetricsPort/metrics,
+# unless MetricsPort is 0
+MetricsPort = config.getint('ann', 'MetricsPort', fallback=9102)
+MetricsHost = config.get('ann', 'MetricsHost', fallback='127.0.0.1')
+AnnotatorSlots = config.getint('ann', 'AnnotatorSlots', fallback=os.cpu_count())
+
+REGISTRY = metrics.Registry()
+JOBS_IN_FLIGHT = metrics.Gauge(REGISTRY, 'gas_annotator_jobs_in_flight',
+                               'Jobs running or waiting for their micro-batch')
+FREE_SLOTS = metrics.Gauge(REGISTRY, 'gas_annotator_free_slots',
+                           'AnnotatorSlots less the jobs in flight')
+JOBS_COMPLETED = metrics.Counter(REGISTRY, 'gas_annotator_jobs_completed_total',
+                                 'Jobs completed, by annotation or result reuse', ['path'])
+JOBS_FAILED = metrics.Counter(REGISTRY, 'gas_annotator_jobs_failed_total',
+                              'Jobs whose annotation failed, re-delivered or, on their '
+                              'last attempt, marked FAILED')
+RECEIVE_SECONDS = metrics.Histogram(REGISTRY, 'gas_annotator_queue_receive_seconds',
+                                    'Duration of request queue receive calls',
+                                    buckets=[0.01, 0.05, 0.1, 0.5, 1, 2, 5, 10, 20])
+QUEUE_WAIT_SECONDS = metrics.Histogram(REGISTRY, 'gas_annotator_queue_wait_seconds',
+                                       'Time from sending to receiving a request message')
+DOWNLOAD_SECONDS = metrics.Histogram(REGISTRY, 'gas_annotator_download_seconds',
+                                     'Download of job inputs from S3')
+ANNOTATE_SECONDS = metrics.Histogram(REGISTRY, 'gas_annotator_annotate_seconds',
+                                     'AnnTools pipeline runs, of a job, shard or micro-batch')
+UPLOAD_SECONDS = metrics.Histogram(REGISTRY, 'gas_annotator_upload_seconds',
+                                   'Upload of results and completion of pipeline runs')
+DB_QUERY_SECONDS = metrics.Histogram(REGISTRY, 'gas_annotator_reference_db_query_seconds',
+                                     'Reference database query latency', ['table'],
+                                     buckets=stage_metrics.HISTOGRAM_BUCKETS)
+RESULT_INDEX_LOOKUPS = metrics.Counter(REGISTRY, 'gas_annotator_result_index_lookups_total',
+                                       'Result index lookups of job inputs, hit or miss',
+                                       ['result'])
+
+# Every BacklogMetricSeconds the queued and running work, weighted by
+# estimated job size, and the annotation slots are published for
+# autoscaling, which divides their farm-wide sums, to
+# BacklogMetricSink: cloudwatch, under BacklogMetricNamespace, local, to the
+# JSON lines BacklogMetricFile, or none
+BacklogMetricSink = config.get('ann', 'BacklogMetricSink', fallback='cloudwatch')
+BacklogMetricNamespace = config.get('ann', 'BacklogMetricNamespace', fallback='GAS/Annotator')
+BacklogMetricFile = config.get('ann', 'BacklogMetricFile', fallback='backlog_metrics.jsonl')
+BacklogMetricSeconds = config.getint('ann', 'BacklogMetricSeconds', fallback=60)
+AnnotationSecondsPerVariant = config.getfloat('ann', 'AnnotationSecondsPerVariant', fallback=0.02)
+
+BACKLOG = backlog.BacklogSignal(AnnotationSecondsPerVariant, SmallJobVariants)
+QUEUED_WORK = metrics.Gauge(REGISTRY, 'gas_annotator_queued_work_seconds',
+                            'Estimated seconds of work in the shared request queue')
+IN_FLIGHT_WORK = metrics.Gauge(REGISTRY, 'gas_annotator_in_flight_work_seconds',
+                               'Estimated seconds of the work running on this annotator')
+
+# On SIGTERM or SIGUSR1, or when the Auto Scaling group scales the instance
+# in, the annotator drains: it stops receiving jobs and waits up to
+# DrainTimeoutSeconds for the jobs in flight, then hands the unfinished
+# subprocess jobs back to the queue and waits for the small jobs running on
+# its threads. With AutoScalingGroupName and LifecycleHookName set,
+# the termination lifecycle hook is completed once it has drained
+DrainTimeoutSeconds = config.getint('ann', 'DrainTimeoutSeconds', fallback=600)
+AutoScalingGroupName = config.get('ann', 'AutoScalingGroupName', fallback=None)
+LifecycleHookName = config.get('ann', 'LifecycleHookName', fallback=None)
+LifecyclePollSeconds = config.getint('ann', 'LifecyclePollSeconds', fallback=5)
+
+DRAINING = threading.Event()
+
+# A new annotator warms up the reference database connections and tables
+# on WarmupThreads threads, at most DbPoolSize, before it receives jobs; it
+# is ready once it has, and says so at /ready and in ReadyFile, which holds
+# its time to ready
+WarmupThreads = config.getint('ann', 'WarmupThreads', fallback=4)
+ReadyFile = config.get('ann', 'ReadyFile', fallback='annotator.ready')
+
+READY = threading.Event()
+TIME_TO_READY = metrics.Gauge(REGISTRY, 'gas_annotator_time_to_ready_seconds',
+                              'Seconds from start to ready to receive jobs')
+
+# Diagnostics a job can request, by a true attribute of its job data or of
+# its SNS or SQS message, or for every job by setting the environment
+# variable GAS_<FLAG> of the annotator
+DiagnosticsFlags = ['memory_profile', 'profile']
 
 
 def errortmp(self_defined_message, error_message):
@@ -22,102 +151,603 @@ def errortmp(self_defined_message, error_message):
     return self_defined_message + ' ' + str(error_message)
 
 
-def main():
+def annotation_workers(size_estimate):
+    """Number of annotation worker processes for a job, 0 for the in-process path"""
+    if size_estimate is None:
+        return 1
+    estimated_variants = size_estimate['estimated_variants']
+    if estimated_variants <= SmallJobVariants:
+        return 0
+    return max(1, min(MaxAnnotationWorkers, -(-estimated_variants // VariantsPerWorker)))
+
+
+def fan_out_job(s3, sns, message_body, local_file, size_estimate):
     """
-    1. Poll the message queue, get a message and the job info
-    2. Get the input file S3 object and copy it to a local file
-    3. Launch annotation job as subprocess
-    4. Update job_status to DynamoDB
-    5. Delete the message
+    Split a huge input into coordinate-range shards, upload them next to the
+    job's shard results and publish each one as a sub-job on the request
+    topic. Returns the number of shards.
     """
-    s3, db, sqs = None, None, None
-    try:
-        s3 = boto3.client('s3',
-                          region_name=AwsRegionName,
-                          config=Config(signature_version='s3v4')
-                          )
-        db = boto3.resource('dynamodb', region_name=AwsRegionName)
-        sqs = boto3.client('sqs', region_name=AwsRegionName)
-    except ClientError as e:
-        print(errortmp("Get aws client failed.", e))
+    job_id = message_body['job_id']
+    user_id = message_body['user_id']
+    input_file_name = local_file.split('/')[-1].split('~', 1)[1]
+    shard_count = max(2, -(-size_estimate['estimated_variants'] // VariantsPerShard))
+    shard_files = vcf_shards.split_vcf(local_file, shard_count)
+    key_prefix = run.shard_key_prefix(user_id, job_id)
+    # the last shard registers the merged results under the whole input's key
+    content_key = run.result_index_key(local_file)
 
-    while True:
-        """Get uploaded file, annotate it and update job status to database"""
-        # poll the message queue
-        # reference:
-        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs.html#SQS.Client.receive_message
-        sqs_response = None
-        try:
-            sqs_response = sqs.receive_message(
-                QueueUrl=RequestsQueueURL,
-                AttributeNames=['All'],
-                MaxNumberOfMessages=1,
-                MessageAttributeNames=['All'],
-                WaitTimeSeconds=3
-            )
-        except ClientError as e:
-            print(errortmp("Poll the message queue failed.", e))
+    for shard_index, shard_file in enumerate(shard_files):
+        shard_job_id = f'{job_id}-{shard_index}'
+        shard_data = {
+            'job_id': shard_job_id,
+            'user_id': user_id,
+            'input_file_name': input_file_name,
+            's3_inputs_bucket': run.ResultBucketName,
+            's3_key_input_file': f'{key_prefix}{shard_job_id}~{input_file_name}',
+            'parent_job_id': job_id,
+            'shard_index': shard_index,
+            'shard_count': len(shard_files),
+            'content_key': content_key
+        }
+        s3.upload_file(shard_file, run.ResultBucketName, shard_data['s3_key_input_file'])
+        sns.publish(TopicArn=RequestsSNSArn,
+                    Message=json.dumps({'default': json.dumps(shard_data)}),
+                    MessageStructure='json')
 
-        if 'Messages' not in sqs_response:
-            continue
+    return len(shard_files)
 
-        message = sqs_response['Messages'][0]  # only contains one message
-        message_body = json.loads(json.loads(message["Body"])["Message"])
-        # get the handler of this message in order to delete it
-        receipt_handle = message["ReceiptHandle"]
 
-        job_id = message_body['job_id']
-        s3_inputs_bucket = message_body['s3_inputs_bucket']
-        s3_key_input_file = message_body['s3_key_input_file']
-        user_id = message_body['user_id']
-        file_name = s3_key_input_file.split('/')[2]
+def job_message(message):
+    """The job data of a request message, with the diagnostics flags
+    requested by message attributes or the environment set to True"""
+    envelope = json.loads(message['Body'])
+    message_body = json.loads(envelope['Message'])
+    # SNS message attributes have a Value, SQS ones a StringValue
+    attributes = dict(envelope.get('MessageAttributes', {}))
+    attributes.update(message.get('MessageAttributes', {}))
+    for flag in DiagnosticsFlags:
+        values = [message_body.get(flag), os.environ.get('GAS_' + flag.upper())]
+        if flag in attributes:
+            values.append(attributes[flag].get('Value', attributes[flag].get('StringValue')))
+        message_body[flag] = any(str(value).lower() in ('1', 'true', 'yes') for value in values)
+    return message_body
 
-        # if job_path folder does not exist, create one
-        job_path = f"jobs/{user_id}/{job_id}"
-        if not os.path.exists(job_path):
-            os.makedirs(job_path)
 
-        # download input vcf file from S3 to the annotator instance
-        # reference:
-        # https://boto3.amazonaws.com/v1/documentation/api/latest/guide/s3-example-download-file.html
+def handle_message(s3, db, sns, message_body):
+    """
+    1. Pre-scan the input file S3 object to estimate the job size
+    2. Get the input file S3 object and copy it to a local file
+    3. Complete resubmitted inputs with their earlier results, fan huge jobs
+       out as shard sub-jobs, otherwise launch annotation job as subprocess;
+       small jobs are returned to be run in a micro-batch
+    4. Update job_status and size estimate to DynamoDB
+    Returns the annotation subprocess or thread of the job, if one was
+    started, or a failed job if its input could not be downloaded, and
+    (full_filename, job_id) of a small job left to batch.
+    A memory or CPU profiled job always runs on its own in a single-worker
+    subprocess: it is never reused, fanned out, batched or run on a thread
+    """
+    job_id = message_body['job_id']
+    s3_inputs_bucket = message_body['s3_inputs_bucket']
+    s3_key_input_file = message_body['s3_key_input_file']
+    user_id = message_body['user_id']
+    file_name = s3_key_input_file.split('/')[-1]
+    # shard sub-jobs of a fanned-out job carry their parent job id
+    shard = None
+    if 'parent_job_id' in message_body:
+        shard = {'parent_job_id': message_body['parent_job_id'],
+                 'shard_index': message_body['shard_index'],
+                 'shard_count': message_body['shard_count'],
+                 'content_key': message_body.get('content_key')}
+
+    # if job_path folder does not exist, create one
+    job_path = f"jobs/{user_id}/{job_id}"
+    if not os.path.exists(job_path):
+        os.makedirs(job_path)
+
+    # estimate the job size from the object size and a sample of its first lines
+    size_estimate = None
+    try:
+        size_estimate = prescan.prescan_input(s3, s3_inputs_bucket, s3_key_input_file,
+                                              PrescanSampleBytes)
+    except ClientError as e:
+        print(errortmp("Pre-scan input file failed.", e))
+    # kept with the job data for the backlog signal
+    message_body['size_estimate'] = size_estimate
+    workers = annotation_workers(size_estimate)
+    profiled = any(message_body.get(flag, False) for flag in DiagnosticsFlags)
+    if profiled:
+        workers = 1
+
+    # download input vcf file from S3 to the annotator instance
+    # reference:
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/guide/s3-example-download-file.html
+    download_start = time.time()
+    try:
+        s3.download_file(s3_inputs_bucket, s3_key_input_file, f'{job_path}/{file_name}')
+    except (ClientError, OSError) as e:
+        print(errortmp("Download file from S3 failed.", e))
+        # nothing to annotate: the job fails, and its message is re-delivered
+        shutil.rmtree(job_path, ignore_errors=True)
+        return failed_job(e), None
+    DOWNLOAD_SECONDS.observe(time.time() - download_start)
+
+    # a resubmitted input is completed with a copy of its earlier results
+    if shard is None and not profiled:
+        if run.reuse_result(f'{job_path}/{file_name}', job_id):
+            RESULT_INDEX_LOOKUPS.inc('hit')
+            JOBS_COMPLETED.inc('reused')
+            return None, None
+        RESULT_INDEX_LOOKUPS.inc('miss')
+
+    # split huge jobs into shard sub-jobs for the whole annotator farm
+    shard_count = None
+    if shard is None and not profiled and RequestsSNSArn is not None \
+            and size_estimate is not None and size_estimate['object_size'] > ShardThresholdBytes:
         try:
-            s3.download_file(s3_inputs_bucket, s3_key_input_file, f'{job_path}/{file_name}')
-        except ClientError as e:
-            print(errortmp("Download file from S3 failed.", e))
+            shard_count = fan_out_job(s3, sns, message_body,
+                                      f'{job_path}/{file_name}', size_estimate)
+        except (ClientError, OSError) as e:
+            print(errortmp("Fan out job shards failed, annotating it here.", e))
+        else:
+            shutil.rmtree(job_path)
 
-        # perform annotation to the downloaded vcf file
-        # command format: python /home/ec2-user/mpcs-cc/anntools/hw5_run.py <filename> <job_id>
+    # perform annotation to the downloaded vcf file, unless it was fanned out
+    # small jobs skip the process spawn: whole jobs are micro-batched with other
+    # small jobs, shards run on a thread of the annotator
+    # command format: python /home/ec2-user/mpcs-cc/gas/ann/run.py <filename> <job_id> <workers>
+    #                 [--parent-job-id <id> --shard-index <i> --shard-count <n>
+    #                  --content-key <key>] [--memory-profile] [--profile]
+    job, batch_job = None, None
+    if shard_count is None and workers == 0 and shard is None:
+        batch_job = (f'{job_path}/{file_name}', job_id)
+    elif shard_count is None and workers == 0:
+        job = start_thread(run.run_job, (f'{job_path}/{file_name}', job_id, 1, shard))
+    elif shard_count is None:
+        command = ['python',
+                   '/home/ec2-user/mpcs-cc/gas/ann/run.py',
+                   f'{job_path}/{file_name}',
+                   job_id,
+                   str(workers)]
+        if shard is not None:
+            command += ['--parent-job-id', shard['parent_job_id'],
+                        '--shard-index', str(shard['shard_index']),
+                        '--shard-count', str(shard['shard_count'])]
+            if shard['content_key'] is not None:
+                command += ['--content-key', shard['content_key']]
+        if message_body.get('memory_profile', False):
+            command += ['--memory-profile']
+        if message_body.get('profile', False):
+            command += ['--profile']
         try:
-            subprocess.Popen(['python',
-                              '/home/ec2-user/mpcs-cc/gas/ann/run.py',
-                              f'{job_path}/{file_name}',
-                              job_id])
+            job = subprocess.Popen(command)
         except OSError as e:
             print(errortmp("Annotate the input file failed.", e))
+            job = failed_job(e)
 
-        # update job_status to 'RUNNING' if the original status is 'PENDING'
-        # reference:
-        # https://highlandsolutions.com/blog/hands-on-examples-for-working-with-dynamodb-boto3-and-python
+    # update job_status to 'RUNNING' if the original status is 'PENDING'
+    # reference:
+    # https://highlandsolutions.com/blog/hands-on-examples-for-working-with-dynamodb-boto3-and-python
+    # the size estimate is stored with the status so the web app can show an ETA;
+    # shards have no job item of their own, their parent is already RUNNING
+    if shard is None:
+        update_expression = 'set job_status = :new_status'
+        expression_values = {':new_status': 'RUNNING', ':cur_status': 'PENDING'}
+        if size_estimate is not None:
+            update_expression += ', size_estimate = :size_estimate'
+            expression_values[':size_estimate'] = size_estimate
+        if shard_count is not None:
+            update_expression += ', shard_count = :shard_count'
+            expression_values[':shard_count'] = shard_count
         try:
             table = db.Table(TableName)
             table.update_item(
                 Key={'job_id': job_id},
-                UpdateExpression='set job_status = :new_status',
+                UpdateExpression=update_expression,
                 ConditionExpression='job_status = :cur_status',
-                ExpressionAttributeValues={':new_status': 'RUNNING', ':cur_status': 'PENDING'},
+                ExpressionAttributeValues=expression_values,
                 ReturnValues='UPDATED_NEW'
             )
         except ClientError as e:
             print(errortmp("Update job status failed.", e))
 
-        # delete the message
+    return job, batch_job
+
+
+def failed_job(error):
+    """A job that failed before it could start, as a finished Future"""
+    future = Future()
+    future.set_exception(error)
+    return future
+
+
+def start_thread(target, args):
+    """Run target on a thread of the annotator; returns a Future of its result"""
+    future = Future()
+
+    def run_target():
+        try:
+            future.set_result(target(*args))
+        except Exception as e:
+            print(errortmp("Annotate the input file failed.", e))
+            future.set_exception(e)
+
+    threading.Thread(target=run_target).start()
+    return future
+
+
+def job_finished(job):
+    """None while an annotation subprocess or thread runs, then whether it succeeded"""
+    if isinstance(job, Future):
+        return job.exception() is None if job.done() else None
+    return_code = job.poll()
+    return return_code == 0 if return_code is not None else None
+
+
+def flush_batch(batch_jobs):
+    """Annotate the pending small jobs on a thread of the annotator, in one
+    pipeline pass when there are several of them"""
+    if len(batch_jobs) == 1:
+        full_filename, job_id = batch_jobs[0]
+        return start_thread(run.run_job, (full_filename, job_id))
+    return start_thread(run.run_batch, (list(batch_jobs),))
+
+
+def keep_invisible(receipt_handle):
+    """Have the heartbeat extend the visibility of a received message"""
+    with HEARTBEATS_LOCK:
+        HEARTBEATS.add(receipt_handle)
+
+
+def stop_heartbeat(receipt_handle):
+    with HEARTBEATS_LOCK:
+        HEARTBEATS.discard(receipt_handle)
+
+
+def heartbeat(sqs):
+    """Every HeartbeatSeconds, keep the messages of the jobs received and not
+    yet done invisible; runs on a thread of its own"""
+    while True:
+        time.sleep(HeartbeatSeconds)
+        # held throughout, so no message is extended after it was deleted
+        with HEARTBEATS_LOCK:
+            for receipt_handle in list(HEARTBEATS):
+                # reference:
+                # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs.html#SQS.Client.change_message_visibility
+                try:
+                    sqs.change_message_visibility(QueueUrl=RequestsQueueURL,
+                                                  ReceiptHandle=receipt_handle,
+                                                  VisibilityTimeout=VisibilityTimeoutSeconds)
+                except ClientError as e:
+                    print(errortmp("Extend message visibility failed.", e))
+
+
+def delete_message(sqs, receipt_handle):
+    """Delete a message whose job is done"""
+    stop_heartbeat(receipt_handle)
+    # reference:
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs.html#SQS.Client.delete_message
+    try:
+        sqs.delete_message(QueueUrl=RequestsQueueURL,
+                           ReceiptHandle=receipt_handle)
+    except ClientError as e:
+        print(errortmp("Delete message from queue failed.", e))
+
+
+def mark_job_failed(db, message_body):
+    """Set the status of a job that failed its last attempt to FAILED; a
+    failed shard fails its parent job"""
+    job_id = message_body.get('parent_job_id', message_body['job_id'])
+    # reference:
+    # https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/Expressions.ConditionExpressions.html
+    try:
+        table = db.Table(TableName)
+        table.update_item(
+            Key={'job_id': job_id},
+            UpdateExpression='set job_status = :failed',
+            ConditionExpression='job_status <> :completed',
+            ExpressionAttributeValues={':failed': 'FAILED', ':completed': 'COMPLETED'}
+        )
+    except ClientError as e:
+        print(errortmp("Update job status to FAILED failed.", e))
+
+
+def check_in_flight(sqs, db, in_flight, jobs):
+    """
+    Delete the messages of jobs that succeeded. Messages of failed jobs are
+    left to be re-delivered after their visibility timeout, and their jobs
+    resume from their checkpoint; after MaxJobAttempts deliveries the job is
+    marked FAILED and its message deleted.
+    """
+    for receipt_handle, job in list(in_flight.items()):
+        finished = job_finished(job) if job is not None else None
+        if finished is None:
+            continue
+        del in_flight[receipt_handle]
+        message_body = jobs.pop(receipt_handle)
+        BACKLOG.job_done(receipt_handle)
+        if finished:
+            JOBS_COMPLETED.inc('annotated')
+            delete_message(sqs, receipt_handle)
+            continue
+        JOBS_FAILED.inc()
+        if message_body['receive_count'] >= MaxJobAttempts:
+            print(f"Job {message_body['job_id']} failed {message_body['receive_count']} times, "
+                  f"giving up on it.")
+            mark_job_failed(db, message_body)
+            delete_message(sqs, receipt_handle)
+        else:
+            stop_heartbeat(receipt_handle)
+
+
+def release_message(sqs, receipt_handle):
+    """Make the message of a job this annotator gives up on visible again,
+    for another annotator to resume from its checkpoint"""
+    stop_heartbeat(receipt_handle)
+    # reference:
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs.html#SQS.Client.change_message_visibility
+    try:
+        sqs.change_message_visibility(QueueUrl=RequestsQueueURL,
+                                      ReceiptHandle=receipt_handle,
+                                      VisibilityTimeout=0)
+    except ClientError as e:
+        print(errortmp("Release message to queue failed.", e))
+
+
+def release_in_flight(sqs, in_flight, jobs):
+    """Stop the annotation subprocesses still running and release their
+    messages; their jobs resume from their checkpoint on another annotator.
+    A thread cannot be stopped, so jobs running on threads stay in flight,
+    with their messages kept invisible, until they are done. Returns the
+    number of jobs released"""
+    released = 0
+    for receipt_handle, job in list(in_flight.items()):
+        if job is None or isinstance(job, Future):
+            continue
+        job.terminate()
+        release_message(sqs, receipt_handle)
+        del in_flight[receipt_handle]
+        del jobs[receipt_handle]
+        BACKLOG.job_done(receipt_handle)
+        released += 1
+    return released
+
+
+def drain(signum=None, frame=None):
+    """Stop receiving jobs and let the annotator finish the ones in flight"""
+    if not DRAINING.is_set():
+        print("Draining: no new jobs, waiting for the jobs in flight.")
+        DRAINING.set()
+        READY.clear()
+        if os.path.exists(ReadyFile):
+            os.remove(ReadyFile)
+
+
+def warm_up(started):
+    """Warm up, then mark the annotator ready to receive jobs"""
+    report = warmup.warm_up(WarmupThreads)
+    report['time_to_ready_seconds'] = time.time() - started
+    print(f"Ready in {report['time_to_ready_seconds']:.2f} seconds "
+          f"(reference tables warmed up in {report['seconds']:.2f} seconds).")
+    TIME_TO_READY.set(report['time_to_ready_seconds'])
+    try:
+        with open(ReadyFile, 'w') as fh:
+            json.dump(report, fh)
+    except OSError as e:
+        print(errortmp("Write ready file failed.", e))
+    READY.set()
+
+
+def observe_runs(runs):
+    """Add the pipeline runs collected from the metrics spool to the metrics"""
+    for run_metrics in runs:
+        ANNOTATE_SECONDS.observe(sum(stage['wall_seconds'] for stage in run_metrics['stages']))
+        if 'upload_seconds' in run_metrics['timings']:
+            UPLOAD_SECONDS.observe(run_metrics['timings']['upload_seconds'])
+        for stage in run_metrics['stages']:
+            for stats in stage.get('query_shapes', {}).values():
+                DB_QUERY_SECONDS.add_counts(stats['buckets'], stats['total_seconds'],
+                                            stats['table'] or '')
+
+
+def stage_totals():
+    """Exposition lines of the process-wide stage metrics totals"""
+    lines = []
+    totals = stage_metrics.totals()
+    for counter in stage_metrics.COUNTERS:
+        name = f'gas_annotator_stage_{counter}_total'
+        lines += [f'# HELP {name} Sum of {counter} of AnnTools pipeline stages',
+                  f'# TYPE {name} counter']
+        lines += [f'{name}{metrics.format_labels(["stage"], [stage])} '
+                  f'{metrics.format_value(total[counter])}'
+                  for stage, total in sorted(totals.items())]
+    return lines
+
+
+REGISTRY.add_collector(stage_totals)
+
+
+def main():
+    """
+    1. Warm up the reference database, then mark the annotator ready
+    2. Poll the message queue, get up to MaxBatchJobs messages and the job info,
+       while fewer than AnnotatorSlots jobs are in flight
+    3. Handle each job, collecting small jobs into a pending micro-batch
+    4. Run the micro-batch once it is full or BatchWindowSeconds old
+    5. Delete the messages of completed jobs, and of jobs that failed
+       MaxJobAttempts times, marking those FAILED; a heartbeat thread keeps
+       extending the visibility of the messages of jobs in flight, so the
+       message of a job lost with its annotator is re-delivered to another one
+    6. Collect the stage metrics of finished jobs into stage_metrics.totals()
+       and update the metrics served at MetricsPort
+    7. Publish the queued and in-flight work and slots for autoscaling
+    8. Once draining, stop receiving, release the messages of batched jobs,
+       and return when the jobs in flight are done; after
+       DrainTimeoutSeconds the annotation subprocesses are stopped and
+       their messages released, while the small jobs running on threads,
+       which cannot be stopped, are waited for. The instance can then be
+       terminated
+    """
+    started = time.time()
+    s3, db, sqs, sns = None, None, None, None
+    try:
+        s3 = boto3.client('s3',
+                          region_name=AwsRegionName,
+                          config=Config(signature_version='s3v4')
+                          )
+        db = boto3.resource('dynamodb', region_name=AwsRegionName)
+        sqs = boto3.client('sqs', region_name=AwsRegionName)
+        sns = boto3.client('sns', region_name=AwsRegionName)
+    except ClientError as e:
+        print(errortmp("Get aws client failed.", e))
+
+    backlog_sink = None
+    if BacklogMetricSink == 'cloudwatch':
+        backlog_sink = backlog.CloudWatchSink(boto3.client('cloudwatch', region_name=AwsRegionName),
+                                              BacklogMetricNamespace)
+    elif BacklogMetricSink == 'local':
+        backlog_sink = backlog.LocalSink(BacklogMetricFile)
+
+    if MetricsPort:
+        try:
+            metrics.serve(REGISTRY, MetricsPort, MetricsHost, READY)
+        except OSError as e:
+            print(errortmp("Serve metrics endpoint failed.", e))
+
+    # a restarted annotator is not ready until it has warmed up again
+    if os.path.exists(ReadyFile):
+        os.remove(ReadyFile)
+    warm_up(started)
+
+    # signal handlers can only be set from the main thread
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, drain)
+        signal.signal(signal.SIGUSR1, drain)
+    if LifecycleHookName:
+        lifecycle.watch_termination(drain, LifecyclePollSeconds)
+
+    batch_jobs = []
+    batch_receipts = []
+    batch_deadline = None
+    drain_deadline = None
+    # receipt handle -> annotation subprocess or thread, None while batched
+    in_flight = {}
+    # receipt handle -> job data of the jobs in flight
+    jobs = {}
+    threading.Thread(target=heartbeat, args=(sqs,), daemon=True).start()
+    next_backlog_metric = time.time()
+    while True:
+        """Get uploaded files, annotate them and update job status to database"""
+        if DRAINING.is_set() and drain_deadline is None:
+            drain_deadline = time.time() + DrainTimeoutSeconds
+            # batched jobs have not started, another annotator can run them now
+            for receipt_handle in batch_receipts:
+                release_message(sqs, receipt_handle)
+                del in_flight[receipt_handle]
+                del jobs[receipt_handle]
+                BACKLOG.job_done(receipt_handle)
+            batch_jobs, batch_receipts, batch_deadline = [], [], None
+
+        # poll the message queue, without waiting past the pending batch's window
         # reference:
-        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs.html#SQS.Client.delete_message
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs.html#SQS.Client.receive_message
+        wait_time = 3
+        if batch_deadline is not None:
+            wait_time = max(0, min(wait_time, int(batch_deadline - time.time())))
+        sqs_response = {}
+        receive_start = time.time()
+        # no more jobs than AnnotatorSlots are taken at a time, the rest are
+        # left in the queue for other annotators
+        free_slots = AnnotatorSlots - len(in_flight)
         try:
-            sqs.delete_message(QueueUrl=RequestsQueueURL,
-                               ReceiptHandle=receipt_handle)
+            if DRAINING.is_set() or free_slots <= 0:
+                time.sleep(1)
+            else:
+                sqs_response = sqs.receive_message(
+                    QueueUrl=RequestsQueueURL,
+                    AttributeNames=['All'],
+                    MaxNumberOfMessages=min(10, MaxBatchJobs, free_slots),
+                    MessageAttributeNames=['All'],
+                    VisibilityTimeout=VisibilityTimeoutSeconds,
+                    WaitTimeSeconds=wait_time
+                )
+                RECEIVE_SECONDS.observe(time.time() - receive_start)
         except ClientError as e:
-            print(errortmp("Delete message from queue failed.", e))
+            print(errortmp("Poll the message queue failed.", e))
+
+        # the heartbeat keeps every received message invisible, also while
+        # the ones before it are downloaded, hashed or split
+        for message in sqs_response.get('Messages', []):
+            keep_invisible(message["ReceiptHandle"])
+        for message in sqs_response.get('Messages', []):
+            if 'SentTimestamp' in message.get('Attributes', {}):
+                QUEUE_WAIT_SECONDS.observe(
+                    max(0, time.time() - int(message['Attributes']['SentTimestamp']) / 1000))
+            message_body = job_message(message)
+            message_body['receive_count'] = \
+                int(message.get('Attributes', {}).get('ApproximateReceiveCount', 1))
+            # get the handler of this message in order to delete it
+            receipt_handle = message["ReceiptHandle"]
+
+            job, batch_job = handle_message(s3, db, sns, message_body)
+            if batch_job is not None:
+                if not batch_jobs:
+                    batch_deadline = time.time() + BatchWindowSeconds
+                batch_jobs.append(batch_job)
+                batch_receipts.append(receipt_handle)
+                in_flight[receipt_handle] = None
+                jobs[receipt_handle] = message_body
+                BACKLOG.job_started(receipt_handle, message_body['size_estimate'])
+            elif job is not None:
+                in_flight[receipt_handle] = job
+                jobs[receipt_handle] = message_body
+                BACKLOG.job_started(receipt_handle, message_body['size_estimate'])
+            else:
+                # reused or fanned out
+                delete_message(sqs, receipt_handle)
+
+            if len(batch_jobs) >= MaxBatchJobs:
+                batch = flush_batch(batch_jobs)
+                in_flight.update((r, batch) for r in batch_receipts)
+                batch_jobs, batch_receipts, batch_deadline = [], [], None
+
+        if batch_jobs and time.time() >= batch_deadline:
+            batch = flush_batch(batch_jobs)
+            in_flight.update((r, batch) for r in batch_receipts)
+            batch_jobs, batch_receipts, batch_deadline = [], [], None
+
+        check_in_flight(sqs, db, in_flight, jobs)
+
+        # add the stage metrics of finished pipeline runs to this process' totals
+        observe_runs(stage_metrics.collect(run.MetricsSpoolDir))
+        JOBS_IN_FLIGHT.set(len(in_flight))
+        FREE_SLOTS.set(max(0, AnnotatorSlots - len(in_flight)))
+
+        # publish the autoscaling signal
+        if backlog_sink is not None and time.time() >= next_backlog_metric:
+            next_backlog_metric = time.time() + BacklogMetricSeconds
+            try:
+                measured = BACKLOG.measure(backlog.queue_depth(sqs, RequestsQueueURL), AnnotatorSlots)
+                QUEUED_WORK.set(measured['QueuedWorkSeconds'])
+                IN_FLIGHT_WORK.set(measured['InFlightWorkSeconds'])
+                backlog_sink.publish(measured)
+            except (ClientError, OSError) as e:
+                print(errortmp("Publish backlog metric failed.", e))
+
+        if drain_deadline is not None and in_flight and time.time() >= drain_deadline:
+            released = release_in_flight(sqs, in_flight, jobs)
+            if released:
+                print(f"Drain deadline passed, released {released} unfinished jobs.")
+                if in_flight:
+                    print(f"Waiting for {len(in_flight)} jobs running on threads.")
+        if drain_deadline is not None and not in_flight:
+            observe_runs(stage_metrics.collect(run.MetricsSpoolDir))
+            print("Drained: safe to terminate.")
+            if AutoScalingGroupName and LifecycleHookName:
+                lifecycle.complete_lifecycle_action(
+                    boto3.client('autoscaling', region_name=AwsRegionName),
+                    AutoScalingGroupName, LifecycleHookName)
+            return
 
 
 if __name__ == '__main__':
@@ -0,0 +1,102 @@
+# backlog.py
+#
+# Autoscaling signal of the annotator farm: the work waiting in the request
+# queue and running on this annotator, weighted by estimated job size, and
+# its annotation slots. Published to CloudWatch, or to a local JSON lines
+# file standing in for it. The queue is shared by the whole farm, so the
+# backlog per slot is only computed across annotators, in the metric math
+# (AVG(QueuedWorkSeconds) + SUM(InFlightWorkSeconds)) / SUM(Slots)
+#
+##
+
+import collections
+import json
+import time
+
+
+class BacklogSignal(object):
+    """
+    Estimated work, in annotation seconds, of the jobs in flight on this
+    annotator and of the messages still in the request queue. Queued jobs
+    have not been pre-scanned yet, so each counts as the average size of the
+    last recent_jobs jobs this annotator received.
+    """
+
+    def __init__(self, seconds_per_variant, default_variants, recent_jobs=100):
+        self.seconds_per_variant = seconds_per_variant
+        self.default_variants = default_variants
+        self.recent = collections.deque(maxlen=recent_jobs)
+        # receipt handle -> estimated variants of the jobs in flight
+        self.in_flight = {}
+
+    def job_started(self, receipt_handle, size_estimate):
+        variants = self.default_variants
+        if size_estimate is not None:
+            variants = int(size_estimate['estimated_variants'])
+            self.recent.append(variants)
+        self.in_flight[receipt_handle] = variants
+
+    def job_done(self, receipt_handle):
+        self.in_flight.pop(receipt_handle, None)
+
+    def average_job_variants(self):
+        if not self.recent:
+            return self.default_variants
+        return sum(self.recent) / len(self.recent)
+
+    def measure(self, queued_messages, slots):
+        """The signal for queued_messages messages in the request queue and
+        slots annotation slots on this annotator; the queued work is that of
+        the whole farm, the jobs in flight and slots this annotator's"""
+        queued_seconds = queued_messages * self.average_job_variants() * self.seconds_per_variant
+        in_flight_seconds = sum(self.in_flight.values()) * self.seconds_per_variant
+        return {'QueuedMessages': queued_messages,
+                'QueuedWorkSeconds': queued_seconds,
+                'InFlightJobs': len(self.in_flight),
+                'InFlightWorkSeconds': in_flight_seconds,
+                'Slots': slots}
+
+
+def queue_depth(sqs, queue_url):
+    """Approximate number of messages waiting to be received"""
+    # reference:
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs.html#SQS.Client.get_queue_attributes
+    response = sqs.get_queue_attributes(QueueUrl=queue_url,
+                                        AttributeNames=['ApproximateNumberOfMessages'])
+    return int(response['Attributes']['ApproximateNumberOfMessages'])
+
+
+class CloudWatchSink(object):
+    """Publishes the signal as CloudWatch metrics of namespace"""
+
+    UNITS = {'QueuedMessages': 'Count', 'InFlightJobs': 'Count', 'Slots': 'Count'}
+
+    def __init__(self, cloudwatch, namespace, dimensions=None):
+        self.cloudwatch = cloudwatch
+        self.namespace = namespace
+        self.dimensions = [{'Name': name, 'Value': value}
+                           for name, value in (dimensions or {}).items()]
+
+    def publish(self, signal):
+        # reference:
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/cloudwatch.html#CloudWatch.Client.put_metric_data
+        self.cloudwatch.put_metric_data(
+            Namespace=self.namespace,
+            MetricData=[{'MetricName': name,
+                         'Dimensions': self.dimensions,
+                         'Value': float(value),
+                         'Unit': self.UNITS.get(name, 'Seconds')}
+                        for name, value in signal.items()])
+
+
+class LocalSink(object):
+    """Appends the signal to a JSON lines file, in place of CloudWatch"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def publish(self, signal):
+        with open(self.path, 'a') as fh:
+            fh.write(json.dumps(dict(signal, time=int(time.time()))) + '\n')
+
+### EOF
@@ -0,0 +1,99 @@
+# batching.py
+#
+# Combine the inputs of several small jobs into one micro-batch that is
+# annotated in a single pipeline pass, and split the annotated batch and
+# its count log back into per-job results
+#
+##
+
+import json
+
+import annotate
+import stage_metrics
+import vcf_shards
+
+
+def marker(job_index):
+    """Marker line that precedes the records of the job_index-th job"""
+    return f'{annotate.BATCH_MARKER}{job_index}'
+
+
+def combine_inputs(job_files, combined_file):
+    """Concatenate the job inputs, each preceded by its marker line"""
+    with open(combined_file, 'w') as fh_out:
+        for job_index, job_file in enumerate(job_files):
+            fh_out.write(marker(job_index) + '\n')
+            with open(job_file) as fh:
+                for line in fh:
+                    fh_out.write(line if line.endswith('\n') else line + '\n')
+
+
+def split_annotated(combined_result, job_results):
+    """Write the annotated lines following each marker to that job's result"""
+    fh_out = None
+    with open(combined_result) as fh:
+        for line in fh:
+            if annotate.isBatchMarker(line):
+                if fh_out:
+                    fh_out.close()
+                fh_out = open(job_results[int(line.strip()[len(annotate.BATCH_MARKER):])], 'w')
+            elif fh_out:
+                fh_out.write(line)
+    if fh_out:
+        fh_out.close()
+
+
+def split_count_log(combined_log, job_logs):
+    """
+    Every logging stage writes, for each marker, the marker line and a
+    snapshot of its counters, then its final counters. A job's counters are
+    the difference between the snapshot at its marker and the next snapshot
+    (or the final counters, for the last job).
+    """
+    with open(combined_log) as fh:
+        lines = fh.read().splitlines()
+
+    job_count = len(job_logs)
+    first_marker = marker(0)
+    stage_starts = [i for i, line in enumerate(lines) if line == first_marker]
+
+    job_lines = [[] for _ in job_logs]
+    for stage_start, stage_end in zip(stage_starts, stage_starts[1:] + [len(lines)]):
+        stage = [line for line in lines[stage_start:stage_end]
+                 if not annotate.isBatchMarker(line)]
+        # job_count snapshots plus the final counters, all of the same length
+        snapshot_length = len(stage) // (job_count + 1)
+        snapshots = [stage[i * snapshot_length:(i + 1) * snapshot_length]
+                     for i in range(job_count + 1)]
+        for job_index in range(job_count):
+            job_lines[job_index] += [
+                vcf_shards.combine_log_line(pair, lambda counts: counts[1] - counts[0])
+                for pair in zip(snapshots[job_index], snapshots[job_index + 1])]
+
+    for job_log, log_lines in zip(job_logs, job_lines):
+        with open(job_log, 'w') as fh_out:
+            fh_out.write('\n'.join(vcf_shards.fix_dbsnp_ratio(log_lines)) + '\n')
+
+
+def split_stage_metrics(combined_file, job_files):
+    """Stage metrics cover the whole batch; every job gets a copy that
+    records the number of jobs it was shared by"""
+    sidecar = stage_metrics.read_sidecar(combined_file)
+    if sidecar is None:
+        return
+    sidecar['batch_jobs'] = len(job_files)
+    for job_file in job_files:
+        with open(stage_metrics.sidecar_file(job_file), 'w') as fh_out:
+            json.dump(sidecar, fh_out, indent=2)
+
+
+def split_results(combined_file, job_files):
+    """Split the annotated batch into the result file, count log and stage
+    metrics of each job"""
+    split_annotated(vcf_shards.result_file(combined_file),
+                    [vcf_shards.result_file(f) for f in job_files])
+    split_count_log(vcf_shards.log_file(combined_file),
+                    [vcf_shards.log_file(f) for f in job_files])
+    split_stage_metrics(combined_file, job_files)
+
+### EOF
@@ -0,0 +1,139 @@
+# checkpoint.py
+#
+# Durable checkpoints of the AnnTools pipeline at stage boundaries, so a
+# re-delivered job resumes from its last completed stage
+#
+##
+
+import json
+import os
+import shutil
+import time
+
+from botocore.exceptions import ClientError
+
+
+class Checkpoint(object):
+    """
+    A checkpoint after stage n is the stage's output (infile.<n>) and the
+    count log so far, saved under names that include n, plus a manifest
+    written last that names n. A crash while saving leaves the previous
+    checkpoint intact. Checkpoints are taken at most every interval seconds,
+    so short jobs never pay for them.
+    Subclasses store the objects: _put, _get (False if missing) and _delete.
+    """
+
+    MANIFEST = 'checkpoint.json'
+
+    def __init__(self, infile, interval=60):
+        self.infile = infile
+        self.interval = interval
+        self.last_saved = time.time()
+        self.stages_saved = 0
+
+    def restore(self):
+        """Restore the last checkpoint's files; returns its number of stages done"""
+        if not self._get(self.MANIFEST, self.infile + '.checkpoint'):
+            return 0
+        with open(self.infile + '.checkpoint') as fh:
+            stages_done = json.load(fh)['stages_done']
+        os.remove(self.infile + '.checkpoint')
+
+        self._get(f'stage.{stages_done}', self.infile + '.' + str(stages_done))
+        self._get(f'count.log.{stages_done}', self.infile + '.count.log')
+        self.stages_saved = stages_done
+        return stages_done
+
+    def stage_done(self, stages_done):
+        """Save a checkpoint after stages_done stages, if one is due"""
+        if time.time() - self.last_saved < self.interval:
+            return
+
+        # a failed checkpoint only costs the work since the previous one
+        try:
+            self._put(self.infile + '.' + str(stages_done), f'stage.{stages_done}')
+            self._put(self.infile + '.count.log', f'count.log.{stages_done}')
+            with open(self.infile + '.checkpoint', 'w') as fh:
+                json.dump({'stages_done': stages_done}, fh)
+            self._put(self.infile + '.checkpoint', self.MANIFEST)
+            os.remove(self.infile + '.checkpoint')
+
+            if self.stages_saved:
+                self._delete(f'stage.{self.stages_saved}')
+                self._delete(f'count.log.{self.stages_saved}')
+        except (ClientError, OSError) as e:
+            print(f"Save checkpoint failed. {str(e)}")
+            return
+        self.stages_saved = stages_done
+        self.last_saved = time.time()
+
+    def clear(self):
+        """Delete the checkpoint of a completed job"""
+        if self.stages_saved:
+            try:
+                self._delete(self.MANIFEST)
+                self._delete(f'stage.{self.stages_saved}')
+                self._delete(f'count.log.{self.stages_saved}')
+            except (ClientError, OSError) as e:
+                print(f"Delete checkpoint failed. {str(e)}")
+            self.stages_saved = 0
+
+
+    def discard(self, stages_saved):
+        """Delete the checkpoint another process, such as a pool worker,
+        saved after stages_saved stages"""
+        self.stages_saved = stages_saved
+        self.clear()
+
+
+class S3Checkpoint(Checkpoint):
+    """Checkpoint stored under a key prefix of an S3 bucket"""
+
+    def __init__(self, s3, bucket, key_prefix, infile, interval=60):
+        super().__init__(infile, interval)
+        self.s3 = s3
+        self.bucket = bucket
+        self.key_prefix = key_prefix
+
+    def _put(self, filename, name):
+        # reference:
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/guide/s3-uploading-files.html
+        self.s3.upload_file(filename, self.bucket, self.key_prefix + name)
+
+    def _get(self, name, filename):
+        # reference:
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#S3.Client.head_object
+        try:
+            self.s3.head_object(Bucket=self.bucket, Key=self.key_prefix + name)
+        except ClientError:
+            return False
+        self.s3.download_file(self.bucket, self.key_prefix + name, filename)
+        return True
+
+    def _delete(self, name):
+        self.s3.delete_object(Bucket=self.bucket, Key=self.key_prefix + name)
+
+
+class DirectoryCheckpoint(Checkpoint):
+    """Checkpoint stored in a local directory, a stand-in for S3"""
+
+    def __init__(self, directory, infile, interval=60):
+        super().__init__(infile, interval)
+        self.directory = directory
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def _put(self, filename, name):
+        shutil.copy(filename, os.path.join(self.directory, name))
+
+    def _get(self, name, filename):
+        if not os.path.exists(os.path.join(self.directory, name)):
+            return False
+        shutil.copy(os.path.join(self.directory, name), filename)
+        return True
+
+    def _delete(self, name):
+        if os.path.exists(os.path.join(self.directory, name)):
+            os.remove(os.path.join(self.directory, name))
+
+### EOF
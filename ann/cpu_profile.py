@@ -0,0 +1,63 @@
+# cpu_profile.py
+#
+# Low-overhead sampling CPU profile of a thread: its stack is sampled at a
+# fixed rate from a background thread and written in the collapsed-stack
+# format of flamegraph.pl and speedscope
+#
+##
+
+import collections
+import os
+import sys
+import threading
+
+
+def frame_label(frame):
+    """Function of a stack frame, with the file and line it is defined at"""
+    code = frame.f_code
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+
+class SamplingProfiler(object):
+    """
+    Samples the stack of the thread that calls start() every 1/rate seconds
+    until stop(). The profiled thread is never interrupted; the cost is the
+    sampling thread's share of the interpreter lock, about 1% at 100 Hz.
+    """
+
+    def __init__(self, rate=100):
+        self.interval = 1.0 / rate
+        self.samples = collections.Counter()
+        self.stopped = threading.Event()
+
+    def start(self):
+        self.thread_id = threading.get_ident()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(frame_label(frame))
+                frame = frame.f_back
+            if stack:
+                self.samples[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def write(self, path):
+        """Write the samples as collapsed stacks: 'root;...;leaf count' lines"""
+        with open(path, 'w') as fh:
+            for stack, count in self.samples.most_common():
+                fh.write(f'{stack} {count}\n')
+
+
+def report_file(vcf):
+    """Name of the CPU profile of the pipeline run on vcf"""
+    return vcf + '.profile.collapsed'
+
+### EOF
@@ -14,101 +14,109 @@ import sys
 import os
 import file_utils as fu
 import annotate as ann
-
-def run(infile, format):
+import stage_metrics
+import utils as u
+
+"""Pipeline stages in order: (description, stage function, stage options).
+   Each stage reads infile.<n> and writes infile.<n+1>, the first one reads
+   infile itself.
+"""
+STAGES = [
+    ("dbSNP", ann.getSnpsFromDbSnp, {}),
+    ("BigRefGene", ann.getBigRefGene, {}),
+    ("Genes", ann.getGenes, {'table': 'refGene', 'promoter_offset': 500}),
+    ("Cytoband", ann.addOverlapWithCytoband, {'table': 'cytoBand'}),
+    ("gadAll", ann.addOverlapWithGadAll, {'table': 'gadAll'}),
+    ("GwasCatalog", ann.addOverlapWithGwasCatalog, {'table': 'gwasCatalog'}),
+    ("miRNA", ann.addOverlapWithMiRNA, {'table': 'targetScanS'}),
+    ("HUGO Gene Nomenclature Committee", ann.addOverlapWitHUGOGeneNomenclature,
+        {'table': 'hugo'}),
+    ("dgv_Cnv", ann.addOverlapWithCnvDatabase, {'table': 'dgv_Cnv'}),
+    ("abParts_IG_T_CelReceptors", ann.addOverlapWithCnvDatabase,
+        {'table': 'abParts_IG_T_CelReceptors'}),
+    ("mcCarroll_Cnv", ann.addOverlapWithCnvDatabase, {'table': 'mcCarroll_Cnv'}),
+    ("conrad_Cnv", ann.addOverlapWithCnvDatabase, {'table': 'conrad_Cnv'}),
+    ("genomicSuperDups", ann.addOverlapWithGenomicSuperDups,
+        {'table': 'genomicSuperDups'}),
+    ("addOverlapWithTfbsConsSites", ann.addOverlapWithTfbsConsSites,
+        {'table': 'tfbsConsSites'}),
+]
+
+
+"""Counts the variant records of a vcf
+"""
+def countRecords(infile):
+    records = 0
+    with open(infile) as fh:
+        for line in fh:
+            if not line.startswith('#'):
+                records = records + 1
+    return records
+
+
+"""Progress callback of one stage, reporting to the pipeline callback
+"""
+def stageProgress(progress, name, stage_index, stage_count, total_records):
+    def report(records):
+        stage_done = min(1.0, records / float(total_records)) if total_records else 0
+        progress({'stage': name,
+                  'stage_number': stage_index + 1,
+                  'stage_count': stage_count,
+                  'records_processed': records,
+                  'total_records': total_records,
+                  'percent_complete': int((stage_index + stage_done) * 100 / stage_count)})
+    return report
+
+
+"""Runs every stage on infile. If given, progress is called with a dict of
+   the current stage, the records it has processed so far and the estimated
+   percent complete of the whole pipeline. If given, checkpoint is restored
+   to skip the stages a previous run completed, and told about every stage
+   completed after that.
+   If given, memory_profiler records the memory use after every stage.
+   The metrics of every stage run, including the latency of its queries by
+   query shape, are written to the infile.stages.json sidecar, next to the
+   count log.
+"""
+def run(infile, format, progress=None, checkpoint=None, memory_profiler=None):
 
     print("Running . . .")
 
-    ann.getSnpsFromDbSnp(vcf=infile, format='vcf', tmpextin='', 
-        tmpextout='.1')
-    print("dbSNP - done.")
-    tmpextin = 1
-    tmpextout = 2
-
-    ann.getBigRefGene(vcf=infile, format='vcf', tmpextin='.' + str(tmpextin),
-        tmpextout='.' + str(tmpextout))
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.getGenes(vcf=infile, format='vcf', table='refGene', 
-        promoter_offset=500, tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCytoband(vcf=infile, format='vcf', table='cytoBand', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("Cytoband - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGadAll(vcf=infile, format='vcf', table='gadAll', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("gadAll - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGwasCatalog(vcf=infile, format='vcf', 
-        table='gwasCatalog', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("GwasCatalog - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithMiRNA(vcf=infile, format='vcf', table='targetScanS', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("miRNA - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWitHUGOGeneNomenclature(vcf=infile, format='vcf', 
-        table='hugo', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("HUGO Gene Nomenclature Committee - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', table='dgv_Cnv', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("dgv_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='abParts_IG_T_CelReceptors', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("abParts_IG_T_CelReceptors - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='mcCarroll_Cnv', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("mcCarroll_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='conrad_Cnv', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("conrad_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGenomicSuperDups(vcf=infile, format='vcf', 
-        table='genomicSuperDups', tmpextin='.' + str(tmpextin),
-        tmpextout='.' + str(tmpextout))
-    print("genomicSuperDups - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithTfbsConsSites(vcf=infile, table='tfbsConsSites',
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("addOverlapWithTfbsConsSites - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
+    total_records = countRecords(infile) if progress else 0
+    stage_count = len(STAGES)
+
+    tmpextin = checkpoint.restore() if checkpoint else 0
+    stages = []
+    if tmpextin:
+        print(f"Resuming after {STAGES[tmpextin - 1][0]}.")
+
+    for stage_index, (name, stage, options) in enumerate(STAGES):
+        if stage_index < tmpextin:
+            continue
+
+        stage_progress = None
+        if progress:
+            stage_progress = stageProgress(progress, name, stage_index,
+                stage_count, total_records)
+            stage_progress(0)
+
+        with stage_metrics.StageMeter(name, infile + '.' + str(tmpextin + 1),
+                infile + '.count.log') as metrics:
+            stage(vcf=infile, format='vcf',
+                tmpextin='.' + str(tmpextin) if tmpextin else '',
+                tmpextout='.' + str(tmpextin + 1), progress=stage_progress, **options)
+        stages.append(metrics)
+        print(f"{name} - done in {metrics['wall_seconds']:.2f} seconds.")
+        if memory_profiler:
+            memory_profiler.stage_done(name)
+        tmpextin = tmpextin + 1
+        if checkpoint and tmpextin < stage_count:
+            checkpoint.stage_done(tmpextin)
+
+    stage_metrics.explain_slowest_shapes(stages, u.db_connect)
+    stage_metrics.write_sidecar(infile, stages)
+    total = stage_metrics.summary(stages)['total']
+    print(f"Approximate runtime: {total.get('wall_seconds', 0):.2f} seconds")
 
     ## Cleanup
     for i in range(1, tmpextin):
@@ -0,0 +1,69 @@
+# lifecycle.py
+#
+# Scale-in of an annotator instance: detect that its Auto Scaling group is
+# terminating it, from the instance metadata service, and complete the
+# termination lifecycle hook once the annotator has drained
+#
+##
+
+import threading
+import urllib.request
+
+from botocore.exceptions import ClientError
+
+MetadataURL = 'http://169.254.169.254/latest'
+
+
+def metadata(path, timeout=2):
+    """An instance metadata item, with an IMDSv2 session token"""
+    # reference:
+    # https://docs.aws.amazon.com/AWSEC2/latest/UserGuide/instancedata-data-retrieval.html
+    token_request = urllib.request.Request(f'{MetadataURL}/api/token', method='PUT',
+                                           headers={'X-aws-ec2-metadata-token-ttl-seconds': '60'})
+    with urllib.request.urlopen(token_request, timeout=timeout) as response:
+        token = response.read().decode()
+    request = urllib.request.Request(f'{MetadataURL}/meta-data/{path}',
+                                     headers={'X-aws-ec2-metadata-token': token})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return response.read().decode()
+
+
+def target_lifecycle_state():
+    """InService, or Terminated once a scale-in has picked this instance;
+    None where there is no instance metadata"""
+    # reference:
+    # https://docs.aws.amazon.com/autoscaling/ec2/userguide/retrieving-target-lifecycle-state-through-imds.html
+    try:
+        return metadata('autoscaling/target-lifecycle-state')
+    except OSError:
+        return None
+
+
+def watch_termination(on_terminating, poll_seconds=5):
+    """Call on_terminating, once, when the instance is being scaled in;
+    polls the instance metadata from a daemon thread"""
+    stopped = threading.Event()
+
+    def watch():
+        while not stopped.wait(poll_seconds):
+            if target_lifecycle_state() == 'Terminated':
+                on_terminating()
+                return
+
+    threading.Thread(target=watch, daemon=True).start()
+    return stopped
+
+
+def complete_lifecycle_action(autoscaling, group_name, hook_name):
+    """Let the Auto Scaling group go on terminating this instance"""
+    # reference:
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/autoscaling.html#AutoScaling.Client.complete_lifecycle_action
+    try:
+        autoscaling.complete_lifecycle_action(LifecycleHookName=hook_name,
+                                              AutoScalingGroupName=group_name,
+                                              LifecycleActionResult='CONTINUE',
+                                              InstanceId=metadata('instance-id'))
+    except (ClientError, OSError) as e:
+        print(f"Complete lifecycle action failed. {str(e)}")
+
+### EOF
@@ -0,0 +1,149 @@
+# memory_profile.py
+#
+# Opt-in memory profile of an AnnTools pipeline run: tracemalloc snapshots
+# and peak RSS at every stage boundary, with the top allocation sites
+#
+##
+
+import json
+import resource
+import threading
+import time
+import tracemalloc
+
+# profilers running in this process; tracing stops when the last one stops
+_profilers = 0
+_profilers_lock = threading.Lock()
+
+
+def reset_peak_rss():
+    """Start a new peak RSS measurement, where Linux supports it"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as fh:
+            fh.write('5')
+    except OSError:
+        pass
+
+
+def rss_kb():
+    """(current, peak) resident set size of this process in kB"""
+    current, peak = None, None
+    try:
+        with open('/proc/self/status') as fh:
+            for line in fh:
+                if line.startswith('VmRSS:'):
+                    current = int(line.split()[1])
+                elif line.startswith('VmHWM:'):
+                    peak = int(line.split()[1])
+    except OSError:
+        pass
+    if peak is None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return current, peak
+
+
+def take_snapshot():
+    """Snapshot of the traced allocations, without tracemalloc's and the
+    profiler's own"""
+    return tracemalloc.take_snapshot().filter_traces(
+        [tracemalloc.Filter(False, tracemalloc.__file__),
+         tracemalloc.Filter(False, __file__)])
+
+
+def allocation_sites(statistics, top):
+    """The top allocation sites of tracemalloc statistics, largest first.
+    Sites traced with more than one frame have their callers too, the
+    outermost first"""
+    sites = []
+    for stat in statistics[:top]:
+        # the frames are sorted from the oldest to the most recent call
+        frame = stat.traceback[-1]
+        site = {'site': f'{frame.filename}:{frame.lineno}',
+                'size_kb': stat.size // 1024,
+                'count': stat.count}
+        if len(stat.traceback) > 1:
+            site['traceback'] = [f'{frame.filename}:{frame.lineno}'
+                                 for frame in stat.traceback]
+        if hasattr(stat, 'size_diff'):
+            site['size_diff_kb'] = stat.size_diff // 1024
+            site['count_diff'] = stat.count_diff
+        sites.append(site)
+    return sites
+
+
+class MemoryProfiler(object):
+    """
+    Traces the allocations of this process from start() to stop(). At every
+    stage_done(name) it records the RSS and traced memory, their peaks during
+    the stage, the top allocation sites still holding memory and the sites
+    whose memory changed the most during the stage.
+    tracemalloc slows allocation-heavy code down several times, so only
+    profile jobs on request, and in a process of their own: the traces
+    cover every thread.
+    """
+
+    def __init__(self, top=10, frames=1):
+        self.top = top
+        self.frames = frames
+        # with more than one frame, sites are grouped by their whole traceback
+        self.key_type = 'traceback' if frames > 1 else 'lineno'
+        self.stages = []
+
+    def start(self):
+        global _profilers
+        with _profilers_lock:
+            if not _profilers:
+                tracemalloc.start(self.frames)
+            _profilers += 1
+        reset_peak_rss()
+        self.started = time.perf_counter()
+        self.stage_started = self.started
+        self.snapshot = take_snapshot()
+
+    def stage_done(self, name):
+        """Record the memory use of the stage that just completed"""
+        current_rss, peak_rss = rss_kb()
+        traced, traced_peak = tracemalloc.get_traced_memory()
+        snapshot = take_snapshot()
+        self.stages.append({
+            'stage': name,
+            'seconds': time.perf_counter() - self.stage_started,
+            'rss_kb': current_rss,
+            'peak_rss_kb': peak_rss,
+            'traced_kb': traced // 1024,
+            'traced_peak_kb': traced_peak // 1024,
+            'top_allocations': allocation_sites(snapshot.statistics(self.key_type), self.top),
+            'growth': allocation_sites(snapshot.compare_to(self.snapshot, self.key_type),
+                                       self.top)
+        })
+        self.snapshot = snapshot
+
+        reset_peak_rss()
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        self.stage_started = time.perf_counter()
+
+    def stop(self):
+        global _profilers
+        with _profilers_lock:
+            _profilers -= 1
+            if not _profilers:
+                tracemalloc.stop()
+        self.snapshot = None
+
+    def report(self):
+        return {'frames': self.frames,
+                'seconds': time.perf_counter() - self.started,
+                'peak_rss_kb': max([stage['peak_rss_kb'] for stage in self.stages], default=None),
+                'stages': self.stages}
+
+    def write(self, path):
+        with open(path, 'w') as fh:
+            json.dump(self.report(), fh, indent=2)
+
+
+def report_file(vcf):
+    """Name of the memory profile report of the pipeline run on vcf"""
+    return vcf + '.memory.json'
+
+### EOF
@@ -0,0 +1,171 @@
+# metrics.py
+#
+# Counters, gauges and histograms of the annotator, served over HTTP in the
+# Prometheus text exposition format
+#
+##
+
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# default histogram buckets, in seconds, for job phase durations
+DURATION_BUCKETS = [0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600]
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = [(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for name, value in pairs]
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+class Metric(object):
+    """A metric family; its series are keyed by their label values"""
+
+    kind = None
+
+    def __init__(self, registry, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.series = {}
+        registry.register(self)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} {self.kind}']
+        with self.lock:
+            for label_values, value in sorted(self.series.items()):
+                lines += self.render_series(label_values, value)
+        return lines
+
+    def render_series(self, label_values, value):
+        return [f'{self.name}{format_labels(self.labels, label_values)} {format_value(value)}']
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.series[label_values] = self.series.get(label_values, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, *label_values):
+        with self.lock:
+            self.series[label_values] = value
+
+
+class Histogram(Metric):
+    """Histogram with fixed upper bounds; observations above the last bound
+    only count in the +Inf bucket"""
+
+    kind = 'histogram'
+
+    def __init__(self, registry, name, help_text, labels=(), buckets=DURATION_BUCKETS):
+        self.buckets = list(buckets)
+        super().__init__(registry, name, help_text, labels)
+
+    def _series(self, label_values):
+        if label_values not in self.series:
+            self.series[label_values] = {'buckets': [0] * (len(self.buckets) + 1),
+                                         'sum': 0.0, 'count': 0}
+        return self.series[label_values]
+
+    def observe(self, value, *label_values):
+        with self.lock:
+            series = self._series(label_values)
+            series['buckets'][bisect.bisect_left(self.buckets, value)] += 1
+            series['sum'] += value
+            series['count'] += 1
+
+    def add_counts(self, bucket_counts, total, *label_values):
+        """Add observations already counted into this histogram's buckets,
+        one count per bucket plus the overflow, with their sum"""
+        with self.lock:
+            series = self._series(label_values)
+            series['buckets'] = [a + b for a, b in zip(series['buckets'], bucket_counts)]
+            series['sum'] += total
+            series['count'] += sum(bucket_counts)
+
+    def render_series(self, label_values, series):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + [float('inf')], series['buckets']):
+            cumulative += count
+            labels = format_labels(self.labels, label_values, [('le', format_value(bound))])
+            lines.append(f'{self.name}_bucket{labels} {cumulative}')
+        labels = format_labels(self.labels, label_values)
+        lines.append(f'{self.name}_sum{labels} {format_value(series["sum"])}')
+        lines.append(f'{self.name}_count{labels} {series["count"]}')
+        return lines
+
+
+class Registry(object):
+    """The metrics to expose, plus collectors: functions called at every
+    scrape that return more exposition lines"""
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines += metric.render()
+        for collector in self.collectors:
+            lines += collector()
+        return '\n'.join(lines) + '\n'
+
+
+def serve(registry, port, host='127.0.0.1', ready=None):
+    """Serve the registry at http://host:port/metrics from a daemon thread;
+    with a ready Event, /ready answers 200 once it is set and 503 before.
+    Returns the server"""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            path = self.path.split('?')[0]
+            if path == '/ready' and ready is not None:
+                status = 200 if ready.is_set() else 503
+                body = b'ready\n' if ready.is_set() else b'not ready\n'
+            elif path == '/metrics':
+                status = 200
+                body = registry.render().encode()
+            else:
+                self.send_error(404)
+                return
+            self.send_response(status)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # scrapes are too frequent to log
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+### EOF
@@ -0,0 +1,61 @@
+# prescan.py
+#
+# Estimate the size of an annotation job from its S3 input object
+# without downloading the whole file
+#
+##
+
+
+def prescan_input(s3, bucket, key, sample_bytes=65536):
+    """
+    1. HEAD the input object to get its size
+    2. Ranged GET of the first sample_bytes of the object
+    3. Extrapolate the variant count from the average record length in the
+       sample, and the per-chromosome distribution from the sampled records
+    """
+    # reference:
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#S3.Client.head_object
+    object_size = s3.head_object(Bucket=bucket, Key=key)['ContentLength']
+    if object_size == 0:
+        return {'object_size': 0, 'estimated_variants': 0, 'chrom_distribution': {}}
+
+    # reference:
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#S3.Client.get_object
+    s3_response = s3.get_object(Bucket=bucket, Key=key, Range=f'bytes=0-{sample_bytes - 1}')
+    sample = s3_response['Body'].read()
+    truncated = len(sample) < object_size
+
+    lines = sample.split(b'\n')
+    if truncated:
+        # the last line of a truncated sample is incomplete
+        lines = lines[:-1]
+
+    header_bytes = 0
+    record_bytes = 0
+    chrom_counts = {}
+    for line in lines:
+        if line.startswith(b'#'):
+            header_bytes += len(line) + 1
+        elif line.strip():
+            record_bytes += len(line) + 1
+            chrom = line.split(b'\t', 1)[0].decode(errors='replace').replace('chr', '')
+            chrom_counts[chrom] = chrom_counts.get(chrom, 0) + 1
+
+    sampled_variants = sum(chrom_counts.values())
+    if not truncated or sampled_variants == 0:
+        estimated_variants = sampled_variants
+    else:
+        average_record_bytes = record_bytes / sampled_variants
+        estimated_variants = int((object_size - header_bytes) / average_record_bytes)
+
+    # scale the sampled chromosome counts up to the estimated total;
+    # DynamoDB does not accept floats, so keep the distribution as counts
+    chrom_distribution = {}
+    for chrom, count in chrom_counts.items():
+        chrom_distribution[chrom] = round(count * estimated_variants / sampled_variants)
+
+    return {'object_size': object_size,
+            'estimated_variants': estimated_variants,
+            'chrom_distribution': chrom_distribution}
+
+### EOF
@@ -0,0 +1,69 @@
+# progress.py
+#
+# Throttled, coalescing writer of annotation progress to the job items
+# in DynamoDB
+#
+##
+
+import threading
+
+from botocore.exceptions import ClientError
+
+
+class ProgressWriter(object):
+    """
+    Keeps only the latest progress event and writes it to the job items at
+    most once every interval seconds, from a background thread, so the number
+    of writes depends on the job's runtime and not on its input size.
+    Use as the progress callback of driver.run, and close() when done.
+    """
+
+    def __init__(self, table, job_ids, interval=5):
+        self.table = table
+        self.job_ids = job_ids
+        self.interval = interval
+        self.latest = None
+        self.written = None
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def __call__(self, event):
+        with self.lock:
+            self.latest = event
+
+    def _run(self):
+        while not self.closed.wait(self.interval):
+            self.flush()
+
+    def flush(self):
+        """Write the latest progress event, if it has not been written yet"""
+        with self.lock:
+            event = self.latest
+        if event is None or event is self.written:
+            return
+
+        # never write progress over a job that has already completed
+        # reference:
+        # https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/Expressions.ConditionExpressions.html
+        for job_id in self.job_ids:
+            try:
+                self.table.update_item(
+                    Key={'job_id': job_id},
+                    UpdateExpression='set progress = :progress',
+                    ConditionExpression='job_status <> :completed',
+                    ExpressionAttributeValues={':progress': event,
+                                               ':completed': 'COMPLETED'}
+                )
+            except ClientError as e:
+                print(f"Update job progress failed. {str(e)}")
+        self.written = event
+
+    def close(self):
+        """Stop the background thread and write the last progress event"""
+        self.closed.set()
+        self.thread.join()
+        self.flush()
+
+### EOF
@@ -17,8 +17,20 @@ import time
 import shutil
 import os
 import json
+import hashlib
+import argparse
+from functools import partial
+from multiprocessing import Pool
 
+import batching
+import checkpoint
+import cpu_profile
 import driver
+import memory_profile
+import progress
+import stage_metrics
+import utils
+import vcf_shards
 import sys
 sys.path.insert(0, '/home/ec2-user/mpcs-cc/gas/util')
 import helpers
@@ -32,113 +44,520 @@ TableName = config['aws']['TableName']
 ResultBucketName = config['aws']['S3ResultsBucket']
 S3KeyPrefix = config['aws']['S3KeyPrefix']
 ResultsSNSArn = config['aws']['ResultsSNSArn']
+# results are reused, and registered for reuse, only with a result index
+ResultIndexTableName = config.get('aws', 'ResultIndexTableName', fallback=None)
 
-"""A rudimentary timer for coarse-grained profiling
-"""
+# Results are reused only for the same input annotated with the same
+# reference data; bump this whenever the annotation database is reloaded
+ReferenceVersion = config.get('ann', 'ReferenceVersion', fallback='dbSNP135')
 
+# Progress events are written to the job item at most this often
+ProgressIntervalSeconds = config.getint('ann', 'ProgressIntervalSeconds', fallback=5)
 
-class Timer(object):
-    def __init__(self, verbose=True):
-        self.verbose = verbose
+# Long jobs save a stage checkpoint at most this often
+CheckpointIntervalSeconds = config.getint('ann', 'CheckpointIntervalSeconds', fallback=60)
 
-    def __enter__(self):
-        self.start = time.time()
-        return self
+# Finished pipeline runs leave their stage metrics here for the annotator
+# to add to its process-wide totals
+MetricsSpoolDir = config.get('ann', 'MetricsSpoolDir', fallback='jobs/metrics')
 
-    def __exit__(self, *args):
-        self.end = time.time()
-        self.secs = self.end - self.start
-        if self.verbose:
-            print(f"Approximate runtime: {self.secs:.2f} seconds")
+# Memory profiled jobs report the MemoryProfileTopSites top allocation sites
+# of every stage, with tracebacks of MemoryProfileFrames frames
+MemoryProfileTopSites = config.getint('ann', 'MemoryProfileTopSites', fallback=10)
+MemoryProfileFrames = config.getint('ann', 'MemoryProfileFrames', fallback=1)
 
+# CPU profiled jobs sample their stack ProfileSampleHz times a second
+ProfileSampleHz = config.getint('ann', 'ProfileSampleHz', fallback=100)
 
-if __name__ == '__main__':
-    # Call the AnnTools pipeline
-    if len(sys.argv) > 1:
-        with Timer():
-            driver.run(sys.argv[1], 'vcf')
-
-        # upload the results and log file to S3
-        # sys.argv[1] example:
-        # jobs/fake_user/jobid/jobid~test_zhicongm.vcf
-        full_filename = sys.argv[1]
-        job_id = sys.argv[2]
-        user_id = full_filename.split('/')[1]
-        # job_id = full_filename.split('/')[2] + '/'
-        filename = full_filename.split('/')[3]
-
-        s3 = boto3.client('s3',
-                          region_name=AwsRegionName,
-                          config=Config(signature_version='s3v4')
-                          )
-
-        # reference:
-        # https://boto3.amazonaws.com/v1/documentation/api/latest/guide/s3-uploading-files.html
-        result_object_name = S3KeyPrefix + user_id + '/' + job_id + filename[:-3] + 'annot.vcf'
-        log_object_name = S3KeyPrefix + user_id + '/' + job_id + filename + '.count.log'
-        try:
-            # upload result file
-            s3.upload_file(full_filename[:-3] + 'annot.vcf',
-                           ResultBucketName,
-                           result_object_name)
-            # upload log file
-            s3.upload_file(full_filename + '.count.log',
-                           ResultBucketName,
-                           log_object_name)
-        except ClientError as e:
-            print(f"Upload result/log file failed. {str(e)}")
+# Reference database queries slower than SlowQueryMilliseconds are logged;
+# the sidecar has the EXPLAIN output of the ExplainSlowestShapes query shapes
+# with the most total time
+stage_metrics.configure(config.getint('ann', 'SlowQueryMilliseconds', fallback=100),
+                        config.getint('ann', 'ExplainSlowestShapes', fallback=0))
 
-        # update job info to dynamo db
-        # reference:
-        # https://highlandsolutions.com/blog/hands-on-examples-for-working-with-dynamodb-boto3-and-python
-        complete_time = int(time.time())
-        try:
-            db = boto3.resource('dynamodb', region_name=AwsRegionName)
-            table = db.Table(TableName)
-            table.update_item(
-                Key={'job_id': job_id},
-                UpdateExpression='set s3_results_bucket=:var_s3_results_bucket,\
-                                    s3_key_result_file=:var_s3_key_result_file,\
-                                    s3_key_log_file=:var_s3_key_log_file,\
-                                    complete_time=:var_complete_time,\
-                                    job_status=:var_job_status',
-                ExpressionAttributeValues={
-                    ':var_s3_results_bucket': ResultBucketName,
-                    ':var_s3_key_result_file': result_object_name,
-                    ':var_s3_key_log_file': log_object_name,
-                    ':var_complete_time': complete_time,
-                    ':var_job_status': 'COMPLETED'
-                },
-                ReturnValues='UPDATED_NEW'
-            )
-        except ClientError as e:
-            print(f"Update finished job info to database failed. {str(e)}")
+# Up to DbPoolSize reference database connections are kept open between
+# the stages and jobs of a process
+utils.configure_db_pool(config.getint('ann', 'DbPoolSize', fallback=4))
 
-        # clean up load job files
-        shutil.rmtree(f'jobs/{user_id}/{job_id}')
 
-        # SNS: public notification to SNS (job_results) about job being done
-        # https://docs.aws.amazon.com/sns/latest/api/API_Publish.html
-        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sns.html#SNS.Client.publish
-        user_email = helpers.get_user_profile(user_id)[0][2]
+def annotate(full_filename, workers=1, progress=None, checkpoint=None, memory_profiler=None,
+             shard_checkpoints=None):
+    """Run the AnnTools pipeline, splitting the input into coordinate-range
+    shards annotated by parallel worker processes when workers > 1.
+    Progress events go to the progress callback, if any; with several workers
+    they count the shards done. A single worker resumes from and saves to
+    the stage checkpoint, if any, and reports to the memory profiler, if any.
+    With several workers, each shard resumes from and saves to a checkpoint
+    of its own, made by shard_checkpoints(shard_file, name) in its worker;
+    returns the (shard_file, name, stages saved) of those checkpoints, for
+    the caller to discard once the job is complete
+    """
+    if workers <= 1:
+        driver.run(full_filename, 'vcf', progress, checkpoint, memory_profiler)
+        return []
+
+    shard_files = vcf_shards.split_vcf(full_filename, workers)
+    # named by the shard count too, so a different split does not restore them
+    shards = [(shard_file, shard_checkpoints, f'shards-{len(shard_files)}/{shard_index}/')
+              for shard_index, shard_file in enumerate(shard_files)]
+    with Pool(len(shard_files)) as pool:
+        saved = []
+        for shards_done, shard_saved in enumerate(pool.imap_unordered(annotate_shard, shards), 1):
+            saved.append(shard_saved)
+            if progress:
+                progress({'stage': 'Shards',
+                          'stage_number': shards_done,
+                          'stage_count': len(shard_files),
+                          'percent_complete': int(shards_done * 100 / len(shard_files))})
+    vcf_shards.merge_results(shard_files, full_filename)
+    return [shard_saved for shard_saved in saved if shard_saved[2]]
+
+
+def annotate_shard(shard):
+    """Run the AnnTools pipeline on a shard, in a worker process; returns
+    the shard file, its checkpoint name and the stages the checkpoint saved"""
+    shard_file, shard_checkpoints, name = shard
+    shard_checkpoint = shard_checkpoints(shard_file, name=name) if shard_checkpoints else None
+    driver.run(shard_file, 'vcf', checkpoint=shard_checkpoint)
+    return shard_file, name, shard_checkpoint.stages_saved if shard_checkpoint else 0
+
+
+def progress_writer(job_ids):
+    """Throttled writer of progress events to the job items"""
+    db = boto3.resource('dynamodb', region_name=AwsRegionName)
+    return progress.ProgressWriter(db.Table(TableName), job_ids, ProgressIntervalSeconds)
+
+
+def run_job(full_filename, job_id, workers=1, shard=None, profile_memory=False,
+            profile_cpu=False):
+    """Annotate a downloaded input file. A whole job is completed right away;
+    a shard of a fanned-out job only uploads its results, and the last shard
+    to finish merges all of them into the parent job's results.
+    A memory or CPU profiled job runs in a single process, and uploads its
+    profiles with its results
+    """
+    memory_profiler, cpu_profiler = None, None
+    if profile_memory:
+        workers = 1
+        memory_profiler = memory_profile.MemoryProfiler(MemoryProfileTopSites,
+                                                        MemoryProfileFrames)
+    if profile_cpu:
+        workers = 1
+        cpu_profiler = cpu_profile.SamplingProfiler(ProfileSampleHz)
+    # shards have no job item of their own to report progress to
+    writer = progress_writer([job_id]) if shard is None else None
+    stage_checkpoint = job_checkpoint(full_filename, job_id) if workers <= 1 else None
+    try:
+        if memory_profiler:
+            memory_profiler.start()
+        if cpu_profiler:
+            cpu_profiler.start()
+        shard_checkpoints = annotate(full_filename, workers, writer, stage_checkpoint,
+                                     memory_profiler, partial(job_checkpoint, job_id=job_id))
+    finally:
+        if writer:
+            writer.close()
+        if cpu_profiler:
+            cpu_profiler.stop()
+            cpu_profiler.write(cpu_profile.report_file(full_filename))
+        if memory_profiler:
+            memory_profiler.stop()
+            memory_profiler.write(memory_profile.report_file(full_filename))
+    run_metrics = stage_metrics.read_sidecar(full_filename)
+
+    upload_start = time.time()
+    if shard is None:
+        complete_job(full_filename, job_id)
+    else:
+        complete_shard(full_filename, job_id, shard)
+    stage_metrics.spool(run_metrics, MetricsSpoolDir, upload_seconds=time.time() - upload_start)
+    if stage_checkpoint:
+        stage_checkpoint.clear()
+    for shard_file, name, stages_saved in shard_checkpoints:
+        job_checkpoint(shard_file, job_id, name).discard(stages_saved)
+
 
-        job_completion_notification = {
+def job_checkpoint(full_filename, job_id, name=''):
+    """Stage checkpoint of a job in the results bucket, restored when the
+    job's message is re-delivered after a crash; the shards of a job run
+    by several workers each have one, by name"""
+    user_id = full_filename.split('/')[1]
+    s3 = boto3.client('s3',
+                      region_name=AwsRegionName,
+                      config=Config(signature_version='s3v4')
+                      )
+    return checkpoint.S3Checkpoint(s3, ResultBucketName,
+                                   S3KeyPrefix + user_id + '/' + job_id + '/checkpoint/' + name,
+                                   full_filename, CheckpointIntervalSeconds)
+
+
+def run_batch(jobs):
+    """Annotate a micro-batch of small downloaded jobs, given as
+    (full_filename, job_id) pairs, in a single pipeline pass, then split
+    the batch results and complete every job as if it had run on its own
+    """
+    batch_path = f'jobs/batches/{jobs[0][1]}'
+    if not os.path.exists(batch_path):
+        os.makedirs(batch_path)
+    batch_file = f'{batch_path}/batch.vcf'
+    job_files = [full_filename for full_filename, job_id in jobs]
+
+    # every job of the batch shows the progress of the whole batch
+    writer = progress_writer([job_id for full_filename, job_id in jobs])
+    try:
+        batching.combine_inputs(job_files, batch_file)
+        annotate(batch_file, progress=writer)
+        batching.split_results(batch_file, job_files)
+    finally:
+        writer.close()
+    run_metrics = stage_metrics.read_sidecar(batch_file)
+    shutil.rmtree(batch_path)
+
+    # the users of the whole batch are looked up at once
+    profiles = helpers.get_user_profiles([full_filename.split('/')[1] for full_filename, job_id in jobs])
+
+    upload_start = time.time()
+    for full_filename, job_id in jobs:
+        profile = profiles.get(full_filename.split('/')[1])
+        complete_job(full_filename, job_id, user_email=profile[2] if profile else None)
+    stage_metrics.spool(run_metrics, MetricsSpoolDir, upload_seconds=time.time() - upload_start,
+                        batch_jobs=len(jobs))
+
+
+def result_index_key(full_filename):
+    """Key of an input's results in the result index: the SHA-256 of the
+    input's content and the version of the reference data it is annotated with
+    """
+    sha256 = hashlib.sha256()
+    with open(full_filename, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return f'{sha256.hexdigest()}:{ReferenceVersion}'
+
+
+def register_result(content_key, job_id, result_object_name, log_object_name):
+    """Record a job's results in the result index for reuse by later jobs
+    with the same input"""
+    if ResultIndexTableName is None:
+        return
+    try:
+        db = boto3.resource('dynamodb', region_name=AwsRegionName)
+        table = db.Table(ResultIndexTableName)
+        table.put_item(Item={
+            'content_key': content_key,
             'job_id': job_id,
-            'user_id': user_id,
-            'user_email': user_email,
             's3_results_bucket': ResultBucketName,
             's3_key_result_file': result_object_name,
-            's3_key_log_file': log_object_name,
-            'complete_time': complete_time
-        }
+            's3_key_log_file': log_object_name
+        })
+    except ClientError as e:
+        print(f"Register result in result index failed. {str(e)}")
+
+
+def reuse_result(full_filename, job_id):
+    """Complete a job right away with a server-side copy of the results of
+    an earlier job with the same input and reference data, if the result
+    index has one. Returns True if the job was completed
+    """
+    if ResultIndexTableName is None:
+        return False
+    user_id = full_filename.split('/')[1]
+    filename = full_filename.split('/')[3]
+
+    try:
+        content_key = result_index_key(full_filename)
+    except OSError as e:
+        print(f"Hash input file failed. {str(e)}")
+        return False
+
+    # reference:
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb.html#DynamoDB.Table.get_item
+    try:
+        db = boto3.resource('dynamodb', region_name=AwsRegionName)
+        table = db.Table(ResultIndexTableName)
+        indexed = table.get_item(Key={'content_key': content_key}).get('Item')
+    except ClientError as e:
+        print(f"Look up result index failed. {str(e)}")
+        return False
+    if indexed is None:
+        return False
+
+    # the earlier results may have been archived or deleted since, or be too
+    # big for a single copy; the job is then annotated as usual
+    # reference:
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#S3.Client.copy_object
+    result_object_name = S3KeyPrefix + user_id + '/' + job_id + filename[:-3] + 'annot.vcf'
+    log_object_name = S3KeyPrefix + user_id + '/' + job_id + filename + '.count.log'
+    s3 = boto3.client('s3',
+                      region_name=AwsRegionName,
+                      config=Config(signature_version='s3v4')
+                      )
+    try:
+        s3.copy_object(Bucket=ResultBucketName,
+                       Key=result_object_name,
+                       CopySource={'Bucket': indexed['s3_results_bucket'],
+                                   'Key': indexed['s3_key_result_file']})
+        s3.copy_object(Bucket=ResultBucketName,
+                       Key=log_object_name,
+                       CopySource={'Bucket': indexed['s3_results_bucket'],
+                                   'Key': indexed['s3_key_log_file']})
+    except ClientError as e:
+        print(f"Copy indexed result/log file failed. {str(e)}")
+        return False
+
+    finish_job(user_id, job_id, result_object_name, log_object_name)
+    return True
+
 
+def shard_key_prefix(user_id, parent_job_id):
+    """S3 key prefix (in the results bucket) of a fanned-out job's shards"""
+    return S3KeyPrefix + user_id + '/' + parent_job_id + '/shards/'
+
+
+def complete_job(full_filename, job_id, content_key=None, user_email=None):
+    """Upload the results, mark the job COMPLETED and notify the job results topic"""
+    # upload the results and log file to S3
+    # full_filename example:
+    # jobs/fake_user/jobid/jobid~test_zhicongm.vcf
+    user_id = full_filename.split('/')[1]
+    # job_id = full_filename.split('/')[2] + '/'
+    filename = full_filename.split('/')[3]
+
+    s3 = boto3.client('s3',
+                      region_name=AwsRegionName,
+                      config=Config(signature_version='s3v4')
+                      )
+
+    # reference:
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/guide/s3-uploading-files.html
+    result_object_name = S3KeyPrefix + user_id + '/' + job_id + filename[:-3] + 'annot.vcf'
+    log_object_name = S3KeyPrefix + user_id + '/' + job_id + filename + '.count.log'
+    try:
+        # upload result file
+        s3.upload_file(full_filename[:-3] + 'annot.vcf',
+                       ResultBucketName,
+                       result_object_name)
+        # upload log file
+        s3.upload_file(full_filename + '.count.log',
+                       ResultBucketName,
+                       log_object_name)
+    except ClientError as e:
+        print(f"Upload result/log file failed. {str(e)}")
+    else:
+        upload_report(s3, stage_metrics.sidecar_file(full_filename),
+                      S3KeyPrefix + user_id + '/' + job_id + filename + '.stages.json')
+        upload_report(s3, memory_profile.report_file(full_filename),
+                      S3KeyPrefix + user_id + '/' + job_id + filename + '.memory.json')
+        upload_report(s3, cpu_profile.report_file(full_filename),
+                      S3KeyPrefix + user_id + '/' + job_id + filename + '.profile.collapsed')
+        # merged fanned-out jobs no longer have their input, their shards
+        # carry its result index key
+        if ResultIndexTableName is not None and content_key is None \
+                and os.path.exists(full_filename):
+            content_key = result_index_key(full_filename)
+        if content_key is not None:
+            register_result(content_key, job_id, result_object_name, log_object_name)
+
+    finish_job(user_id, job_id, result_object_name, log_object_name, user_email)
+
+
+def upload_report(s3, report_file, object_name):
+    """Upload a report of a pipeline run, such as its stage metrics, if it
+    has one"""
+    if not os.path.exists(report_file):
+        return
+    try:
+        s3.upload_file(report_file,
+                       ResultBucketName,
+                       object_name)
+    except ClientError as e:
+        print(f"Upload report file {os.path.basename(report_file)} failed. {str(e)}")
+
+
+def finish_job(user_id, job_id, result_object_name, log_object_name, user_email=None):
+    """Mark the job COMPLETED with its result keys, clean up its local files
+    and notify the job results topic, looking the user's email up unless it
+    is given"""
+    # update job info to dynamo db
+    # reference:
+    # https://highlandsolutions.com/blog/hands-on-examples-for-working-with-dynamodb-boto3-and-python
+    complete_time = int(time.time())
+    try:
+        db = boto3.resource('dynamodb', region_name=AwsRegionName)
+        table = db.Table(TableName)
+        table.update_item(
+            Key={'job_id': job_id},
+            UpdateExpression='set s3_results_bucket=:var_s3_results_bucket,\
+                                s3_key_result_file=:var_s3_key_result_file,\
+                                s3_key_log_file=:var_s3_key_log_file,\
+                                complete_time=:var_complete_time,\
+                                job_status=:var_job_status',
+            ExpressionAttributeValues={
+                ':var_s3_results_bucket': ResultBucketName,
+                ':var_s3_key_result_file': result_object_name,
+                ':var_s3_key_log_file': log_object_name,
+                ':var_complete_time': complete_time,
+                ':var_job_status': 'COMPLETED'
+            },
+            ReturnValues='UPDATED_NEW'
+        )
+    except ClientError as e:
+        print(f"Update finished job info to database failed. {str(e)}")
+
+    # clean up load job files
+    shutil.rmtree(f'jobs/{user_id}/{job_id}')
+
+    # SNS: public notification to SNS (job_results) about job being done
+    # https://docs.aws.amazon.com/sns/latest/api/API_Publish.html
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sns.html#SNS.Client.publish
+    if user_email is None:
+        user_email = helpers.get_user_profile(user_id)[0][2]
+
+    job_completion_notification = {
+        'job_id': job_id,
+        'user_id': user_id,
+        'user_email': user_email,
+        's3_results_bucket': ResultBucketName,
+        's3_key_result_file': result_object_name,
+        's3_key_log_file': log_object_name,
+        'complete_time': complete_time
+    }
+
+    try:
+        sns = boto3.client('sns', region_name=AwsRegionName)
+        sns.publish(TopicArn=ResultsSNSArn,
+                    Message=json.dumps({'default': json.dumps(job_completion_notification)}),
+                    MessageStructure='json')
+    except ClientError as e:
+        print(f"Publish job completion notification message failed. {str(e)}")
+
+
+def complete_shard(full_filename, job_id, shard):
+    """Upload a shard's results and record it as done on the parent job;
+    merge the parent job if this was the last shard outstanding
+    """
+    user_id = full_filename.split('/')[1]
+    filename = full_filename.split('/')[3]
+    parent_job_id = shard['parent_job_id']
+    shard_object_name = shard_key_prefix(user_id, parent_job_id) + str(shard['shard_index'])
+
+    s3 = boto3.client('s3',
+                      region_name=AwsRegionName,
+                      config=Config(signature_version='s3v4')
+                      )
+    try:
+        s3.upload_file(vcf_shards.result_file(full_filename),
+                       ResultBucketName,
+                       shard_object_name + '.annot.vcf')
+        s3.upload_file(vcf_shards.log_file(full_filename),
+                       ResultBucketName,
+                       shard_object_name + '.count.log')
+    except ClientError as e:
+        print(f"Upload shard result/log file failed. {str(e)}")
+        return
+    upload_report(s3, stage_metrics.sidecar_file(full_filename),
+                  shard_object_name + '.stages.json')
+
+    shutil.rmtree(f'jobs/{user_id}/{job_id}')
+
+    # shards are recorded in a set, so a redelivered shard is not counted twice
+    # reference:
+    # https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/Expressions.UpdateExpressions.html#Expressions.UpdateExpressions.ADD
+    try:
+        db = boto3.resource('dynamodb', region_name=AwsRegionName)
+        table = db.Table(TableName)
+        db_response = table.update_item(
+            Key={'job_id': parent_job_id},
+            UpdateExpression='add shards_completed :shard',
+            ExpressionAttributeValues={':shard': {str(shard['shard_index'])}},
+            ReturnValues='UPDATED_NEW'
+        )
+    except ClientError as e:
+        print(f"Update shard completion to database failed. {str(e)}")
+        return
+
+    if len(db_response['Attributes']['shards_completed']) == shard['shard_count']:
+        parent_filename = parent_job_id + '~' + filename.split('~', 1)[1]
+        merge_shards(s3, user_id, parent_job_id, parent_filename, shard['shard_count'],
+                     shard.get('content_key'))
+
+
+def merge_shards(s3, user_id, parent_job_id, parent_filename, shard_count, content_key=None):
+    """Merge the shard results of a fanned-out job into a single result and
+    count log, then complete the parent job as if it had run in one piece
+    """
+    parent_path = f'jobs/{user_id}/{parent_job_id}'
+    key_prefix = shard_key_prefix(user_id, parent_job_id)
+
+    shard_files = []
+    try:
+        for i in range(shard_count):
+            shard_dir = f'{parent_path}/shards/{i}'
+            if not os.path.exists(shard_dir):
+                os.makedirs(shard_dir)
+            shard_file = f'{shard_dir}/{parent_filename}'
+            s3.download_file(ResultBucketName, f'{key_prefix}{i}.annot.vcf',
+                             vcf_shards.result_file(shard_file))
+            s3.download_file(ResultBucketName, f'{key_prefix}{i}.count.log',
+                             vcf_shards.log_file(shard_file))
+            shard_files.append(shard_file)
+    except ClientError as e:
+        print(f"Download shard result/log file failed. {str(e)}")
+        return
+
+    # the stage metrics are merged from the shards that have them
+    for i, shard_file in enumerate(shard_files):
         try:
-            sns = boto3.client('sns', region_name=AwsRegionName)
-            sns.publish(TopicArn=ResultsSNSArn,
-                        Message=json.dumps({'default': json.dumps(job_completion_notification)}),
-                        MessageStructure='json')
+            s3.download_file(ResultBucketName, f'{key_prefix}{i}.stages.json',
+                             stage_metrics.sidecar_file(shard_file))
         except ClientError as e:
-            print(f"Publish job completion notification message failed. {str(e)}")
+            print(f"Download shard stage metrics file failed. {str(e)}")
+
+    vcf_shards.merge_results(shard_files, f'{parent_path}/{parent_filename}')
+    complete_job(f'{parent_path}/{parent_filename}', parent_job_id, content_key)
+
+    # delete the shard inputs and results
+    # reference:
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#S3.Client.delete_objects
+    try:
+        paginator = s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=ResultBucketName, Prefix=key_prefix):
+            if page.get('Contents'):
+                s3.delete_objects(Bucket=ResultBucketName,
+                                  Delete={'Objects': [{'Key': obj['Key']} for obj in page['Contents']]})
+    except ClientError as e:
+        print(f"Delete shard files failed. {str(e)}")
+
 
+def parse_job_args(argv):
+    """Arguments of run_job from a run.py command line
+    command format: python run.py <filename> <job_id> [<workers>]
+                    [--parent-job-id <id> --shard-index <i> --shard-count <n>
+                     --content-key <key>] [--memory-profile] [--profile]
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('filename')
+    parser.add_argument('job_id')
+    parser.add_argument('workers', nargs='?', type=int, default=1)
+    parser.add_argument('--parent-job-id')
+    parser.add_argument('--shard-index', type=int)
+    parser.add_argument('--shard-count', type=int)
+    parser.add_argument('--content-key')
+    parser.add_argument('--memory-profile', action='store_true')
+    parser.add_argument('--profile', action='store_true')
+    args = parser.parse_args(argv)
+    shard = None
+    if args.parent_job_id:
+        shard = {'parent_job_id': args.parent_job_id,
+                 'shard_index': args.shard_index,
+                 'shard_count': args.shard_count,
+                 'content_key': args.content_key}
+    return args.filename, args.job_id, args.workers, shard, args.memory_profile, args.profile
+
+
+if __name__ == '__main__':
+    # Call the AnnTools pipeline
+    if len(sys.argv) > 2:
+        run_job(*parse_job_args(sys.argv[1:]))
     else:
         print("A valid .vcf file must be provided as input to this program.")
@@ -1,2 +1,3 @@
 . /home/ec2-user/mpcs-cc/bin/activate
-python /home/ec2-user/mpcs-cc/gas/ann/annotator.py
\ No newline at end of file
+# exec, so SIGTERM reaches the annotator and it drains
+exec python /home/ec2-user/mpcs-cc/gas/ann/annotator.py
\ No newline at end of file
@@ -0,0 +1,328 @@
+# stage_metrics.py
+#
+# Per-stage metrics of the AnnTools pipeline: wall and CPU time, records in
+# and out, reference database queries and rows, query latency histograms by
+# query shape with a slow query log, and bytes written. driver.run
+# writes them to a JSON sidecar next to the count log; finished runs are
+# spooled to a directory the annotator folds into its process-wide totals
+#
+##
+
+import bisect
+import json
+import os
+import re
+import threading
+import time
+import uuid
+
+COUNTERS = ['wall_seconds', 'cpu_seconds', 'records_in', 'records_out',
+            'queries', 'rows_fetched', 'bytes_written']
+
+# upper bounds, in seconds, of the query latency histogram buckets; the
+# last bucket counts the queries slower than all of them
+HISTOGRAM_BUCKETS = [0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0]
+
+# queries at least this slow are logged; EXPLAIN output is captured for
+# this many of the query shapes with the most total time, see configure
+slow_query_seconds = 0.1
+explain_slowest = 0
+
+# slow queries kept per stage, the slowest first
+MAX_SLOW_QUERIES = 20
+
+# the metrics of the stage running on each thread, for the cursors to count into
+_active = threading.local()
+
+
+def configure(slow_query_ms=None, explain_shapes=None):
+    """Set the slow query threshold and the number of shapes to EXPLAIN"""
+    global slow_query_seconds, explain_slowest
+    if slow_query_ms is not None:
+        slow_query_seconds = slow_query_ms / 1000.0
+    if explain_shapes is not None:
+        explain_slowest = explain_shapes
+
+
+def current():
+    """Metrics of the stage running on this thread, None outside of a stage"""
+    return getattr(_active, 'stage', None)
+
+
+_LITERALS = re.compile(r'"[^"]*"|\'[^\']*\'|\b\d+(?:\.\d+)?\b')
+_PLACEHOLDER_LISTS = re.compile(r'\?(?:\s*,\s*\?)+')
+_SPACES = re.compile(r'\s+')
+_TABLE = re.compile(r'\bfrom\s+(\w+)', re.IGNORECASE)
+
+
+def query_shape(query):
+    """The query with its literals replaced by ?, so queries that differ
+    only in their values have the same shape"""
+    shape = _PLACEHOLDER_LISTS.sub('?, ...', _LITERALS.sub('?', query))
+    return _SPACES.sub(' ', shape).strip()
+
+
+def new_shape(shape):
+    table = _TABLE.search(shape)
+    return {'table': table.group(1) if table else None,
+            'count': 0,
+            'total_seconds': 0.0,
+            'max_seconds': 0.0,
+            'buckets': [0] * (len(HISTOGRAM_BUCKETS) + 1),
+            'slowest_query': None}
+
+
+def record_query(stage, query, seconds):
+    """Add a query's latency to the histogram of its shape, and log it if slow"""
+    stage['queries'] += 1
+    shape = query_shape(query)
+    stats = stage['query_shapes'].get(shape)
+    if stats is None:
+        stats = stage['query_shapes'][shape] = new_shape(shape)
+    stats['count'] += 1
+    stats['total_seconds'] += seconds
+    stats['buckets'][bisect.bisect_left(HISTOGRAM_BUCKETS, seconds)] += 1
+    if seconds >= stats['max_seconds']:
+        stats['max_seconds'] = seconds
+        stats['slowest_query'] = query
+
+    if seconds >= slow_query_seconds:
+        print(f"Slow query in {stage['stage']} ({seconds * 1000:.1f} ms): {query}")
+        add_slow_queries(stage['slow_queries'], [{'seconds': seconds, 'query': query}])
+
+
+def add_slow_queries(slow_queries, more):
+    slow_queries.extend(more)
+    slow_queries.sort(key=lambda slow_query: -slow_query['seconds'])
+    del slow_queries[MAX_SLOW_QUERIES:]
+
+
+def merge_query_shapes(query_shapes, more):
+    """Add the query shape statistics of more to query_shapes"""
+    for shape, stats in more.items():
+        merged = query_shapes.get(shape)
+        if merged is None:
+            merged = query_shapes[shape] = new_shape(shape)
+        merged['count'] += stats['count']
+        merged['total_seconds'] += stats['total_seconds']
+        merged['buckets'] = [a + b for a, b in zip(merged['buckets'], stats['buckets'])]
+        if stats['max_seconds'] >= merged['max_seconds']:
+            merged['max_seconds'] = stats['max_seconds']
+            merged['slowest_query'] = stats['slowest_query']
+        if 'explain' in stats:
+            merged['explain'] = stats['explain']
+
+
+def new_metrics(name):
+    return dict({counter: 0 for counter in COUNTERS},
+                stage=name, query_shapes={}, slow_queries=[])
+
+
+def merge_metrics(metrics, more):
+    """Add the metrics of another run of the same stage"""
+    for counter in COUNTERS:
+        metrics[counter] += more[counter]
+    merge_query_shapes(metrics['query_shapes'], more.get('query_shapes', {}))
+    add_slow_queries(metrics['slow_queries'], more.get('slow_queries', []))
+
+
+class InstrumentedCursor(object):
+    """DB-API cursor wrapper recording queries, their latency by query shape
+    and fetched rows into the metrics of the stage running on the calling
+    thread"""
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, query, args=None):
+        stage = current()
+        if stage is None:
+            return self.cursor.execute(query) if args is None else self.cursor.execute(query, args)
+        start = time.perf_counter()
+        result = self.cursor.execute(query) if args is None else self.cursor.execute(query, args)
+        record_query(stage, query, time.perf_counter() - start)
+        return result
+
+    def fetchone(self):
+        row = self.cursor.fetchone()
+        stage = current()
+        if stage is not None and row is not None:
+            stage['rows_fetched'] += 1
+        return row
+
+    def fetchall(self):
+        rows = self.cursor.fetchall()
+        stage = current()
+        if stage is not None:
+            stage['rows_fetched'] += len(rows)
+        return rows
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+class InstrumentedConnection(object):
+    """DB-API connection wrapper whose cursors are InstrumentedCursors"""
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def cursor(self, *args, **kwargs):
+        return InstrumentedCursor(self.connection.cursor(*args, **kwargs))
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+
+def explain_slowest_shapes(stages, connect):
+    """
+    Attach the EXPLAIN output of the slowest query of each of the
+    explain_slowest shapes with the most total time. connect returns a
+    reference database connection.
+    """
+    shapes = [stats for stage in stages for stats in stage['query_shapes'].values()]
+    shapes.sort(key=lambda stats: -stats['total_seconds'])
+    if not explain_slowest or not shapes:
+        return
+
+    conn = connect()
+    try:
+        cursor = conn.cursor()
+        for stats in shapes[:explain_slowest]:
+            try:
+                cursor.execute('EXPLAIN ' + stats['slowest_query'].rstrip(' ;'))
+                stats['explain'] = [[str(value) for value in row] for row in cursor.fetchall()]
+            except Exception as e:
+                print(f"Explain query failed. {str(e)}")
+    finally:
+        conn.close()
+
+
+def file_size(path):
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+class StageMeter(object):
+    """
+    Measure one stage writing outfile and appending to log_file. Use as a
+    context manager around the stage call; the metrics dict is the context
+    value and is complete on exit. The stage counts its records into
+    records_in and records_out as it reads and writes them, see
+    annotate.trackProgress and annotate.RecordWriter.
+    """
+
+    def __init__(self, name, outfile, log_file):
+        self.outfile = outfile
+        self.log_file = log_file
+        self.metrics = new_metrics(name)
+
+    def __enter__(self):
+        self.previous = current()
+        _active.stage = self.metrics
+        self.log_size = file_size(self.log_file)
+        self.wall_start = time.perf_counter()
+        self.cpu_start = time.thread_time()
+        return self.metrics
+
+    def __exit__(self, *args):
+        self.metrics['wall_seconds'] = time.perf_counter() - self.wall_start
+        self.metrics['cpu_seconds'] = time.thread_time() - self.cpu_start
+        _active.stage = self.previous
+        self.metrics['bytes_written'] = file_size(self.outfile) + \
+            max(0, file_size(self.log_file) - self.log_size)
+
+
+def summary(stages):
+    """Sidecar content: the metrics of every stage and their totals"""
+    total = {counter: sum(stage[counter] for stage in stages)
+             for counter in COUNTERS if counter not in ('records_in', 'records_out')}
+    if stages:
+        total['records_in'] = stages[0]['records_in']
+        total['records_out'] = stages[-1]['records_out']
+    total['slow_queries'] = sum(len(stage['slow_queries']) for stage in stages)
+    return {'stages': stages, 'total': total}
+
+
+def sidecar_file(vcf):
+    """Name of the stage metrics sidecar driver.run writes for vcf"""
+    return vcf + '.stages.json'
+
+
+def write_sidecar(vcf, stages):
+    with open(sidecar_file(vcf), 'w') as fh:
+        json.dump(summary(stages), fh, indent=2)
+
+
+def read_sidecar(vcf):
+    """Stage metrics of the sidecar of vcf, or None if there is none"""
+    if not os.path.exists(sidecar_file(vcf)):
+        return None
+    with open(sidecar_file(vcf)) as fh:
+        return json.load(fh)
+
+
+def merge_sidecars(vcfs, vcf):
+    """
+    Sum the stage metrics of the pipeline runs of vcfs (the shards of vcf)
+    into the sidecar of vcf. Stages are matched by name, in the order of
+    the first run; wall time adds up as if the runs were sequential.
+    """
+    stages = {}
+    for sidecar in filter(None, (read_sidecar(f) for f in vcfs)):
+        for stage in sidecar['stages']:
+            merge_metrics(stages.setdefault(stage['stage'], new_metrics(stage['stage'])), stage)
+    if stages:
+        write_sidecar(vcf, list(stages.values()))
+
+
+def spool(sidecar, spool_dir, **timings):
+    """Hand the stage metrics of a finished run, read from its sidecar, and
+    timings of the job around it to the annotator's process-wide totals"""
+    if sidecar is None:
+        return
+    if not os.path.exists(spool_dir):
+        os.makedirs(spool_dir, exist_ok=True)
+    # written under a temporary name, so collect never reads a partial file
+    spool_file = os.path.join(spool_dir, str(uuid.uuid4()))
+    with open(spool_file + '.tmp', 'w') as fh:
+        json.dump({'stages': sidecar['stages'], 'timings': timings}, fh)
+    os.rename(spool_file + '.tmp', spool_file + '.json')
+
+
+# stage name -> counter totals, plus 'runs', of the runs collected so far
+_totals = {}
+_totals_lock = threading.Lock()
+
+
+def collect(spool_dir):
+    """Add the spooled runs to the process-wide totals and remove them;
+    returns the runs collected"""
+    runs = []
+    if not os.path.exists(spool_dir):
+        return runs
+    for name in os.listdir(spool_dir):
+        if not name.endswith('.json'):
+            continue
+        path = os.path.join(spool_dir, name)
+        try:
+            with open(path) as fh:
+                run = json.load(fh)
+            os.remove(path)
+        except (OSError, ValueError) as e:
+            print(f"Collect stage metrics failed. {str(e)}")
+            continue
+        runs.append(run)
+        with _totals_lock:
+            for stage in run['stages']:
+                total = _totals.setdefault(stage['stage'], dict(new_metrics(stage['stage']), runs=0))
+                total['runs'] += 1
+                merge_metrics(total, stage)
+    return runs
+
+
+def totals():
+    """Copy of the process-wide totals per stage name"""
+    with _totals_lock:
+        return json.loads(json.dumps(_totals))
+
+### EOF
@@ -12,40 +12,112 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 
 import os
-import json
+import sys
+import threading
 import pymysql
-import boto3
 from botocore.exceptions import ClientError
 
-"""Get connection to reference database
+import stage_metrics
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'util'))
+import secrets_provider
+
+"""Up to db_pool_size closed reference database connections are kept
+open for the next db_connect of this process
 """
-def db_connect():
+db_pool_size = 4
+
+_idle_connections = []
+_pool_lock = threading.Lock()
+
+
+"""Set the number of idle reference database connections kept open
+"""
+def configure_db_pool(size):
+    global db_pool_size
+    db_pool_size = size
+
+
+"""Get the reference database credentials from the shared secrets provider
+"""
+def db_secret():
     AWS_REGION_NAME = os.environ['AWS_REGION_NAME'] if \
         ('AWS_REGION_NAME' in  os.environ) else "us-east-1"
 
-    # Get RDS secret from AWS Secrets Manager
-    asm = boto3.client('secretsmanager', region_name=AWS_REGION_NAME)
+    # Get RDS secret from AWS Secrets Manager, cached
     try:
-        asm_response = asm.get_secret_value(SecretId='rds/anntools_database')
-        rds_secret = json.loads(asm_response['SecretString'])
+        return secrets_provider.get_secret('rds/anntools_database', AWS_REGION_NAME)
     except ClientError as e:
         print(f"Unable to retrieve RDS credentials from AWS Secrets Manager: {e}")
         raise e
 
-    # Extract database connection parameters
-    rds_host = rds_secret['host']
-    mysql_port = rds_secret['port']
-    username = rds_secret['username']
-    password = rds_secret['password']
-    database_name = 'annotator'
-
-    # Return a connection to the database
-    return pymysql.connect(
-        host=rds_host,
-        port=mysql_port,
-        user=username,
-        passwd=password,
-        db=database_name)
+
+"""Connection whose close() returns it to the idle connections of the pool
+"""
+class PooledConnection(object):
+    def __init__(self, connection):
+        self.connection = connection
+
+    def close(self):
+        if self.connection is None:
+            return
+        connection, self.connection = self.connection, None
+        try:
+            # end the read transaction, so the next user sees fresh data
+            connection.rollback()
+        except pymysql.Error:
+            connection.close()
+            return
+        with _pool_lock:
+            if len(_idle_connections) < db_pool_size:
+                _idle_connections.append(connection)
+                return
+        connection.close()
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+
+"""Forget the idle connections of the parent in a forked worker: their
+sockets are shared with the parent
+"""
+def _forget_idle_connections():
+    global _pool_lock
+    _pool_lock = threading.Lock()
+    del _idle_connections[:]
+
+os.register_at_fork(after_in_child=_forget_idle_connections)
+
+
+"""Get connection to reference database
+"""
+def db_connect():
+    connection = None
+    with _pool_lock:
+        if _idle_connections:
+            connection = _idle_connections.pop()
+    if connection is not None:
+        # reconnect if the server closed the idle connection
+        connection.ping(reconnect=True)
+    else:
+        rds_secret = db_secret()
+
+        # Extract database connection parameters
+        rds_host = rds_secret['host']
+        mysql_port = rds_secret['port']
+        username = rds_secret['username']
+        password = rds_secret['password']
+        database_name = 'annotator'
+
+        connection = pymysql.connect(
+            host=rds_host,
+            port=mysql_port,
+            user=username,
+            passwd=password,
+            db=database_name)
+
+    # Return a connection to the database, recording queries and rows
+    # into the metrics of the calling stage
+    return stage_metrics.InstrumentedConnection(PooledConnection(connection))
 
 
 """Column inices for pileup and VCF
@@ -0,0 +1,148 @@
+# vcf_shards.py
+#
+# Split a VCF into coordinate-range shards that can be annotated
+# independently, and merge the annotated shards back into a single
+# result file and count log
+#
+##
+
+import os
+import shutil
+
+import stage_metrics
+
+
+def result_file(vcf):
+    """Name of the annotated file driver.run writes for vcf"""
+    return vcf[:-3] + 'annot.vcf'
+
+
+def log_file(vcf):
+    """Name of the count log driver.run writes for vcf"""
+    return vcf + '.count.log'
+
+
+def split_vcf(vcf, shard_count, shard_root=None):
+    """
+    Split the records of vcf into at most shard_count contiguous coordinate
+    ranges. Each shard repeats the input's header lines and keeps the input's
+    file name in its own sub-directory of shard_root, so driver.run names its
+    outputs for a shard the same way it would for the input.
+    Returns the shard file paths in coordinate order.
+    """
+    shard_root = shard_root or os.path.join(os.path.dirname(vcf), 'shards')
+
+    header = []
+    record_count = 0
+    with open(vcf) as fh:
+        for line in fh:
+            if line.startswith('#'):
+                header.append(line)
+            elif line.strip():
+                record_count += 1
+
+    shard_count = max(1, min(shard_count, record_count))
+    shard_size = -(-record_count // shard_count)  # ceiling division
+
+    shard_files = []
+    fh_out = None
+    written = shard_size
+    with open(vcf) as fh:
+        for line in fh:
+            if line.startswith('#') or not line.strip():
+                continue
+            if written == shard_size:
+                if fh_out:
+                    fh_out.close()
+                shard_dir = os.path.join(shard_root, str(len(shard_files)))
+                if not os.path.exists(shard_dir):
+                    os.makedirs(shard_dir)
+                shard_files.append(os.path.join(shard_dir, os.path.basename(vcf)))
+                fh_out = open(shard_files[-1], 'w')
+                fh_out.writelines(header)
+                written = 0
+            fh_out.write(line)
+            written += 1
+
+    if fh_out:
+        fh_out.close()
+    else:
+        # no records: a single header-only shard
+        shard_dir = os.path.join(shard_root, '0')
+        if not os.path.exists(shard_dir):
+            os.makedirs(shard_dir)
+        shard_files.append(os.path.join(shard_dir, os.path.basename(vcf)))
+        with open(shard_files[-1], 'w') as fh_out:
+            fh_out.writelines(header)
+
+    return shard_files
+
+
+def merge_annotated(shard_results, outfile):
+    """Concatenate annotated shards, keeping the header of the first only"""
+    with open(outfile, 'w') as fh_out:
+        for i, shard_result in enumerate(shard_results):
+            with open(shard_result) as fh:
+                for line in fh:
+                    if i > 0 and line.startswith('#'):
+                        continue
+                    fh_out.write(line)
+
+
+def merge_count_logs(shard_logs, outfile):
+    """
+    Sum the counters of the shards' count logs. Every shard runs the same
+    stages, so the logs have the same lines in the same order and only the
+    numbers differ.
+    """
+    logs = []
+    for shard_log in shard_logs:
+        with open(shard_log) as fh:
+            logs.append(fh.read().splitlines())
+
+    merged = [combine_log_line(lines, sum) for lines in zip(*logs)]
+    with open(outfile, 'w') as fh_out:
+        fh_out.write('\n'.join(fix_dbsnp_ratio(merged)) + '\n')
+
+
+def combine_log_line(lines, combine):
+    """Combine the integer tokens of aligned count log lines"""
+    if lines[0].startswith('Total: '):
+        # getSnpsFromDbSnp starts its record counter at 1, so every log
+        # counts one more record than it has
+        total = combine([int(line.split()[1]) - 1 for line in lines]) + 1
+        return f"Total: {total}"
+
+    combined = []
+    for tokens in zip(*[line.split(' ') for line in lines]):
+        if all(token.isdigit() for token in tokens):
+            combined.append(str(combine([int(token) for token in tokens])))
+        else:
+            combined.append(tokens[0])
+    return ' '.join(combined)
+
+
+def fix_dbsnp_ratio(log_lines):
+    """Recompute the dbSNP percentage from the combined counters"""
+    total = None
+    fixed = []
+    for line in log_lines:
+        if line.startswith('Total: '):
+            total = int(line.split()[1])
+        elif line.startswith('In dbSNP: ') and total:
+            var_count = int(line.split()[2])
+            ratioInDbSnp = (var_count / float(total)) * 100
+            line = f"In dbSNP: {str(var_count)} ({str(ratioInDbSnp)}%)"
+        fixed.append(line)
+    return fixed
+
+
+def merge_results(shard_files, vcf):
+    """Merge the annotated shards of vcf into its result file, count log and
+    stage metrics"""
+    merge_annotated([result_file(f) for f in shard_files], result_file(vcf))
+    merge_count_logs([log_file(f) for f in shard_files], log_file(vcf))
+    stage_metrics.merge_sidecars(shard_files, vcf)
+    shutil.rmtree(os.path.dirname(os.path.dirname(shard_files[0])))
+
+### EOF
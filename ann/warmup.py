@@ -0,0 +1,81 @@
+# warmup.py
+#
+# Cold start of an annotator: fetch the reference database credentials,
+# then touch every reference table from parallel connections, which are
+# left open in the connection pool for the first jobs. The tables are warm
+# for every process, but the pooled connections only for the jobs that run
+# in the annotator process (small jobs and shards on its threads); run.py
+# subprocesses open connections of their own
+#
+##
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pymysql
+from botocore.exceptions import ClientError
+
+import driver
+import utils
+
+# tables the stages query besides their 'table' option; tfbsConsSites is
+# split into a table per chromosome
+CHROMOSOMES = [str(n) for n in range(1, 23)] + ['X', 'Y']
+SPLIT_TABLES = ['tfbsConsSites']
+STAGE_TABLES = ['dbSNP', 'chrom_pos_equal_base', 'chrom_pos_equal_nobase',
+                'chrom_pos_unequal', 'cpgIslandExt'] + \
+               [f'tfbsConsSites{chrom}' for chrom in CHROMOSOMES]
+
+
+def reference_tables():
+    tables = list(STAGE_TABLES)
+    for name, stage, options in driver.STAGES:
+        table = options.get('table')
+        if table is not None and table not in SPLIT_TABLES and table not in tables:
+            tables.append(table)
+    return tables
+
+
+def warm_table(table):
+    """Open the table and read from it, so the database has it open and
+    cached; the connection goes back to the pool"""
+    conn = utils.db_connect()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(f'select * from {table} limit 1')
+        cursor.fetchall()
+    finally:
+        conn.close()
+
+
+def warm_up(threads=4):
+    """
+    1. Fetch the reference database credentials once, for every connection
+    2. Read from every reference table on up to threads connections at once,
+       no more than the connection pool keeps, so none is opened in vain
+    Returns the seconds each step took and the tables that failed
+    """
+    start = time.time()
+    report = {'failed_tables': []}
+    try:
+        utils.db_secret()
+    except ClientError:
+        report['failed_tables'] = reference_tables()
+        report['seconds'] = time.time() - start
+        return report
+    report['secret_seconds'] = time.time() - start
+
+    tables = reference_tables()
+    with ThreadPoolExecutor(max_workers=max(1, min(threads, utils.db_pool_size))) as executor:
+        futures = {table: executor.submit(warm_table, table) for table in tables}
+    for table, future in futures.items():
+        try:
+            future.result()
+        except (pymysql.Error, OSError) as e:
+            print(f"Warm up table {table} failed. {str(e)}")
+            report['failed_tables'].append(table)
+    report['tables_seconds'] = time.time() - start - report['secret_seconds']
+    report['seconds'] = time.time() - start
+    return report
+
+### EOF
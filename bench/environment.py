@@ -0,0 +1,212 @@
+# environment.py
+#
+# Run the GAS annotator, run.py and driver.run in-process against the
+# stand-ins of standins.py: installs stand-in boto3, botocore, pymysql and
+# psycopg2 modules, writes the annotator configuration into a working
+# directory and seeds the reference and accounts databases
+#
+##
+
+import glob
+import os
+import sqlite3
+import sys
+import threading
+import types
+
+import reference_db
+import standins
+
+RepoRoot = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SampleVcfFiles = sorted(glob.glob(os.path.join(RepoRoot, 'ann', 'data', '*.vcf')))
+
+AnnConfig = """[aws]
+AwsRegionName = us-east-1
+TableName = annotations
+RequestsSQSURL = https://sqs.local/requests
+RequestsSNSArn = arn:requests
+S3ResultsBucket = results
+S3KeyPrefix = prefix/
+ResultsSNSArn = arn:results
+ResultIndexTableName = result_index
+
+[ann]
+"""
+
+UtilConfig = """[aws]
+AwsRegionName = us-east-1
+
+[gas]
+AccountsDatabase = accounts
+EmailDefaultSender = gas@example.com
+"""
+
+# [ann] options of every benchmark run, unless overridden by ann_settings;
+# the autoscaling signal goes to backlog_metrics.jsonl in place of CloudWatch
+AnnSettings = {'BacklogMetricSink': 'local'}
+
+BenchUserId = 'bench-user'
+
+
+class Environment(object):
+    """The stand-in services of one benchmark run"""
+
+    def __init__(self, workdir):
+        self.workdir = workdir
+        self.store = standins.ObjectStore(os.path.join(workdir, 's3'))
+        self.messaging = standins.Messaging()
+        self.tables = {'annotations': standins.Table('annotations'),
+                       'result_index': standins.Table('result_index', key='content_key')}
+        self.reference_db = os.path.join(workdir, 'reference.sqlite')
+        self.accounts_db = os.path.join(workdir, 'accounts.sqlite')
+        self.secrets = standins.SecretsManager({
+            'rds/anntools_database': {'host': 'reference', 'port': 3306,
+                                      'username': 'bench', 'password': 'bench'},
+            'rds/accounts_database': {'host': 'accounts', 'port': 5432,
+                                      'username': 'bench', 'password': 'bench'}})
+        self.messaging.subscribe('arn:requests', 'requests')
+        self.messaging.subscribe('arn:results', 'results')
+
+    def table(self, name):
+        if name not in self.tables:
+            self.tables[name] = standins.Table(name)
+        return self.tables[name]
+
+    def client(self, service_name, **kwargs):
+        if service_name == 's3':
+            return self.store
+        if service_name in ('sqs', 'sns'):
+            return self.messaging
+        if service_name == 'secretsmanager':
+            return self.secrets
+        raise ValueError(f'No stand-in for {service_name}')
+
+    def resource(self, service_name, **kwargs):
+        if service_name != 'dynamodb':
+            raise ValueError(f'No stand-in for {service_name}')
+        return types.SimpleNamespace(Table=self.table)
+
+
+def install_modules(env):
+    """Make boto3, botocore, pymysql and psycopg2 resolve to the stand-ins"""
+    boto3 = types.ModuleType('boto3')
+    boto3.client = env.client
+    boto3.resource = env.resource
+    dynamodb = types.ModuleType('boto3.dynamodb')
+    conditions = types.ModuleType('boto3.dynamodb.conditions')
+    conditions.Key = standins.KeyCondition
+    conditions.Attr = standins.KeyCondition
+    dynamodb.conditions = conditions
+    boto3.dynamodb = dynamodb
+
+    botocore = types.ModuleType('botocore')
+    exceptions = types.ModuleType('botocore.exceptions')
+    exceptions.BotoCoreError = standins.BotoCoreError
+    exceptions.ClientError = standins.ClientError
+    config = types.ModuleType('botocore.config')
+    config.Config = standins.Config
+    botocore.exceptions = exceptions
+    botocore.config = config
+
+    # every reference database connection is to the SQLite stand-in
+    pymysql = types.ModuleType('pymysql')
+    pymysql.connect = lambda **kwargs: sqlite3.connect(env.reference_db, check_same_thread=False,
+                                                       factory=standins.MySQLConnection)
+    pymysql.Error = sqlite3.Error
+
+    psycopg2 = types.ModuleType('psycopg2')
+    psycopg2.connect = lambda *args, **kwargs: standins.PostgresConnection(env.accounts_db)
+    psycopg2.Error = sqlite3.Error
+    extras = types.ModuleType('psycopg2.extras')
+    extras.DictCursor = None
+    psycopg2.extras = extras
+    pool = types.ModuleType('psycopg2.pool')
+    pool.ThreadedConnectionPool = lambda minconn, maxconn, *args, **kwargs: \
+        standins.PostgresPool(lambda: standins.PostgresConnection(env.accounts_db), maxconn)
+    psycopg2.pool = pool
+
+    sys.modules.update({'boto3': boto3,
+                        'boto3.dynamodb': dynamodb,
+                        'boto3.dynamodb.conditions': conditions,
+                        'botocore': botocore,
+                        'botocore.exceptions': exceptions,
+                        'botocore.config': config,
+                        'pymysql': pymysql,
+                        'psycopg2': psycopg2,
+                        'psycopg2.extras': extras,
+                        'psycopg2.pool': pool})
+
+
+def seed_accounts(path, user_id, role='premium_user'):
+    """Accounts database with a single user profile"""
+    connection = sqlite3.connect(path)
+    connection.execute('create table if not exists profiles '
+                       '(identity_id, name, email, institution, role, created, updated)')
+    connection.execute('insert into profiles values (?, ?, ?, ?, ?, ?, ?)',
+                       (user_id, 'Bench User', 'bench@example.com', 'UChicago', role, 0, 0))
+    connection.commit()
+    connection.close()
+
+
+def install(workdir, ann_settings=None, vcf_files=None):
+    """
+    Set up a fresh working directory with the stand-ins and import the
+    annotator modules against them. ann_settings are extra [ann] options of
+    ann_config.ini. Returns the Environment; the annotator, run and driver
+    modules are its attributes.
+    Must be called once per process, before anything imports boto3.
+    """
+    os.makedirs(workdir)
+    env = Environment(workdir)
+    install_modules(env)
+    reference_db.seed(env.reference_db, vcf_files or SampleVcfFiles)
+    seed_accounts(env.accounts_db, BenchUserId)
+
+    with open(os.path.join(workdir, 'ann_config.ini'), 'w') as fh:
+        fh.write(AnnConfig)
+        for option, value in dict(AnnSettings, **(ann_settings or {})).items():
+            fh.write(f'{option} = {value}\n')
+
+    # the annotator reads its configuration from and keeps its jobs under
+    # the working directory
+    os.chdir(workdir)
+    sys.path.insert(0, os.path.join(RepoRoot, 'util'))
+    sys.path.insert(0, os.path.join(RepoRoot, 'ann'))
+    import helpers
+    helpers.config.read_string(UtilConfig)
+    import annotator
+    import driver
+    import run
+
+    # run.py subprocesses run on threads, to share the stand-ins
+    annotator.subprocess = types.SimpleNamespace(
+        Popen=lambda command, *args, **kwargs: ThreadProcess(run.run_job, run.parse_job_args(command[2:])))
+
+    env.annotator, env.driver, env.run = annotator, driver, run
+    return env
+
+
+class ThreadProcess(object):
+    """subprocess.Popen stand-in running a function on a thread"""
+
+    def __init__(self, target, args):
+        self.returncode = None
+        self.thread = threading.Thread(target=self._run, args=(target, args), daemon=True)
+        self.thread.start()
+
+    def _run(self, target, args):
+        try:
+            target(*args)
+            self.returncode = 0
+        except Exception as e:
+            print(f"Annotation thread failed. {str(e)}")
+            self.returncode = 1
+
+    def poll(self):
+        return self.returncode
+
+    def terminate(self):
+        # threads cannot be stopped; it runs on until the benchmark exits
+        pass
+
+### EOF
@@ -0,0 +1,136 @@
+# reference_db.py
+#
+# Seed a SQLite stand-in for the AnnTools reference database with synthetic
+# annotations around the variants of a set of VCF files
+#
+##
+
+import random
+import sqlite3
+
+CHROMOSOMES = [str(i) for i in range(1, 23)] + ['X', 'Y']
+
+REFSEQ_COLUMNS = ['id', 'CHR', 'start', 'end', 'haplotypeReference',
+                  'haplotypeAlternate', 'name', 'name2', 'transcriptStrand',
+                  'positionType', 'frame', 'mrnaCoord', 'codonCoord', 'spliceDist',
+                  'referenceCodon', 'referenceAA', 'variantCodon', 'variantAA',
+                  'changesAA', 'functionalClass', 'codingCoordStr', 'proteinCoordStr',
+                  'inCodingRegion', 'spliceInfo', 'uorfChange']
+
+TABLES = {
+    'dbSNP': ['bin', 'CHR', 'POS', 'ID', 'REF', 'ALT', 'INFO', 'MAF'],
+    'chrom_pos_equal_base': REFSEQ_COLUMNS,
+    'chrom_pos_equal_nobase': REFSEQ_COLUMNS,
+    'chrom_pos_unequal': REFSEQ_COLUMNS,
+    'refGene': ['bin', 'name', 'chrom', 'strand', 'txStart', 'txEnd', 'cdsStart',
+                'cdsEnd', 'exonCount', 'exonStarts', 'exonEnds', 'score', 'name2',
+                'cdsStartStat', 'cdsEndStat', 'exonFrames'],
+    'cpgIslandExt': ['bin', 'chrom', 'chromStart', 'chromEnd', 'name'],
+    'cytoBand': ['chrom', 'chromStart', 'chromEnd', 'name', 'gieStain'],
+    'gadAll': ['id', 'association', 'broadPhen', 'geneSymbol', 'chromosome',
+               'chromStart', 'chromEnd'],
+    'gwasCatalog': ['bin', 'chrom', 'chromStart', 'chromEnd', 'name', 'pubMedID',
+                    'author', 'pubDate', 'journal', 'title', 'trait'],
+    'hugo': ['id', 'chrom', 'chromStart', 'chromEnd', 'hgncId', 'symbol', 'name'],
+    'dgv_Cnv': ['bin', 'chrom', 'chromStart', 'chromEnd', 'name'],
+    'abParts_IG_T_CelReceptors': ['bin', 'chrom', 'chromStart', 'chromEnd', 'name'],
+    'mcCarroll_Cnv': ['bin', 'chrom', 'chromStart', 'chromEnd', 'name'],
+    'conrad_Cnv': ['bin', 'chrom', 'chromStart', 'chromEnd', 'name'],
+    'genomicSuperDups': ['bin', 'chrom', 'chromStart', 'chromEnd', 'name', 'score',
+                         'strand', 'otherChrom', 'otherStart', 'otherEnd'],
+    'targetScanS': ['bin', 'chrom', 'chromStart', 'chromEnd', 'name', 'score', 'strand'],
+}
+TABLES.update({f'tfbsConsSites{chrom}': ['chrom', 'chromStart', 'chromEnd', 'name']
+               for chrom in CHROMOSOMES})
+
+# the columns the annotation stages look rows up by
+INDEXES = {
+    'dbSNP': ['CHR', 'POS'],
+    'chrom_pos_equal_base': ['CHR', 'start'],
+    'chrom_pos_equal_nobase': ['CHR', 'start'],
+    'chrom_pos_unequal': ['CHR', 'start'],
+    'refGene': ['chrom', 'txStart'],
+    'cpgIslandExt': ['chrom', 'chromStart'],
+    'cytoBand': ['chrom', 'chromStart'],
+    'gadAll': ['chromosome', 'chromStart'],
+    'gwasCatalog': ['chrom', 'chromStart'],
+    'hugo': ['chrom', 'chromStart'],
+    'genomicSuperDups': ['chrom', 'chromStart'],
+    'targetScanS': ['chrom', 'chromStart'],
+}
+INDEXES.update({name: ['chrom', 'chromStart'] for name in
+                ['dgv_Cnv', 'abParts_IG_T_CelReceptors', 'mcCarroll_Cnv', 'conrad_Cnv']})
+INDEXES.update({f'tfbsConsSites{chrom}': ['chromStart'] for chrom in CHROMOSOMES})
+
+
+def vcf_records(vcf_files):
+    """(chrom, pos, id, ref, alt) of every record of the files"""
+    for vcf_file in vcf_files:
+        with open(vcf_file) as fh:
+            for line in fh:
+                if line.startswith('#') or not line.strip():
+                    continue
+                fields = line.split('\t')
+                yield (fields[0].replace('chr', ''), int(fields[1]), fields[2],
+                       fields[3], fields[4])
+
+
+def seed(path, vcf_files, feature_rate=0.02, random_seed=7):
+    """
+    Create the reference tables at path and fill them from the records of
+    vcf_files: every record with an rs ID is in dbSNP, some records have
+    RefSeq annotations, and about feature_rate of them are near a gene,
+    cytoband, CNV, miRNA, TFBS, GAD and GWAS feature.
+    """
+    rnd = random.Random(random_seed)
+    connection = sqlite3.connect(path)
+    for table, columns in TABLES.items():
+        connection.execute(f'create table if not exists {table} ({", ".join(columns)})')
+
+    def insert(table, row):
+        connection.execute(f'insert into {table} values ({",".join("?" * len(row))})', row)
+
+    for n, (chrom, pos, rsid, ref, alt) in enumerate(vcf_records(vcf_files)):
+        if rsid.startswith('rs'):
+            insert('dbSNP', (0, chrom, pos, rsid, ref, alt, 'SNV',
+                             rnd.choice(['.', '0.01', '0.2'])))
+
+        refseq = rnd.random()
+        if refseq < 0.1:
+            insert('chrom_pos_equal_base', (n, chrom, pos, pos, ref, alt, f'NM_{n}', f'G{n}',
+                                            '+', 'CDS', 0, 12, 4, 0, 'AAA', 'K', 'AAG', 'K',
+                                            'N', 'synonymous', 'c.1', 'p.1', 1, '', 0))
+        elif refseq < 0.2:
+            insert('chrom_pos_unequal', (n, chrom, pos - 5, pos + 5, ref, alt, f'NM_{n}', f'G{n}',
+                                         '-', 'intron', 0, 0, 0, 0, '', '', '', '', '', '',
+                                         '', '', 0, '', 0))
+
+        if rnd.random() < feature_rate:
+            ucsc_chrom = 'chr' + chrom
+            tx_start = pos - 1000
+            insert('refGene', (0, f'NM_{n}', ucsc_chrom, rnd.choice('+-'), tx_start, pos + 1000,
+                               tx_start + 100, pos + 900, 2, f'{tx_start},{pos - 10},'.encode(),
+                               f'{tx_start + 50},{pos + 10},'.encode(), 0, f'GENE{n}',
+                               'cmpl', 'cmpl', ''))
+            insert('cpgIslandExt', (0, ucsc_chrom, tx_start - 600, tx_start - 400, f'CpG: {n}'))
+            insert('cytoBand', (ucsc_chrom, pos - 5000, pos + 5000, f'p{n}', 'gneg'))
+            insert('hugo', (n, ucsc_chrom, pos - 50, pos + 50, f'HGNC:{n}', f'SYM{n}', f'name {n}'))
+            insert('dgv_Cnv', (0, ucsc_chrom, pos - 100, pos + 100, f'cnv{n}'))
+            insert('genomicSuperDups', (0, ucsc_chrom, pos - 100, pos + 100, 'x', 0, '+',
+                                        'chr2', 1, 2))
+            insert('targetScanS', (0, ucsc_chrom, pos - 3, pos + 3, f'mir{n}', 0, '+'))
+            if chrom in CHROMOSOMES:
+                insert(f'tfbsConsSites{chrom}', (ucsc_chrom, pos - 3, pos + 3, f'tf{n}'))
+
+        if rnd.random() < feature_rate:
+            insert('gadAll', (n, 'Y', 'p', f'GS{n}', chrom, pos - 10, pos + 10))
+            insert('gwasCatalog', (0, 'chr' + chrom, pos - 1, pos, f'rs{n}', 1000 + n,
+                                   'a', 'd', 'j', 't', f'trait {n}'))
+
+    for table, columns in INDEXES.items():
+        connection.execute(f'create index if not exists {table}_lookup '
+                           f'on {table} ({", ".join(columns)})')
+    connection.commit()
+    connection.close()
+
+### EOF
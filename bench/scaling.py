@@ -0,0 +1,164 @@
+# scaling.py
+#
+# Scaling benchmark of the AnnTools pipeline: generates synthetic VCFs of
+# several sizes, then runs every annotate.py stage and the whole driver.run
+# on each against the SQLite reference database, recording throughput and
+# peak RSS. Results are written as JSON so runs of different commits can be
+# compared with --compare.
+#
+# usage: python scaling.py [--sizes 1000,10000,...,10000000] [--output <file>]
+#                          [--compare <earlier output>] [--workdir <dir>]
+#
+##
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import environment
+import synthetic_vcf
+
+# the peak RSS measurement of the AnnTools memory profiler
+sys.path.insert(0, os.path.join(environment.RepoRoot, 'ann'))
+from memory_profile import reset_peak_rss, rss_kb
+
+# up to the 10M variants of a whole genome; that run takes hours, pass
+# smaller --sizes for a quick comparison
+DefaultSizes = '1000,10000,100000,1000000,10000000'
+
+
+def measure(target, args):
+    """
+    Run target(*args) in a forked child, so its peak RSS is its own;
+    returns (seconds, peak RSS in kB)
+    """
+    def child(connection):
+        sys.stdout = open(os.devnull, 'w')
+        reset_peak_rss()
+        start = time.perf_counter()
+        target(*args)
+        connection.send((time.perf_counter() - start, rss_kb()[1]))
+        connection.close()
+
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.get_context('fork').Process(target=child, args=(sender,))
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        result = None
+    process.join()
+    if result is None:
+        raise RuntimeError(f'Benchmark child failed with exit code {process.exitcode}')
+    return result
+
+
+def run_stage(stage, options, infile, stage_index):
+    stage(vcf=infile, format='vcf',
+          tmpextin='.' + str(stage_index) if stage_index else '',
+          tmpextout='.' + str(stage_index + 1), **options)
+
+
+def benchmark_size(driver, vcf_file, variant_count, directory):
+    """Results of every stage and of driver.run on one input"""
+    results = []
+
+    def record(name, seconds, rss):
+        results.append({'variants': variant_count,
+                        'stage': name,
+                        'seconds': seconds,
+                        'variants_per_second': variant_count / seconds if seconds else 0.0,
+                        'peak_rss_kb': rss})
+        print(f"{variant_count:>10} {name:<32} {seconds:9.3f}s "
+              f"{results[-1]['variants_per_second']:12.0f}/s {rss / 1024:8.1f} MB")
+
+    # every stage reads the output of the one before it
+    infile = os.path.join(directory, 'stages.vcf')
+    shutil.copy(vcf_file, infile)
+    for stage_index, (name, stage, options) in enumerate(driver.STAGES):
+        record(name, *measure(run_stage, (stage, options, infile, stage_index)))
+
+    infile = os.path.join(directory, 'pipeline.vcf')
+    shutil.copy(vcf_file, infile)
+    record('driver.run', *measure(driver.run, (infile, 'vcf')))
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=environment.RepoRoot,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark(sizes, workdir=None, random_seed=7):
+    """Generate the inputs, seed the reference database from them and run"""
+    root = workdir or tempfile.mkdtemp(prefix='gas-scaling-')
+    inputs = os.path.join(root, 'inputs')
+    os.makedirs(inputs)
+    profile = synthetic_vcf.learn_profile()
+    vcf_files = {size: synthetic_vcf.generate(os.path.join(inputs, f'synthetic_{size}.vcf'),
+                                              size, profile, random_seed)
+                 for size in sizes}
+
+    env = environment.install(os.path.join(root, 'work'), vcf_files=list(vcf_files.values()))
+    results = []
+    for size in sizes:
+        directory = os.path.join(root, 'work', f'size_{size}')
+        os.makedirs(directory)
+        results += benchmark_size(env.driver, vcf_files[size], size, directory)
+
+    return {'commit': git_commit(),
+            'created': int(time.time()),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'random_seed': random_seed,
+            'profile': profile,
+            'results': results}
+
+
+def compare(report, baseline):
+    """Print the throughput of report relative to an earlier baseline report"""
+    earlier = {(result['variants'], result['stage']): result for result in baseline['results']}
+    print(f"Compared with {baseline.get('commit')}:")
+    for result in report['results']:
+        before = earlier.get((result['variants'], result['stage']))
+        if not before or not before['variants_per_second']:
+            continue
+        speedup = result['variants_per_second'] / before['variants_per_second']
+        print(f"{result['variants']:>10} {result['stage']:<32} {speedup:6.2f}x throughput "
+              f"{result['peak_rss_kb'] - before['peak_rss_kb']:+9d} kB peak RSS")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='AnnTools pipeline scaling benchmark')
+    parser.add_argument('--sizes', default=DefaultSizes,
+                        help='comma separated variant counts')
+    parser.add_argument('--output', default='scaling.json')
+    parser.add_argument('--compare', help='earlier output to compare with')
+    parser.add_argument('--workdir', help='new directory for the inputs and stand-ins')
+    parser.add_argument('--seed', type=int, default=7)
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as fh:
+            baseline = json.load(fh)
+
+    report = benchmark([int(size) for size in args.sizes.split(',')], args.workdir, args.seed)
+    with open(output, 'w') as fh:
+        json.dump(report, fh, indent=2)
+    if baseline:
+        compare(report, baseline)
+
+### EOF
@@ -0,0 +1,528 @@
+# standins.py
+#
+# In-process stand-ins for the AWS services and databases the GAS uses:
+# a filesystem-backed object store (S3), an in-memory queue and topic
+# broker (SQS, SNS), a dict-backed table (DynamoDB), a secrets store
+# (Secrets Manager) and SQLite-backed database connections (RDS).
+# They implement only the calls and expression forms the GAS makes.
+#
+##
+
+import collections
+import copy
+import io
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import uuid
+
+
+class BotoCoreError(Exception):
+    """Stand-in for botocore.exceptions.BotoCoreError"""
+
+
+class ClientError(Exception):
+    """Stand-in for botocore.exceptions.ClientError"""
+
+    def __init__(self, error_response=None, operation_name=''):
+        self.response = error_response or {'Error': {'Code': 'Error', 'Message': ''}}
+        self.operation_name = operation_name
+        super().__init__(f"{self.response['Error']['Code']} ({operation_name})")
+
+
+def client_error(code, operation_name):
+    return ClientError({'Error': {'Code': code, 'Message': code}}, operation_name)
+
+
+class Config(object):
+    """Stand-in for botocore.config.Config"""
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+
+
+class ObjectStore(object):
+    """S3 client stand-in keeping bucket/key objects as files under root"""
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, bucket, key):
+        return os.path.join(self.root, bucket, key)
+
+    def _read(self, bucket, key, operation_name):
+        if not os.path.isfile(self._path(bucket, key)):
+            raise client_error('NoSuchKey', operation_name)
+        with open(self._path(bucket, key), 'rb') as fh:
+            return fh.read()
+
+    def _write(self, bucket, key, data):
+        os.makedirs(os.path.dirname(self._path(bucket, key)), exist_ok=True)
+        with open(self._path(bucket, key), 'wb') as fh:
+            fh.write(data)
+
+    def head_object(self, Bucket, Key, **kwargs):
+        if not os.path.isfile(self._path(Bucket, Key)):
+            raise client_error('404', 'HeadObject')
+        return {'ContentLength': os.path.getsize(self._path(Bucket, Key))}
+
+    def get_object(self, Bucket, Key, Range=None, **kwargs):
+        data = self._read(Bucket, Key, 'GetObject')
+        if Range:
+            start, end = re.match(r'bytes=(\d*)-(\d*)', Range).groups()
+            if start == '':
+                data = data[-int(end):]
+            else:
+                data = data[int(start):int(end) + 1 if end else None]
+        return {'Body': io.BytesIO(data), 'ContentLength': len(data)}
+
+    def put_object(self, Bucket, Key, Body=b'', **kwargs):
+        self._write(Bucket, Key, Body if isinstance(Body, bytes) else Body.encode())
+        return {}
+
+    def upload_file(self, Filename, Bucket, Key, **kwargs):
+        with open(Filename, 'rb') as fh:
+            self._write(Bucket, Key, fh.read())
+
+    def download_file(self, Bucket, Key, Filename, **kwargs):
+        data = self._read(Bucket, Key, 'DownloadFile')
+        with open(Filename, 'wb') as fh:
+            fh.write(data)
+
+    def copy_object(self, Bucket, Key, CopySource, **kwargs):
+        self._write(Bucket, Key, self._read(CopySource['Bucket'], CopySource['Key'], 'CopyObject'))
+        return {}
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        if os.path.isfile(self._path(Bucket, Key)):
+            os.remove(self._path(Bucket, Key))
+        return {}
+
+    def delete_objects(self, Bucket, Delete, **kwargs):
+        for obj in Delete['Objects']:
+            self.delete_object(Bucket, obj['Key'])
+        return {}
+
+    def list_objects_v2(self, Bucket, Prefix='', **kwargs):
+        bucket_root = os.path.join(self.root, Bucket)
+        keys = []
+        for directory, _, files in os.walk(bucket_root):
+            for name in files:
+                key = os.path.relpath(os.path.join(directory, name), bucket_root)
+                if key.startswith(Prefix):
+                    keys.append(key)
+        return {'Contents': [{'Key': key, 'Size': os.path.getsize(self._path(Bucket, key))}
+                             for key in sorted(keys)]}
+
+    def get_paginator(self, operation_name):
+        return SinglePagePaginator(getattr(self, operation_name))
+
+    def generate_presigned_url(self, ClientMethod, Params=None, ExpiresIn=None, **kwargs):
+        return 'file://' + self._path(Params['Bucket'], Params['Key'])
+
+
+class SinglePagePaginator(object):
+    """Paginator stand-in returning everything as one page"""
+
+    def __init__(self, operation):
+        self.operation = operation
+
+    def paginate(self, **kwargs):
+        yield self.operation(**kwargs)
+
+
+class Queue(object):
+    """An SQS queue: message id -> [body, visible_at, receipt handle, attributes]"""
+
+    def __init__(self, name):
+        self.name = name
+        self.url = f'https://sqs.local/{name}'
+        self.lock = threading.Lock()
+        self.messages = collections.OrderedDict()
+
+    def send(self, body):
+        with self.lock:
+            message_id = str(uuid.uuid4())
+            self.messages[message_id] = [body, 0.0, None,
+                                         {'SentTimestamp': str(int(time.time() * 1000))}]
+            return message_id
+
+    def find(self, receipt_handle):
+        for message_id, message in self.messages.items():
+            if message[2] == receipt_handle:
+                return message_id
+        return None
+
+
+class Messaging(object):
+    """SQS and SNS client stand-in; topics deliver to subscribed queues"""
+
+    def __init__(self, visibility_timeout=30):
+        self.queues = {}
+        self.topics = collections.defaultdict(list)
+        self.visibility_timeout = visibility_timeout
+
+    def queue(self, name):
+        if name not in self.queues:
+            self.queues[name] = Queue(name)
+        return self.queues[name]
+
+    def subscribe(self, topic_arn, queue_name):
+        self.topics[topic_arn].append(self.queue(queue_name))
+
+    def _queue_by_url(self, url, operation_name):
+        for queue in self.queues.values():
+            if queue.url == url:
+                return queue
+        raise client_error('AWS.SimpleQueueService.NonExistentQueue', operation_name)
+
+    # SNS
+    def publish(self, TopicArn, Message, MessageStructure=None, **kwargs):
+        message = json.loads(Message)['default'] if MessageStructure == 'json' else Message
+        for queue in self.topics[TopicArn]:
+            queue.send(json.dumps({'Type': 'Notification', 'TopicArn': TopicArn, 'Message': message}))
+        return {'MessageId': str(uuid.uuid4())}
+
+    def publish_batch(self, TopicArn, PublishBatchRequestEntries, **kwargs):
+        if len(PublishBatchRequestEntries) > 10:
+            raise client_error('TooManyEntriesInBatchRequest', 'PublishBatch')
+        for entry in PublishBatchRequestEntries:
+            self.publish(TopicArn, entry['Message'], entry.get('MessageStructure'))
+        return {'Successful': [{'Id': entry['Id']} for entry in PublishBatchRequestEntries],
+                'Failed': []}
+
+    # SQS
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, WaitTimeSeconds=0,
+                        VisibilityTimeout=None, **kwargs):
+        queue = self._queue_by_url(QueueUrl, 'ReceiveMessage')
+        visibility_timeout = self.visibility_timeout if VisibilityTimeout is None else VisibilityTimeout
+        deadline = time.time() + WaitTimeSeconds
+        while True:
+            received = []
+            with queue.lock:
+                now = time.time()
+                for message_id, message in queue.messages.items():
+                    if len(received) == MaxNumberOfMessages:
+                        break
+                    if message[1] <= now:
+                        message[1] = now + visibility_timeout
+                        message[2] = str(uuid.uuid4())
+                        message[3]['ApproximateReceiveCount'] = \
+                            str(int(message[3].get('ApproximateReceiveCount', '0')) + 1)
+                        received.append({'MessageId': message_id,
+                                         'ReceiptHandle': message[2],
+                                         'Body': message[0],
+                                         'Attributes': dict(message[3]),
+                                         'MessageAttributes': {}})
+            if received:
+                return {'Messages': received}
+            if time.time() >= deadline:
+                return {}
+            time.sleep(0.02)
+
+    def delete_message(self, QueueUrl, ReceiptHandle, **kwargs):
+        queue = self._queue_by_url(QueueUrl, 'DeleteMessage')
+        with queue.lock:
+            message_id = queue.find(ReceiptHandle)
+            if message_id:
+                del queue.messages[message_id]
+        return {}
+
+    def change_message_visibility(self, QueueUrl, ReceiptHandle, VisibilityTimeout, **kwargs):
+        queue = self._queue_by_url(QueueUrl, 'ChangeMessageVisibility')
+        with queue.lock:
+            message_id = queue.find(ReceiptHandle)
+            if message_id is None:
+                raise client_error('ReceiptHandleIsInvalid', 'ChangeMessageVisibility')
+            queue.messages[message_id][1] = time.time() + VisibilityTimeout
+        return {}
+
+    def send_message(self, QueueUrl, MessageBody, **kwargs):
+        return {'MessageId': self._queue_by_url(QueueUrl, 'SendMessage').send(MessageBody)}
+
+    def get_queue_attributes(self, QueueUrl, AttributeNames=None, **kwargs):
+        queue = self._queue_by_url(QueueUrl, 'GetQueueAttributes')
+        now = time.time()
+        with queue.lock:
+            visible = sum(1 for message in queue.messages.values() if message[1] <= now)
+            not_visible = len(queue.messages) - visible
+        return {'Attributes': {'ApproximateNumberOfMessages': str(visible),
+                               'ApproximateNumberOfMessagesNotVisible': str(not_visible)}}
+
+
+class KeyCondition(object):
+    """Stand-in for boto3.dynamodb.conditions.Key and Attr"""
+
+    def __init__(self, name):
+        self.name = name
+
+    def eq(self, value):
+        return lambda item: item.get(self.name) == value
+
+
+class Table(object):
+    """DynamoDB table stand-in keyed by one hash key attribute. Supports the
+    update and condition expression forms the GAS uses: set, add and remove
+    actions, and =, <>, <, <=, >, >= and attribute_(not_)exists clauses
+    joined by AND"""
+
+    def __init__(self, name, key='job_id'):
+        self.name = name
+        self.key = key
+        self.items = {}
+        self.lock = threading.Lock()
+        self.writes = 0
+
+    def put_item(self, Item, ConditionExpression=None, ExpressionAttributeValues=None,
+                 ExpressionAttributeNames=None, **kwargs):
+        with self.lock:
+            if ConditionExpression and not self._condition(
+                    self.items.get(Item[self.key]), ConditionExpression,
+                    ExpressionAttributeValues or {}, ExpressionAttributeNames or {}):
+                raise client_error('ConditionalCheckFailedException', 'PutItem')
+            self.items[Item[self.key]] = copy.deepcopy(Item)
+            self.writes += 1
+        return {}
+
+    def get_item(self, Key, **kwargs):
+        with self.lock:
+            item = self.items.get(Key[self.key])
+            return {'Item': copy.deepcopy(item)} if item is not None else {}
+
+    def delete_item(self, Key, **kwargs):
+        with self.lock:
+            self.items.pop(Key[self.key], None)
+            self.writes += 1
+        return {}
+
+    def query(self, KeyConditionExpression, **kwargs):
+        with self.lock:
+            items = [copy.deepcopy(item) for item in self.items.values()
+                     if KeyConditionExpression(item)]
+        return {'Items': items, 'Count': len(items)}
+
+    def scan(self, **kwargs):
+        with self.lock:
+            items = [copy.deepcopy(item) for item in self.items.values()]
+        return {'Items': items, 'Count': len(items)}
+
+    def batch_writer(self, **kwargs):
+        return BatchWriter(self)
+
+    def _condition(self, item, expression, values, names):
+        item = item or {}
+        for clause in re.split(r'\s+AND\s+', expression.strip(), flags=re.I):
+            clause = clause.strip()
+            exists = re.match(r'attribute_(not_)?exists\((\S+)\)', clause)
+            if exists:
+                if (names.get(exists.group(2), exists.group(2)) in item) == bool(exists.group(1)):
+                    return False
+                continue
+            name, op, placeholder = re.match(r'(\S+)\s*(=|<>|<=|<|>=|>)\s*(\S+)', clause).groups()
+            current = item.get(names.get(name, name))
+            value = values[placeholder]
+            if op == '=':
+                holds = current == value
+            elif op == '<>':
+                holds = current != value
+            else:
+                holds = current is not None and {'<': lambda: current < value,
+                                                 '<=': lambda: current <= value,
+                                                 '>': lambda: current > value,
+                                                 '>=': lambda: current >= value}[op]()
+            if not holds:
+                return False
+        return True
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeValues=None,
+                    ConditionExpression=None, ExpressionAttributeNames=None,
+                    ReturnValues=None, **kwargs):
+        values = ExpressionAttributeValues or {}
+        names = ExpressionAttributeNames or {}
+        with self.lock:
+            item = self.items.get(Key[self.key])
+            if ConditionExpression and not self._condition(item, ConditionExpression, values, names):
+                raise client_error('ConditionalCheckFailedException', 'UpdateItem')
+            if item is None:
+                item = copy.deepcopy(Key)
+                self.items[Key[self.key]] = item
+
+            updated = {}
+            expression = ' '.join(UpdateExpression.split())
+            for action, body in re.findall(r'(set|add|remove)\s+(.*?)(?=\s+(?:set|add|remove)\s+|$)',
+                                           expression, flags=re.I):
+                for part in split_top_level(body):
+                    name = self._apply(item, action.lower(), part, values, names)
+                    if name in item:
+                        updated[name] = item[name]
+            self.writes += 1
+
+        if ReturnValues == 'UPDATED_NEW':
+            return {'Attributes': copy.deepcopy(updated)}
+        if ReturnValues == 'ALL_NEW':
+            return {'Attributes': copy.deepcopy(item)}
+        return {}
+
+    def _apply(self, item, action, part, values, names):
+        if action == 'remove':
+            name = names.get(part, part)
+            item.pop(name, None)
+            return name
+
+        if action == 'add':
+            name, placeholder = part.split()
+            name = names.get(name, name)
+            value = values[placeholder]
+            if isinstance(value, set):
+                item[name] = set(item.get(name, set())) | value
+            else:
+                item[name] = item.get(name, 0) + value
+            return name
+
+        name, value = [side.strip() for side in part.split('=', 1)]
+        name = names.get(name, name)
+        if_not_exists = re.match(r'if_not_exists\((\S+?),\s*(:\w+)\)\s*(?:\+\s*(:\w+))?$', value)
+        list_append = re.match(r'list_append\((\S+?),\s*(:\w+)\)$', value)
+        if if_not_exists:
+            current = item.get(names.get(if_not_exists.group(1), if_not_exists.group(1)),
+                               values[if_not_exists.group(2)])
+            item[name] = current + values[if_not_exists.group(3)] if if_not_exists.group(3) else current
+        elif list_append:
+            item[name] = item.get(names.get(list_append.group(1), list_append.group(1)), []) + \
+                values[list_append.group(2)]
+        elif '+' in value or ' - ' in value:
+            operand, op, placeholder = re.match(r'(\S+)\s*([+-])\s*(:\w+)$', value).groups()
+            current = item.get(names.get(operand, operand), 0)
+            item[name] = current + values[placeholder] if op == '+' else current - values[placeholder]
+        else:
+            item[name] = copy.deepcopy(values[value])
+        return name
+
+
+class BatchWriter(object):
+    """Stand-in for the DynamoDB table batch_writer context manager"""
+
+    def __init__(self, table):
+        self.table = table
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def put_item(self, Item):
+        self.table.put_item(Item=Item)
+
+
+def split_top_level(body):
+    """Split an update expression clause on the commas outside parentheses"""
+    parts, depth, current = [], 0, ''
+    for char in body:
+        depth += {'(': 1, ')': -1}.get(char, 0)
+        if char == ',' and depth == 0:
+            parts.append(current.strip())
+            current = ''
+        else:
+            current += char
+    if current.strip():
+        parts.append(current.strip())
+    return parts
+
+
+class SecretsManager(object):
+    """Secrets Manager client stand-in"""
+
+    def __init__(self, secrets):
+        self.secrets = secrets
+
+    def get_secret_value(self, SecretId, **kwargs):
+        if SecretId not in self.secrets:
+            raise client_error('ResourceNotFoundException', 'GetSecretValue')
+        return {'SecretString': json.dumps(self.secrets[SecretId])}
+
+
+class MySQLConnection(sqlite3.Connection):
+    """pymysql connection stand-in: a SQLite connection that can be pinged"""
+
+    def ping(self, reconnect=False):
+        pass
+
+
+class PostgresConnection(object):
+    """psycopg2 connection stand-in over SQLite: translates the %s
+    placeholders, and returns rows that can be indexed by position or name"""
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+
+    def cursor(self, cursor_factory=None):
+        return PostgresCursor(self.connection.cursor())
+
+    def commit(self):
+        self.connection.commit()
+
+    def rollback(self):
+        self.connection.rollback()
+
+    def close(self):
+        self.connection.close()
+
+
+class PostgresPool(object):
+    """psycopg2.pool.ThreadedConnectionPool stand-in over connect()"""
+
+    def __init__(self, connect, maxconn):
+        self.connect = connect
+        self.maxconn = maxconn
+        self.idle = []
+        self.used = 0
+        self.lock = threading.Lock()
+
+    def getconn(self):
+        with self.lock:
+            if self.used >= self.maxconn:
+                raise sqlite3.OperationalError('connection pool exhausted')
+            self.used += 1
+            return self.idle.pop() if self.idle else self.connect()
+
+    def putconn(self, connection, close=False):
+        with self.lock:
+            self.used -= 1
+            if close:
+                connection.close()
+            else:
+                self.idle.append(connection)
+
+    def closeall(self):
+        with self.lock:
+            for connection in self.idle:
+                connection.close()
+            self.idle = []
+
+
+class PostgresCursor(object):
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, query, params=None):
+        query = query.replace('%s', '?')
+        if params is None:
+            return self.cursor.execute(query)
+        return self.cursor.execute(query, tuple(params))
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def close(self):
+        self.cursor.close()
+
+### EOF
@@ -0,0 +1,120 @@
+# synthetic_vcf.py
+#
+# Generate VCF files of any size that look like the GAS sample inputs: the
+# chromosome mix, positions, multi-allelic rate and the share of variants
+# with an rs ID (and so a dbSNP hit) are learned from ann/data/*.vcf
+#
+# usage: python synthetic_vcf.py <variant_count> <output.vcf> [--seed <n>]
+#
+##
+
+import argparse
+import json
+import random
+
+import environment
+
+CHROMOSOME_ORDER = [str(i) for i in range(1, 23)] + ['X', 'Y', 'MT']
+BASES = 'ACGT'
+
+HEADER = """##fileformat=VCFv4.1
+##source=GAS synthetic_vcf.py
+##INFO=<ID=AC,Number=.,Type=Integer,Description="Allele count in genotypes">
+##INFO=<ID=AN,Number=1,Type=Integer,Description="Total number of alleles in called genotypes">
+##INFO=<ID=DP,Number=1,Type=Integer,Description="Total Depth">
+#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO
+"""
+
+
+def learn_profile(vcf_files=None):
+    """
+    Variant statistics of the sample files: the share of variants and the
+    position range of every chromosome, the multi-allelic rate and the
+    share of variants with an rs ID
+    """
+    chromosomes = {}
+    variants = multi_allelic = rs_ids = 0
+    for vcf_file in vcf_files or environment.SampleVcfFiles:
+        with open(vcf_file) as fh:
+            for line in fh:
+                if line.startswith('#') or not line.strip():
+                    continue
+                fields = line.split('\t', 5)
+                chrom, pos = fields[0].replace('chr', ''), int(fields[1])
+                if chrom not in chromosomes:
+                    chromosomes[chrom] = {'variants': 0, 'start': pos, 'end': pos}
+                stats = chromosomes[chrom]
+                stats['variants'] += 1
+                stats['start'] = min(stats['start'], pos)
+                stats['end'] = max(stats['end'], pos)
+                variants += 1
+                multi_allelic += ',' in fields[4]
+                rs_ids += fields[2].startswith('rs')
+
+    for stats in chromosomes.values():
+        stats['share'] = stats.pop('variants') / variants
+    return {'chromosomes': chromosomes,
+            'multi_allelic_rate': multi_allelic / variants,
+            'rs_id_rate': rs_ids / variants}
+
+
+def chromosome_counts(profile, variant_count):
+    """Split variant_count over the chromosomes by their share, in VCF order"""
+    order = sorted(profile['chromosomes'],
+                   key=lambda chrom: (CHROMOSOME_ORDER.index(chrom)
+                                      if chrom in CHROMOSOME_ORDER else len(CHROMOSOME_ORDER), chrom))
+    counts = {chrom: int(variant_count * profile['chromosomes'][chrom]['share']) for chrom in order}
+    # hand the rounding remainder to the largest chromosomes
+    for chrom in sorted(order, key=lambda chrom: -profile['chromosomes'][chrom]['share']):
+        if sum(counts.values()) == variant_count:
+            break
+        counts[chrom] += 1
+    return [(chrom, counts[chrom]) for chrom in order if counts[chrom]]
+
+
+def generate(path, variant_count, profile=None, random_seed=7):
+    """
+    Write a sorted VCF of variant_count variants to path. Positions of a
+    chromosome are spread over its sampled range by random gaps, so files
+    of any size are generated in constant memory.
+    """
+    profile = profile or learn_profile()
+    rnd = random.Random(random_seed)
+    rs_number = 900000000
+    with open(path, 'w') as fh:
+        fh.write(HEADER)
+        for chrom, count in chromosome_counts(profile, variant_count):
+            stats = profile['chromosomes'][chrom]
+            mean_gap = max(1.0, (stats['end'] - stats['start']) / count)
+            pos = stats['start']
+            for n in range(count):
+                ref = rnd.choice(BASES)
+                alts = [base for base in BASES if base != ref]
+                rnd.shuffle(alts)
+                alt = ','.join(alts[:2]) if rnd.random() < profile['multi_allelic_rate'] else alts[0]
+                rsid = '.'
+                if rnd.random() < profile['rs_id_rate']:
+                    rs_number += 1
+                    rsid = f'rs{rs_number}'
+                an = rnd.randint(2, 200)
+                fh.write(f'{chrom}\t{pos}\t{rsid}\t{ref}\t{alt}\t.\tPASS\t'
+                         f'AC={rnd.randint(1, an)};AN={an};DP={rnd.randint(10, 5000)}\n')
+                pos += 1 + int(rnd.expovariate(1.0 / mean_gap))
+    return path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate a VCF like the sample inputs')
+    parser.add_argument('variant_count', type=int)
+    parser.add_argument('output')
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--show-profile', action='store_true',
+                        help='print the statistics learned from ann/data/*.vcf')
+    args = parser.parse_args()
+
+    profile = learn_profile()
+    if args.show_profile:
+        print(json.dumps(profile, indent=2))
+    generate(args.output, args.variant_count, profile, args.seed)
+
+### EOF
@@ -0,0 +1,164 @@
+# throughput.py
+#
+# Offline end-to-end throughput benchmark of the annotator farm: submits N
+# jobs built from ann/data/*.vcf the way the web app does, runs annotator.py,
+# run.py and driver.run in-process against the stand-ins and reports jobs/sec,
+# submit-to-complete latency percentiles and the time spent in each stage
+#
+# usage: python throughput.py <job_count> [--set Option=Value ...]
+#                             [--reuse] [--workdir <dir>] [--json <file>]
+#
+##
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+import environment
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of a non-empty list"""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered) + 0.5)) - 1))]
+
+
+def time_stages(driver):
+    """Wrap the driver stages to sum their wall time; returns the totals"""
+    totals = {name: 0.0 for name, fn, options in driver.STAGES}
+    lock = threading.Lock()
+
+    def timed(name, fn):
+        def stage(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with lock:
+                    totals[name] += time.perf_counter() - start
+        return stage
+
+    driver.STAGES[:] = [(name, timed(name, fn), options) for name, fn, options in driver.STAGES]
+    return totals
+
+
+def submit_job(env, vcf_file, unique):
+    """Upload an input file, record the job as PENDING and publish the request"""
+    job_id = str(uuid.uuid4())
+    input_file_name = os.path.basename(vcf_file)
+    key = f'prefix/{environment.BenchUserId}/{job_id}~{input_file_name}'
+    with open(vcf_file, 'rb') as fh:
+        body = fh.read()
+    if unique:
+        # a distinct header line keeps the result index from serving the job
+        body = f'##bench_job={job_id}\n'.encode() + body
+    env.store.put_object(Bucket='inputs', Key=key, Body=body)
+
+    job_data = {
+        'job_id': job_id,
+        'user_id': environment.BenchUserId,
+        'input_file_name': input_file_name,
+        's3_inputs_bucket': 'inputs',
+        's3_key_input_file': key,
+        'submit_time': int(time.time()),
+        'job_status': 'PENDING'
+    }
+    env.table('annotations').put_item(Item=job_data)
+    env.messaging.publish(TopicArn='arn:requests',
+                          Message=json.dumps({'default': json.dumps(job_data)}),
+                          MessageStructure='json')
+    return job_id
+
+
+def wait_for_jobs(env, submitted, timeout):
+    """Completion time of every submitted job id; missing if it timed out"""
+    table = env.table('annotations')
+    completed = {}
+    deadline = time.time() + timeout
+    while len(completed) < len(submitted) and time.time() < deadline:
+        for job_id in submitted:
+            if job_id not in completed and \
+                    table.items[job_id].get('job_status') == 'COMPLETED':
+                completed[job_id] = time.perf_counter()
+        time.sleep(0.01)
+    return completed
+
+
+def benchmark(job_count, ann_settings=None, unique=True, workdir=None, timeout=600):
+    """Run job_count jobs through the annotator; returns the report dict"""
+    workdir = workdir or os.path.join(tempfile.mkdtemp(prefix='gas-bench-'), 'work')
+    env = environment.install(workdir, ann_settings)
+    stage_seconds = time_stages(env.driver)
+    threading.Thread(target=env.annotator.main, daemon=True).start()
+
+    submitted = {}
+    start = time.perf_counter()
+    for n in range(job_count):
+        vcf_file = environment.SampleVcfFiles[n % len(environment.SampleVcfFiles)]
+        submitted[submit_job(env, vcf_file, unique)] = time.perf_counter()
+    completed = wait_for_jobs(env, submitted, timeout)
+    elapsed = time.perf_counter() - start
+
+    latencies = [completed[job_id] - submitted[job_id] for job_id in completed]
+    stage_total = sum(stage_seconds.values())
+    report = {
+        'jobs_submitted': job_count,
+        'jobs_completed': len(completed),
+        'elapsed_seconds': elapsed,
+        'jobs_per_second': len(completed) / elapsed if elapsed else 0.0,
+        'latency_seconds': {f'p{p}': percentile(latencies, p) for p in (50, 95, 99)}
+        if latencies else {},
+        'stages': {name: {'seconds': seconds,
+                          'share': seconds / stage_total if stage_total else 0.0}
+                   for name, seconds in stage_seconds.items()},
+        'ann_settings': ann_settings or {},
+        'unique_inputs': unique,
+    }
+    return report
+
+
+def print_report(report):
+    print(f"Jobs completed: {report['jobs_completed']}/{report['jobs_submitted']} "
+          f"in {report['elapsed_seconds']:.2f}s ({report['jobs_per_second']:.2f} jobs/sec)")
+    for name, seconds in report['latency_seconds'].items():
+        print(f"Latency {name}: {seconds:.3f}s")
+    print("Stage time:")
+    for name, stage in sorted(report['stages'].items(), key=lambda item: -item[1]['seconds']):
+        print(f"  {name:<32} {stage['seconds']:8.3f}s {stage['share']:6.1%}")
+
+
+def parse_setting(text):
+    option, sep, value = text.partition('=')
+    if not sep:
+        raise argparse.ArgumentTypeError(f'{text} is not Option=Value')
+    return option.strip(), value.strip()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline annotator throughput benchmark')
+    parser.add_argument('job_count', type=int)
+    parser.add_argument('--set', dest='settings', type=parse_setting, action='append', default=[],
+                        metavar='Option=Value', help='[ann] option of ann_config.ini')
+    parser.add_argument('--reuse', action='store_true',
+                        help='submit identical inputs, so repeats are served by the result index')
+    parser.add_argument('--workdir', help='new directory for the stand-ins and jobs')
+    parser.add_argument('--timeout', type=int, default=600)
+    parser.add_argument('--json', help='also write the report to this file')
+    args = parser.parse_args()
+
+    report = benchmark(args.job_count, dict(args.settings), not args.reuse,
+                       args.workdir, args.timeout)
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as fh:
+            json.dump(report, fh, indent=2)
+    # the annotator loop never returns
+    sys.stdout.flush()
+    os._exit(0 if report['jobs_completed'] == report['jobs_submitted'] else 1)
+
+### EOF
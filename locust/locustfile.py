@@ -1,12 +1,29 @@
+import os
+
 from locust import HttpUser, between, task
 
+# The session cookie of a logged-in GAS user, copied from a browser; without
+# it only the home page is requested. The annotation pages call S3 and
+# DynamoDB, so they show the latency of the web app's AWS clients.
+SESSION_COOKIE = os.environ.get('GAS_SESSION_COOKIE')
+
 class UserBehavior(HttpUser):
     wait_time = between(1, 3)
-    
+
     def on_start(self):
-        pass
-    
+        if SESSION_COOKIE:
+            self.client.cookies.set('session', SESSION_COOKIE)
+
     @task(1)
     def index(self):
         self.client.get("/")
-        
\ No newline at end of file
+
+    @task(3)
+    def annotations(self):
+        if SESSION_COOKIE:
+            self.client.get("/annotations")
+
+    @task(2)
+    def annotate(self):
+        if SESSION_COOKIE:
+            self.client.get("/annotate")
@@ -78,7 +78,7 @@ def main():
         user_id = message_body['user_id']
 
         # check user type (free or premium)
-        user_type = helpers.get_user_profile(user_id)[0][4]
+        user_type = helpers.get_user_role(user_id)
         # delete message and continue if premium user
         if user_type == 'premium_user':
             helpers.delete_message_from_sqs(sqs, ArchiveSQSURL, receipt_handle)
@@ -119,6 +119,8 @@ def main():
             )
         except ClientError as e:
             print("Update results_file_archive_id to DynamoDB failed.", str(e))
+        # the web app's cached item of the job is stale now
+        helpers.invalidate_cached_job(job_id)
 
         # delete result file from S3
         # reference:
@@ -9,10 +9,12 @@
 __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import os
-import json
 import uuid
 import boto3
-from botocore.exceptions import ClientError
+from botocore.exceptions import BotoCoreError, ClientError
+
+import job_cache
+import secrets_provider
 
 # Get util configuration
 from configparser import SafeConfigParser
@@ -44,45 +46,153 @@ def send_email_ses(recipients=None,
     return response
 
 
+import threading
+from contextlib import contextmanager
+
 import psycopg2
 import psycopg2.extras
+import psycopg2.pool
 
-"""Access user profile in accounts database
+"""Pooled connections to the accounts database: up to AccountsPoolSize per
+database, callers wait for one when all are in use. Rotated credentials
+replace the pool of their database
 """
+AccountsPoolSize = config.getint('gas', 'AccountsPoolSize', fallback=4)
 
+# database name -> (connection URI, pool, slots of the pool)
+_accounts_pools = {}
+_accounts_pools_lock = threading.Lock()
 
-def get_user_profile(id=None, db_name=None):
-    # Get database connection details from AWS Secrets Manager
-    asm = boto3.client('secretsmanager', region_name=config['aws']['AwsRegionName'])
+
+def _forget_accounts_pools():
+    """A forked child must not use the parent's connections"""
+    global _accounts_pools_lock
+    _accounts_pools_lock = threading.Lock()
+    _accounts_pools.clear()
+
+os.register_at_fork(after_in_child=_forget_accounts_pools)
+
+
+def accounts_pool(db_name=None):
+    """(pool, slots) of the accounts database db_name"""
+    # Get database connection details from AWS Secrets Manager, cached
     try:
-        asm_response = asm.get_secret_value(SecretId='rds/accounts_database')
-        rds_secret = json.loads(asm_response['SecretString'])
+        rds_secret = secrets_provider.get_secret('rds/accounts_database',
+                                                 config['aws']['AwsRegionName'])
     except ClientError as e:
         raise ClientError
 
+    db_name = db_name or config['gas']['AccountsDatabase']
     db_uri = "postgresql://" + rds_secret['username'] + ':' + \
              rds_secret['password'] + '@' + rds_secret['host'] + ':' + \
-             str(rds_secret['port']) + '/' + \
-             (db_name or config['gas']['AccountsDatabase'])
+             str(rds_secret['port']) + '/' + db_name
+
+    with _accounts_pools_lock:
+        if db_name not in _accounts_pools or _accounts_pools[db_name][0] != db_uri:
+            # connections of a replaced pool close when they are garbage collected
+            _accounts_pools[db_name] = (
+                db_uri,
+                psycopg2.pool.ThreadedConnectionPool(0, AccountsPoolSize, db_uri),
+                threading.BoundedSemaphore(AccountsPoolSize))
+        return _accounts_pools[db_name][1:]
+
+
+def live_connection(pool):
+    """A connection of the pool that answers a query. Idle connections the
+    database closed, for example after an idle timeout, are discarded and
+    replaced, up to AccountsPoolSize of them"""
+    for attempt in range(AccountsPoolSize + 1):
+        connection = pool.getconn()
+        try:
+            connection.cursor().execute('SELECT 1')
+            connection.rollback()
+            return connection
+        except psycopg2.Error:
+            pool.putconn(connection, close=True)
+            if attempt == AccountsPoolSize:
+                raise
+
+
+@contextmanager
+def accounts_cursor(db_name=None):
+    """Cursor on a live pooled accounts database connection; the connection
+    goes back to the pool after its read transaction ends, or is discarded
+    after a database error"""
+    pool, slots = accounts_pool(db_name)
+    with slots:
+        connection = live_connection(pool)
+        try:
+            yield connection.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        except psycopg2.Error:
+            pool.putconn(connection, close=True)
+            raise
+        except BaseException:
+            connection.rollback()
+            pool.putconn(connection)
+            raise
+        connection.rollback()
+        pool.putconn(connection)
 
-    try:
-        # Connect to accounts database and get a cursor
-        connection = psycopg2.connect(db_uri)
-        cursor = connection.cursor(cursor_factory=psycopg2.extras.DictCursor)
 
-        # Query the database and get the user's profile record
-        query_string = f"SELECT * FROM profiles WHERE identity_id = '{id}'"
-        cursor.execute(query_string)
-        profile = cursor.fetchall()
+"""Access user profile in accounts database
+"""
 
-    except psycopg2.Error as e:
-        connection.rollback()
-        raise psycopg2.Error
+
+def get_user_profile(id=None, db_name=None):
+    # Query the database and get the user's profile record
+    with accounts_cursor(db_name) as cursor:
+        cursor.execute("SELECT * FROM profiles WHERE identity_id = %s", (id,))
+        profile = cursor.fetchall()
 
     # Return user profile record as a dict
     return profile
 
 
+"""Access the profiles of many users in one query: identity_id -> profile
+record, users without a profile are left out
+"""
+
+
+def get_user_profiles(ids, db_name=None):
+    ids = list(set(ids))
+    if not ids:
+        return {}
+    with accounts_cursor(db_name) as cursor:
+        cursor.execute("SELECT * FROM profiles WHERE identity_id IN (" +
+                       ', '.join(['%s'] * len(ids)) + ")", ids)
+        profiles = cursor.fetchall()
+
+    return {profile['identity_id']: profile for profile in profiles}
+
+
+"""Get a user's role, None for unknown users. Read from the accounts
+database every time: archiving acts on it, and must not see a role the
+user has just changed
+"""
+
+
+def get_user_role(id):
+    profile = get_user_profile(id)
+    return profile[0]['role'] if profile else None
+
+
+"""Log a change to a finished job in CacheVersionTableName, so the web app
+drops its cached item. Only a hint: without it the web app shows the old
+item until its JOB_CACHE_TTL ends, so failures are logged, never raised
+"""
+
+
+def invalidate_cached_job(job_id):
+    table_name = config.get('aws', 'CacheVersionTableName', fallback=None)
+    if not table_name:
+        print(f"CacheVersionTableName is not set, the web app's cached job {job_id} is stale.")
+        return
+    try:
+        job_cache.DynamoDBJobChanges(table_name, config['aws']['AwsRegionName']).record(job_id)
+    except (BotoCoreError, ClientError, KeyError) as e:
+        print(f"Log job change failed. {str(e)}")
+
+
 def delete_message_from_sqs(sqs_client, sqs_url, receipt_handle):
     try:
         sqs_client.delete_message(QueueUrl=sqs_url, ReceiptHandle=receipt_handle)
@@ -0,0 +1,142 @@
+# job_cache.py
+#
+# Least recently used cache of annotation job items for the web app. Items
+# of finished jobs hardly change, so they are kept for long; items of
+# pending and running jobs only for a few seconds. The utilities that change
+# finished jobs (archive, thaw) log the job ids they changed in DynamoDB,
+# and every web worker drops just those jobs from its cache within seconds
+#
+##
+
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+import boto3
+from botocore.exceptions import ClientError
+
+# job statuses whose item only changes on archive and restore
+FINISHED_STATUSES = ('COMPLETED', 'FAILED')
+
+# BatchGetItem reads at most this many items at a time; caches that missed
+# more changes than this drop all their items instead
+BATCH_GET_LIMIT = 100
+
+
+class DynamoDBJobChanges(object):
+    """
+    Log of the changes to finished jobs, in a DynamoDB table with the string
+    hash key 'name'. The item name counts the changes; change n is the item
+    name#n with the job id changed. Changes expire after expire_seconds,
+    when the table has TTL enabled on expire_time.
+    """
+
+    def __init__(self, table_name, region_name, name='jobs', expire_seconds=86400):
+        self.dynamodb = boto3.resource('dynamodb', region_name=region_name)
+        self.table = self.dynamodb.Table(table_name)
+        self.name = name
+        self.expire_seconds = expire_seconds
+
+    def current(self):
+        """Number of changes so far"""
+        # reference:
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb.html#DynamoDB.Table.get_item
+        item = self.table.get_item(Key={'name': self.name}).get('Item', {})
+        return int(item.get('version', 0))
+
+    def changed(self, first, last):
+        """Job ids of changes first to last, None if any of them is missing"""
+        keys = [{'name': f'{self.name}#{n}'} for n in range(first, last + 1)]
+        # reference:
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb.html#DynamoDB.ServiceResource.batch_get_item
+        response = self.dynamodb.batch_get_item(
+            RequestItems={self.table.name: {'Keys': keys, 'ProjectionExpression': 'job_id'}})
+        items = response.get('Responses', {}).get(self.table.name, [])
+        if len(items) < len(keys):
+            return None
+        return [item['job_id'] for item in items]
+
+    def record(self, job_id):
+        """Log a change to the job"""
+        # reference:
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb.html#DynamoDB.Table.update_item
+        response = self.table.update_item(Key={'name': self.name},
+                                          UpdateExpression='ADD version :one',
+                                          ExpressionAttributeValues={':one': 1},
+                                          ReturnValues='UPDATED_NEW')
+        self.table.put_item(Item={'name': f"{self.name}#{int(response['Attributes']['version'])}",
+                                  'job_id': job_id,
+                                  'expire_time': int(time.time()) + self.expire_seconds})
+
+
+class JobCache(object):
+    """
+    Job items by job id, as loaded by loader(job_id), at most max_items of
+    them. Finished jobs are kept for ttl seconds, others for active_ttl.
+    With a change log, the jobs changed since the last check are dropped,
+    checked at most every version_check_seconds; the whole cache is dropped
+    when the changes cannot be read.
+    """
+
+    def __init__(self, loader, max_items=1024, ttl=3600, active_ttl=5,
+                 changes=None, version_check_seconds=5):
+        self.loader = loader
+        self.max_items = max_items
+        self.ttl = ttl
+        self.active_ttl = active_ttl
+        self.changes = changes
+        self.version_check_seconds = version_check_seconds
+        self.lock = threading.Lock()
+        # job id -> (item, expiry time), least recently used first
+        self.jobs = OrderedDict()
+        self.seen_version = None
+        self.next_version_check = 0.0
+
+    def check_version(self):
+        if self.changes is None or time.time() < self.next_version_check:
+            return
+        self.next_version_check = time.time() + self.version_check_seconds
+        try:
+            current = self.changes.current()
+            changed = None
+            if self.seen_version is not None and 0 < current - self.seen_version <= BATCH_GET_LIMIT:
+                changed = self.changes.changed(self.seen_version + 1, current)
+        except ClientError as e:
+            print(f"Read job cache changes failed. {str(e)}")
+            return
+        with self.lock:
+            if current == self.seen_version:
+                return
+            if changed is None:
+                self.jobs.clear()
+            else:
+                for job_id in changed:
+                    self.jobs.pop(job_id, None)
+            self.seen_version = current
+
+    def get(self, job_id):
+        """A copy of the job item, which the caller may change; None if
+        there is no such job. Missing jobs are not cached"""
+        self.check_version()
+        with self.lock:
+            cached = self.jobs.get(job_id)
+            if cached is not None and time.time() < cached[1]:
+                self.jobs.move_to_end(job_id)
+                return copy.deepcopy(cached[0])
+        item = self.loader(job_id)
+        if item is None:
+            return None
+        ttl = self.ttl if item.get('job_status') in FINISHED_STATUSES else self.active_ttl
+        with self.lock:
+            self.jobs[job_id] = (item, time.time() + ttl)
+            self.jobs.move_to_end(job_id)
+            while len(self.jobs) > self.max_items:
+                self.jobs.popitem(last=False)
+        return copy.deepcopy(item)
+
+    def invalidate(self, job_id):
+        with self.lock:
+            self.jobs.pop(job_id, None)
+
+### EOF
@@ -0,0 +1,99 @@
+# profile_cache.py
+#
+# User profile and role cache of the web app; the utility daemons read
+# roles uncached. Profiles are kept in process for a TTL; a profile change
+# bumps a version counter in DynamoDB, and every web worker checks the
+# counter at most every few seconds and drops its cached profiles when it
+# has moved, so a new role is seen by all of them within seconds while most
+# lookups skip the accounts database
+#
+##
+
+import threading
+import time
+
+import boto3
+from botocore.exceptions import ClientError
+
+
+class DynamoDBVersion(object):
+    """Version counter of the cached profiles, an item of a DynamoDB table
+    with the string hash key 'name'"""
+
+    def __init__(self, table_name, region_name, name='profiles'):
+        self.table = boto3.resource('dynamodb', region_name=region_name).Table(table_name)
+        self.name = name
+
+    def current(self):
+        # reference:
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb.html#DynamoDB.Table.get_item
+        item = self.table.get_item(Key={'name': self.name}).get('Item', {})
+        return int(item.get('version', 0))
+
+    def bump(self):
+        # reference:
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb.html#DynamoDB.Table.update_item
+        self.table.update_item(Key={'name': self.name},
+                               UpdateExpression='ADD version :one',
+                               ExpressionAttributeValues={':one': 1})
+
+
+class ProfileCache(object):
+    """
+    Profiles by identity id, as loaded by loader(identity_id), kept for ttl
+    seconds. With a version counter, the whole cache is dropped when the
+    counter has moved, checked at most every version_check_seconds; when the
+    counter cannot be read, the cached profiles are used until their TTL.
+    """
+
+    def __init__(self, loader, ttl=300, version=None, version_check_seconds=5):
+        self.loader = loader
+        self.ttl = ttl
+        self.version = version
+        self.version_check_seconds = version_check_seconds
+        self.lock = threading.Lock()
+        # identity id -> (profile, time loaded)
+        self.profiles = {}
+        self.seen_version = None
+        self.next_version_check = 0.0
+
+    def check_version(self):
+        if self.version is None or time.time() < self.next_version_check:
+            return
+        self.next_version_check = time.time() + self.version_check_seconds
+        try:
+            current = self.version.current()
+        except ClientError as e:
+            print(f"Read profile cache version failed. {str(e)}")
+            return
+        with self.lock:
+            if current != self.seen_version:
+                self.profiles.clear()
+                self.seen_version = current
+
+    def get(self, identity_id):
+        """The profile, None if there is none; missing profiles are not cached"""
+        self.check_version()
+        key = str(identity_id)
+        with self.lock:
+            cached = self.profiles.get(key)
+            if cached is not None and time.time() - cached[1] < self.ttl:
+                return cached[0]
+        profile = self.loader(identity_id)
+        if profile is not None:
+            with self.lock:
+                self.profiles[key] = (profile, time.time())
+        return profile
+
+    def invalidate(self, identity_id):
+        """Drop the profile from this process' cache, and from every other
+        process' by bumping the version counter"""
+        with self.lock:
+            self.profiles.pop(str(identity_id), None)
+        if self.version is not None:
+            try:
+                self.version.bump()
+            except ClientError as e:
+                print(f"Bump profile cache version failed. {str(e)}")
+
+### EOF
@@ -0,0 +1,193 @@
+# secrets_provider.py
+#
+# Shared, cached access to AWS Secrets Manager for the annotator, the
+# utilities and the web app: secrets are kept in process for a TTL,
+# refreshed in the background before they expire, fetched in parallel when
+# several are needed at once and, optionally, kept in an encrypted file so
+# a restarted process does not have to fetch them again
+#
+# Configured by environment variables:
+#   GAS_SECRETS_TTL_SECONDS  seconds a fetched secret is used (900)
+#   GAS_SECRETS_CACHE_FILE   encrypted on-disk cache, off when unset
+#   GAS_SECRETS_CACHE_KEY    Fernet key of the on-disk cache, made with
+#                            cryptography.fernet.Fernet.generate_key()
+#
+##
+
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.exceptions import ClientError
+
+# the on-disk cache needs the cryptography package
+try:
+    from cryptography.fernet import Fernet, InvalidToken
+except ImportError:
+    Fernet, InvalidToken = None, ValueError
+
+# secrets are refreshed this long before they expire
+REFRESH_AHEAD_SECONDS = 60
+
+
+class SecretsProvider(object):
+    """
+    JSON secrets of Secrets Manager by secret id, cached for ttl seconds.
+    A background thread refreshes cached secrets before they expire, so
+    get() only waits on Secrets Manager for a secret's first fetch; when a
+    refresh fails, the cached value is kept until it expires.
+    """
+
+    def __init__(self, region_name, ttl=900, cache_file=None, cache_key=None):
+        self.region_name = region_name
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # secret id -> (secret, time fetched)
+        self.secrets = {}
+        self.refresher = None
+        self.cipher = None
+        self.cache_file = None
+        if cache_file and cache_key and Fernet is not None:
+            self.cipher = Fernet(cache_key)
+            self.cache_file = cache_file
+            self.load()
+        elif cache_file:
+            print("Secrets cache file disabled: it needs GAS_SECRETS_CACHE_KEY "
+                  "and the cryptography package.")
+
+    def fetch(self, secret_id):
+        # reference:
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/secretsmanager.html#SecretsManager.Client.get_secret_value
+        asm = boto3.client('secretsmanager', region_name=self.region_name)
+        asm_response = asm.get_secret_value(SecretId=secret_id)
+        return json.loads(asm_response['SecretString'])
+
+    def get(self, secret_id):
+        """The secret, from the cache unless it has expired"""
+        return self.get_many([secret_id])[secret_id]
+
+    def get_many(self, secret_ids):
+        """Several secrets; the ones not cached are fetched in parallel.
+        Raises the ClientError of the first secret that failed"""
+        now = time.time()
+        with self.lock:
+            found = {secret_id: self.secrets[secret_id][0] for secret_id in secret_ids
+                     if secret_id in self.secrets and now - self.secrets[secret_id][1] < self.ttl}
+        missing = [secret_id for secret_id in secret_ids if secret_id not in found]
+        if missing:
+            found.update(self.refresh(missing))
+        return found
+
+    def refresh(self, secret_ids):
+        """Fetch secrets in parallel and cache them"""
+        if len(secret_ids) == 1:
+            fetched = {secret_ids[0]: self.fetch(secret_ids[0])}
+        else:
+            with ThreadPoolExecutor(max_workers=len(secret_ids)) as executor:
+                futures = {secret_id: executor.submit(self.fetch, secret_id)
+                           for secret_id in secret_ids}
+            fetched = {secret_id: future.result() for secret_id, future in futures.items()}
+        now = time.time()
+        with self.lock:
+            self.secrets.update((secret_id, (secret, now)) for secret_id, secret in fetched.items())
+        self.save()
+        self.start_refresher()
+        return fetched
+
+    def start_refresher(self):
+        # a forked child inherits the cache, but not the thread
+        with self.lock:
+            if self.refresher is not None and self.refresher.is_alive():
+                return
+            self.refresher = threading.Thread(target=self.refresh_ahead, daemon=True)
+            self.refresher.start()
+
+    def refresh_ahead(self):
+        while True:
+            with self.lock:
+                refresh_at = {secret_id: fetched + self.ttl - min(REFRESH_AHEAD_SECONDS, self.ttl / 2)
+                              for secret_id, (secret, fetched) in self.secrets.items()}
+            time.sleep(max(1, min(refresh_at.values()) - time.time()))
+            due = [secret_id for secret_id, at in refresh_at.items() if at <= time.time()]
+            if not due:
+                continue
+            try:
+                self.refresh(due)
+            except ClientError as e:
+                print(f"Refresh secrets {', '.join(due)} failed. {str(e)}")
+                # try again in a while, the cached values are still good
+                time.sleep(min(REFRESH_AHEAD_SECONDS, self.ttl) / 4)
+
+    def load(self):
+        """Cache the unexpired secrets of the on-disk cache"""
+        if not os.path.exists(self.cache_file):
+            return
+        try:
+            with open(self.cache_file, 'rb') as fh:
+                cached = json.loads(self.cipher.decrypt(fh.read()))
+        except (OSError, ValueError, InvalidToken) as e:
+            print(f"Read secrets cache file failed. {str(e)}")
+            return
+        now = time.time()
+        with self.lock:
+            self.secrets.update((secret_id, (entry['secret'], entry['fetched']))
+                                for secret_id, entry in cached.items()
+                                if now - entry['fetched'] < self.ttl)
+
+    def save(self):
+        if self.cache_file is None:
+            return
+        with self.lock:
+            cached = {secret_id: {'secret': secret, 'fetched': fetched}
+                      for secret_id, (secret, fetched) in self.secrets.items()}
+        token = self.cipher.encrypt(json.dumps(cached).encode())
+        # written under a temporary name readable by this user only
+        temporary_file = f'{self.cache_file}.{os.getpid()}.tmp'
+        try:
+            fd = os.open(temporary_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'wb') as fh:
+                fh.write(token)
+            os.replace(temporary_file, self.cache_file)
+        except OSError as e:
+            print(f"Write secrets cache file failed. {str(e)}")
+
+
+# region name -> the SecretsProvider of this process
+_providers = {}
+_providers_lock = threading.Lock()
+
+
+def _reset_locks():
+    """A forked child gets fresh locks: the parent's may be held by threads
+    the child does not have"""
+    global _providers_lock
+    _providers_lock = threading.Lock()
+    for secrets in _providers.values():
+        secrets.lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_locks)
+
+
+def provider(region_name):
+    """The SecretsProvider of this process for a region"""
+    with _providers_lock:
+        if region_name not in _providers:
+            _providers[region_name] = SecretsProvider(
+                region_name,
+                ttl=int(os.environ.get('GAS_SECRETS_TTL_SECONDS', 900)),
+                cache_file=os.environ.get('GAS_SECRETS_CACHE_FILE'),
+                cache_key=os.environ.get('GAS_SECRETS_CACHE_KEY'))
+        return _providers[region_name]
+
+
+def get_secret(secret_id, region_name):
+    return provider(region_name).get(secret_id)
+
+
+def get_secrets(secret_ids, region_name):
+    return provider(region_name).get_many(secret_ids)
+
+### EOF
@@ -103,6 +103,8 @@ def main():
             )
         except ClientError as e:
             print("Update DynamoDB attribute failed.", str(e))
+        # the web app's cached item of the job is stale now
+        helpers.invalidate_cached_job(job_id)
 
         # delete archive in Glacier
         # reference:
@@ -0,0 +1,76 @@
+# aws_clients.py
+#
+# boto3 clients and resources of the web app, built once per gunicorn
+# worker instead of once per request, so requests reuse warm, kept-alive
+# connections to AWS. Clients are thread-safe and shared by the threads of
+# a worker; resources are not, so each thread gets its own
+#
+##
+
+import os
+import threading
+
+import boto3
+from botocore.client import Config
+
+from gas import app
+
+# (service name, signature version) -> client of this worker
+_clients = {}
+_clients_lock = threading.Lock()
+_session = None
+# resources of this thread, by service name
+_local = threading.local()
+
+
+def _reset():
+    """A forked worker builds its own clients: connection pools do not
+    survive a fork, and the parent's lock may be held"""
+    global _clients_lock, _session, _local
+    _clients.clear()
+    _clients_lock = threading.Lock()
+    _session = None
+    _local = threading.local()
+
+os.register_at_fork(after_in_child=_reset)
+
+
+def _config(signature_version=None):
+    # reference:
+    # https://botocore.amazonaws.com/v1/documentation/api/latest/reference/config.html
+    return Config(signature_version=signature_version,
+                  max_pool_connections=app.config['AWS_MAX_POOL_CONNECTIONS'],
+                  connect_timeout=app.config['AWS_CONNECT_TIMEOUT'],
+                  tcp_keepalive=True,
+                  retries={'mode': 'standard'})
+
+
+def client(service_name, signature_version=None):
+    """The worker's client of a service"""
+    key = (service_name, signature_version)
+    service_client = _clients.get(key)
+    if service_client is not None:
+        return service_client
+    global _session
+    # a boto3 session is not thread-safe, so clients are made under the lock
+    with _clients_lock:
+        if key not in _clients:
+            if _session is None:
+                _session = boto3.session.Session()
+            _clients[key] = _session.client(service_name,
+                                            region_name=app.config['AWS_REGION_NAME'],
+                                            config=_config(signature_version))
+        return _clients[key]
+
+
+def resource(service_name):
+    """The thread's resource of a service, on a session of its own"""
+    resources = getattr(_local, 'resources', None)
+    if resources is None:
+        resources = _local.resources = {}
+    if service_name not in resources:
+        resources[service_name] = boto3.session.Session().resource(
+            service_name, region_name=app.config['AWS_REGION_NAME'], config=_config())
+    return resources[service_name]
+
+### EOF
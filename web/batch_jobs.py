@@ -0,0 +1,106 @@
+# batch_jobs.py
+#
+# Jobs of a batch submission. The job items are written in transactions,
+# then their job requests are published with SNS PublishBatch. The items of
+# the jobs whose request could not be published are deleted again, so they
+# do not stay PENDING forever and their uploads can be submitted again
+#
+##
+
+import json
+
+from boto3.dynamodb.types import TypeSerializer
+from botocore.exceptions import ClientError
+
+# SNS PublishBatch takes at most this many messages per call
+SNS_PUBLISH_BATCH_LIMIT = 10
+# and TransactWriteItems this many items per transaction
+TRANSACT_WRITE_LIMIT = 100
+
+
+def put_new_job_items(dynamodb, table_name, jobs):
+    """Write the job items in transactions of TRANSACT_WRITE_LIMIT, each
+    failing as a whole when one of its job IDs already exists; returns
+    False then. The items of earlier transactions are deleted again when
+    a later one fails"""
+    serializer = TypeSerializer()
+    # reference:
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb.html#DynamoDB.Client.transact_write_items
+    for start in range(0, len(jobs), TRANSACT_WRITE_LIMIT):
+        try:
+            dynamodb.transact_write_items(TransactItems=[{'Put': {
+                'TableName': table_name,
+                'Item': {name: serializer.serialize(value) for name, value in job_data.items()},
+                'ConditionExpression': 'attribute_not_exists(job_id)'
+            }} for job_data in jobs[start:start + TRANSACT_WRITE_LIMIT]])
+        except ClientError as e:
+            delete_unpublished_job_items(dynamodb, table_name,
+                                         [job_data['job_id'] for job_data in jobs[:start]])
+            reasons = e.response.get('CancellationReasons', [])
+            if any(reason.get('Code') == 'ConditionalCheckFailed' for reason in reasons):
+                return False
+            raise
+    return True
+
+
+def publish_job_requests(sns, topic_arn, jobs):
+    """Publish the job request notifications of job items, 10 per SNS
+    PublishBatch call, retrying failed entries once; returns the job IDs
+    that still failed. A call that fails as a whole fails all its entries"""
+    pending = jobs
+    for attempt in range(2):
+        failed = []
+        for start in range(0, len(pending), SNS_PUBLISH_BATCH_LIMIT):
+            entries = pending[start:start + SNS_PUBLISH_BATCH_LIMIT]
+            # reference:
+            # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sns.html#SNS.Client.publish_batch
+            try:
+                sns_response = sns.publish_batch(
+                    TopicArn=topic_arn,
+                    PublishBatchRequestEntries=[{
+                        'Id': job_data['job_id'],
+                        'Message': json.dumps({'default': json.dumps(job_data)}),
+                        'MessageStructure': 'json'
+                    } for job_data in entries])
+            except ClientError as e:
+                print(f"Publish notification messages failed. {str(e)}")
+                failed.extend(entries)
+                continue
+            failed_ids = {entry['Id'] for entry in sns_response.get('Failed', [])}
+            failed.extend(job_data for job_data in entries if job_data['job_id'] in failed_ids)
+        pending = failed
+        if not pending:
+            break
+    return [job_data['job_id'] for job_data in pending]
+
+
+def delete_unpublished_job_items(dynamodb, table_name, job_ids):
+    """Delete the items of jobs whose request was never published, as long as
+    they are still PENDING; returns the job IDs whose item is left"""
+    left = []
+    for job_id in job_ids:
+        # reference:
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb.html#DynamoDB.Client.delete_item
+        try:
+            dynamodb.delete_item(TableName=table_name,
+                                 Key={'job_id': {'S': job_id}},
+                                 ConditionExpression='job_status = :pending',
+                                 ExpressionAttributeValues={':pending': {'S': 'PENDING'}})
+        except ClientError as e:
+            print(f"Delete unpublished job {job_id} failed. {str(e)}")
+            left.append(job_id)
+    return left
+
+
+def submit_jobs(dynamodb, sns, table_name, topic_arn, jobs):
+    """Create the jobs and publish their requests. Returns None when a job ID
+    already exists, and no job was created; else the job IDs whose request
+    could not be published, whose items are deleted again"""
+    if not put_new_job_items(dynamodb, table_name, jobs):
+        return None
+    failed = publish_job_requests(sns, topic_arn, jobs)
+    if failed:
+        delete_unpublished_job_items(dynamodb, table_name, failed)
+    return failed
+
+### EOF
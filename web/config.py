@@ -9,13 +9,16 @@
 __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import os
-import json
-import boto3
+import sys
 import base64
 from botocore.exceptions import ClientError
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 
+# the shared secrets provider; appended, so web's helpers comes first
+sys.path.append(os.path.join(os.path.dirname(basedir), 'util'))
+import secrets_provider
+
 
 class Config(object):
     GAS_LOG_LEVEL = os.environ['GAS_LOG_LEVEL'] \
@@ -38,25 +41,19 @@ class Config(object):
     AWS_REGION_NAME = os.environ['AWS_REGION_NAME'] \
         if ('AWS_REGION_NAME' in os.environ) else "us-east-1"
 
-    # Get various credentials from AWS Secrets Manager
-    asm = boto3.client('secretsmanager', region_name=AWS_REGION_NAME)
-
-    # Get Flask application secret
+    # Get various credentials from AWS Secrets Manager, in parallel
     try:
-        asm_response = asm.get_secret_value(SecretId='gas/web_server')
-        flask_secret = json.loads(asm_response['SecretString'])
+        secrets = secrets_provider.get_secrets(
+            ['gas/web_server', 'rds/accounts_database', 'globus/auth_client'], AWS_REGION_NAME)
     except ClientError as e:
-        print(f"Unable to retrieve Flask secret from ASM: {e}")
+        print(f"Unable to retrieve Flask, accounts database and Globus Auth secrets from ASM: {e}")
         raise e
-    SECRET_KEY = flask_secret['flask_secret_key']
+
+    # Get Flask application secret
+    SECRET_KEY = secrets['gas/web_server']['flask_secret_key']
 
     # Get RDS secret and construct database URI
-    try:
-        asm_response = asm.get_secret_value(SecretId='rds/accounts_database')
-        rds_secret = json.loads(asm_response['SecretString'])
-    except ClientError as e:
-        print(f"Unable to retrieve accounts database credentials from ASM: {e}")
-        raise e
+    rds_secret = secrets['rds/accounts_database']
 
     SQLALCHEMY_DATABASE_TABLE = os.environ['ACCOUNTS_DATABASE_TABLE']
     SQLALCHEMY_DATABASE_URI = "postgresql://" + \
@@ -66,21 +63,27 @@ class Config(object):
     SQLALCHEMY_TRACK_MODIFICATIONS = True
 
     # Get the Globus Auth client ID and secret
-    try:
-        asm_response = asm.get_secret_value(SecretId='globus/auth_client')
-        globus_auth = json.loads(asm_response['SecretString'])
-    except ClientError as e:
-        print(f"Unable to retrieve Globus Auth credentials from ASM: {e}")
-        raise e
+    globus_auth = secrets['globus/auth_client']
 
     # Set the Globus Auth client ID and secret
     GAS_CLIENT_ID = globus_auth['gas_client_id']
     GAS_CLIENT_SECRET = globus_auth['gas_client_secret']
     GLOBUS_AUTH_LOGOUT_URI = "https://auth.globus.org/v2/web/logout"
 
+    # Connection pool size of each AWS client and resource of a worker, and
+    # the connect timeout (in seconds); connections are kept alive
+    AWS_MAX_POOL_CONNECTIONS = int(os.environ.get('AWS_MAX_POOL_CONNECTIONS', 50))
+    AWS_CONNECT_TIMEOUT = 5
+
     # Set validity of pre-signed POST requests (in seconds)
     AWS_SIGNED_REQUEST_EXPIRATION = 60
 
+    # Validity of the pre-signed POST requests of batch submissions, whose
+    # uploads run one after another (in seconds), and their most files; up
+    # to 100, a batch's jobs are created together in one transaction
+    AWS_BATCH_SIGNED_REQUEST_EXPIRATION = 900
+    ANNOTATE_BATCH_MAX_FILES = 100
+
     AWS_S3_INPUTS_BUCKET = "mpcs-cc-gas-inputs"
     AWS_S3_RESULTS_BUCKET = "mpcs-cc-gas-results"
     # Set the S3 key (object name) prefix to your CNetID
@@ -101,6 +104,43 @@ class Config(object):
 
     # Change the table name to your own
     AWS_DYNAMODB_ANNOTATIONS_TABLE = "zhicongm_annotations"
+    # Global secondary index of the annotations table with hash key user_id
+    # and range key submit_time (number), projecting at least job_id,
+    # input_file_name and job_status; the annotation list pages through it
+    AWS_DYNAMODB_ANNOTATIONS_SUBMIT_TIME_INDEX = "user_id_submit_time_index"
+    ANNOTATIONS_PAGE_SIZE = 25
+
+    # User profiles are cached for PROFILE_CACHE_TTL seconds (default 300),
+    # and job items of finished jobs for JOB_CACHE_TTL seconds, those of
+    # pending and running jobs for JOB_CACHE_ACTIVE_TTL. A profile change
+    # bumps a version counter in this table (hash key 'name'), which empties
+    # the profile caches of the web servers; the archive and restore of a
+    # finished job are logged in it, and drop just that job from their job
+    # caches. Enable TTL on expire_time to delete old log entries
+    PROFILE_CACHE_TTL = int(os.environ.get('PROFILE_CACHE_TTL', 300))
+    JOB_CACHE_TTL = int(os.environ.get('JOB_CACHE_TTL', 3600))
+    JOB_CACHE_ACTIVE_TTL = 5
+    JOB_CACHE_SIZE = 1024
+    AWS_DYNAMODB_CACHE_VERSION_TABLE = "zhicongm_cache_version"
+
+    # Log pages are read from S3 LOG_PAGE_BYTES at a time; whole logs are
+    # streamed in chunks of LOG_STREAM_CHUNK_BYTES
+    LOG_PAGE_BYTES = 64 * 1024
+    LOG_STREAM_CHUNK_BYTES = 64 * 1024
+
+    # Job status event streams: the jobs browsers wait on are read every
+    # JOB_EVENTS_POLL_SECONDS; a stream sends a keep-alive after
+    # JOB_EVENTS_HEARTBEAT_SECONDS without events and ends after
+    # JOB_EVENTS_STREAM_SECONDS, when the browser reconnects. Jobs that have
+    # not changed for JOB_EVENTS_IDLE_SECONDS are no longer streamed. Each
+    # stream holds a gunicorn thread, so a worker serves at most
+    # JOB_EVENTS_MAX_STREAMS, leaving the other threads to page requests
+    JOB_EVENTS_POLL_SECONDS = 2
+    JOB_EVENTS_HEARTBEAT_SECONDS = 15
+    JOB_EVENTS_STREAM_SECONDS = 300
+    JOB_EVENTS_IDLE_SECONDS = 1800
+    JOB_EVENTS_MAX_STREAMS = 8
+    JOB_EVENTS_RETRY_MILLISECONDS = 3000
 
     # Change the email address to your username
     MAIL_DEFAULT_SENDER = "zhicongm@mpcs-cc.com"
@@ -108,6 +148,9 @@ class Config(object):
     # Time before free user results are archived (in seconds)
     FREE_USER_DATA_RETENTION = 300
 
+    # Approximate annotation time per variant, used to show job ETAs (in seconds)
+    ANNOTATION_SECONDS_PER_VARIANT = 0.02
+
 
 class DevelopmentConfig(Config):
     DEBUG = True
@@ -11,8 +11,30 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 from flask import redirect, request, session, url_for
 from functools import wraps
 
-from gas import db
+from gas import app, db
 from models import Profile
+from profile_cache import DynamoDBVersion, ProfileCache
+
+"""Load a user profile from the accounts database as a plain dict, which
+outlives the database session
+"""
+def load_profile(identity_id):
+  profile = db.session.query(Profile).filter_by(identity_id=identity_id).first()
+  if not profile:
+    return None
+  return {'identity_id': str(profile.identity_id), 'name': profile.name,
+          'email': profile.email, 'institution': profile.institution,
+          'role': profile.role}
+
+"""Cached user profiles of this worker, dropped on every web worker through
+the version counter of AWS_DYNAMODB_CACHE_VERSION_TABLE
+"""
+profile_cache = ProfileCache(
+  load_profile,
+  ttl=app.config['PROFILE_CACHE_TTL'],
+  version=DynamoDBVersion(app.config['AWS_DYNAMODB_CACHE_VERSION_TABLE'],
+                          app.config['AWS_REGION_NAME'])
+  if app.config['AWS_DYNAMODB_CACHE_VERSION_TABLE'] else None)
 
 """Mark a route as requiring authentication
 """
@@ -39,11 +61,11 @@ def is_premium(fn):
   @wraps(fn)
   def decorated_function(*args, **kwargs):
     # Check if user is a subscriber
-    profile = db.session.query(Profile).filter_by(identity_id=session.get('primary_identity')).first()
+    profile = profile_cache.get(session.get('primary_identity'))
     if not profile:
       # Force login
       return redirect(url_for('login', next=request.url))
-    elif (profile.role != "premium_user"):
+    elif (profile['role'] != "premium_user"):
       # Redirect free user to subscribe
       return redirect(url_for('subscribe', next=request.url))
 
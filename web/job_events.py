@@ -0,0 +1,82 @@
+# job_events.py
+#
+# Status and progress events of running annotation jobs for the web app's
+# event streams. One thread per worker watches every job that a connected
+# browser is waiting on, reading them all with one batched DynamoDB read
+# per poll, and fans changes out to the browsers' streams
+#
+##
+
+import queue
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+# BatchGetItem reads at most this many items at a time
+BATCH_GET_LIMIT = 100
+
+
+class JobEvents(object):
+    """
+    Subscriptions to job status. loader(job_ids) returns the status items of
+    the jobs it could read, by job id: {'job_id', 'job_status', 'progress',
+    ...}. Each subscriber gets the changed items of its jobs on its queue.
+    """
+
+    def __init__(self, loader, poll_seconds=2):
+        self.loader = loader
+        self.poll_seconds = poll_seconds
+        self.lock = threading.Lock()
+        # job id -> queues of the subscribers
+        self.subscribers = {}
+        # job id -> the last status item sent
+        self.last = {}
+        self.thread = None
+
+    def subscribe(self, job_id, events=None):
+        """The queue of the job's changed status items; one queue may be
+        subscribed to several jobs"""
+        events = events if events is not None else queue.Queue()
+        with self.lock:
+            self.subscribers.setdefault(job_id, set()).add(events)
+            # a new subscriber starts from the last status seen
+            if job_id in self.last:
+                events.put(self.last[job_id])
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+        return events
+
+    def unsubscribe(self, job_id, events):
+        with self.lock:
+            subscribers = self.subscribers.get(job_id, set())
+            subscribers.discard(events)
+            if not subscribers:
+                self.subscribers.pop(job_id, None)
+                self.last.pop(job_id, None)
+
+    def _run(self):
+        while True:
+            time.sleep(self.poll_seconds)
+            with self.lock:
+                job_ids = list(self.subscribers)
+            for start in range(0, len(job_ids), BATCH_GET_LIMIT):
+                try:
+                    items = self.loader(job_ids[start:start + BATCH_GET_LIMIT])
+                except ClientError as e:
+                    print(f"Read job status failed. {str(e)}")
+                    continue
+                self.publish(items)
+
+    def publish(self, items):
+        """Send the items that changed to their jobs' subscribers"""
+        with self.lock:
+            for job_id, item in items.items():
+                if job_id not in self.subscribers or self.last.get(job_id) == item:
+                    continue
+                self.last[job_id] = item
+                for events in self.subscribers[job_id]:
+                    events.put(item)
+
+### EOF
@@ -0,0 +1,123 @@
+# test_batch_jobs.py
+#
+# Tests of batch job submission when publishing the job requests fails.
+# Run from web/: python -m unittest test_batch_jobs
+#
+##
+
+import unittest
+
+from botocore.exceptions import ClientError
+
+from batch_jobs import submit_jobs
+
+TABLE_NAME = 'annotations'
+TOPIC_ARN = 'arn:aws:sns:us-east-1:000000000000:job_requests'
+
+
+class FakeDynamoDB(object):
+    """DynamoDB client of a table of job items by job id"""
+
+    def __init__(self):
+        self.items = {}
+
+    def transact_write_items(self, TransactItems):
+        puts = [item['Put']['Item'] for item in TransactItems]
+        if any(put['job_id']['S'] in self.items for put in puts):
+            raise ClientError({'Error': {'Code': 'TransactionCanceledException', 'Message': ''},
+                               'CancellationReasons': [{'Code': 'ConditionalCheckFailed'}]},
+                              'TransactWriteItems')
+        for put in puts:
+            self.items[put['job_id']['S']] = put
+
+    def delete_item(self, TableName, Key, ConditionExpression, ExpressionAttributeValues):
+        item = self.items.get(Key['job_id']['S'])
+        if item is None or item['job_status'] != ExpressionAttributeValues[':pending']:
+            raise ClientError({'Error': {'Code': 'ConditionalCheckFailedException', 'Message': ''}},
+                              'DeleteItem')
+        del self.items[Key['job_id']['S']]
+
+
+class FakeSNS(object):
+    """SNS client that fails the entries of fail_ids, and every call after
+    the first fail_after calls"""
+
+    def __init__(self, fail_ids=(), fail_after=None):
+        self.fail_ids = set(fail_ids)
+        self.fail_after = fail_after
+        self.published = []
+        self.calls = 0
+
+    def publish_batch(self, TopicArn, PublishBatchRequestEntries):
+        self.calls += 1
+        if self.fail_after is not None and self.calls > self.fail_after:
+            raise ClientError({'Error': {'Code': 'InternalError', 'Message': ''}}, 'PublishBatch')
+        failed = [{'Id': entry['Id']} for entry in PublishBatchRequestEntries
+                  if entry['Id'] in self.fail_ids]
+        self.published.extend(entry['Id'] for entry in PublishBatchRequestEntries
+                              if entry['Id'] not in self.fail_ids)
+        return {'Failed': failed}
+
+
+def new_jobs(count):
+    return [{'job_id': f'job-{n}',
+             'user_id': 'user',
+             'input_file_name': f'file-{n}.vcf',
+             's3_inputs_bucket': 'inputs',
+             's3_key_input_file': f'prefix/user/job-{n}~file-{n}.vcf',
+             'submit_time': 0,
+             'job_status': 'PENDING'} for n in range(count)]
+
+
+class SubmitJobsTest(unittest.TestCase):
+
+    def test_published(self):
+        dynamodb, sns = FakeDynamoDB(), FakeSNS()
+        self.assertEqual(submit_jobs(dynamodb, sns, TABLE_NAME, TOPIC_ARN, new_jobs(15)), [])
+        self.assertEqual(len(dynamodb.items), 15)
+        self.assertEqual(len(sns.published), 15)
+
+    def test_failed_entries_deleted(self):
+        dynamodb, sns = FakeDynamoDB(), FakeSNS(fail_ids={'job-3', 'job-12'})
+        jobs = new_jobs(15)
+        failed = submit_jobs(dynamodb, sns, TABLE_NAME, TOPIC_ARN, jobs)
+        self.assertEqual(sorted(failed), ['job-12', 'job-3'])
+        self.assertEqual(set(dynamodb.items), set(sns.published))
+        # the failed jobs are submitted again, without a conflict
+        sns.fail_ids.clear()
+        retry = [job_data for job_data in jobs if job_data['job_id'] in failed]
+        self.assertEqual(submit_jobs(dynamodb, sns, TABLE_NAME, TOPIC_ARN, retry), [])
+        self.assertEqual(len(dynamodb.items), 15)
+
+    def test_failed_call_deleted(self):
+        dynamodb, sns = FakeDynamoDB(), FakeSNS(fail_after=1)
+        failed = submit_jobs(dynamodb, sns, TABLE_NAME, TOPIC_ARN, new_jobs(25))
+        self.assertEqual(len(failed), 15)
+        self.assertEqual(set(dynamodb.items), set(sns.published))
+        self.assertEqual(len(dynamodb.items), 10)
+
+    def test_started_job_kept(self):
+        dynamodb, sns = FakeDynamoDB(), FakeSNS(fail_ids={'job-0'})
+        original = dynamodb.transact_write_items
+
+        def write_and_start(TransactItems):
+            original(TransactItems)
+            dynamodb.items['job-0']['job_status'] = {'S': 'RUNNING'}
+        dynamodb.transact_write_items = write_and_start
+        self.assertEqual(submit_jobs(dynamodb, sns, TABLE_NAME, TOPIC_ARN, new_jobs(1)), ['job-0'])
+        self.assertIn('job-0', dynamodb.items)
+
+    def test_existing_job_rejected(self):
+        dynamodb, sns = FakeDynamoDB(), FakeSNS()
+        jobs = new_jobs(120)
+        dynamodb.items['job-110'] = {'job_id': {'S': 'job-110'}, 'job_status': {'S': 'RUNNING'}}
+        self.assertIsNone(submit_jobs(dynamodb, sns, TABLE_NAME, TOPIC_ARN, jobs))
+        # the items of the first transaction are deleted again
+        self.assertEqual(list(dynamodb.items), ['job-110'])
+        self.assertEqual(sns.published, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+### EOF
@@ -11,19 +11,27 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 import uuid
 import time
 import json
+import hmac
+import queue
+import threading
+import base64
+import hashlib
+from decimal import Decimal
 from datetime import datetime
 
-import boto3
-from boto3.dynamodb.conditions import Key
-from botocore.client import Config
+from boto3.dynamodb.conditions import Attr, Key
 from botocore.exceptions import ClientError
 
 from flask import (abort, flash, redirect, render_template,
                    request, session, url_for, Response)
 
 from gas import app, db
-from decorators import authenticated, is_premium
-from auth import get_profile, update_profile
+import aws_clients
+from decorators import authenticated, is_premium, profile_cache
+from auth import update_profile
+from batch_jobs import submit_jobs
+from job_cache import FINISHED_STATUSES, DynamoDBJobChanges, JobCache
+from job_events import JobEvents
 
 
 """
@@ -50,11 +58,9 @@ def errortmp(self_defined_message, error_message=None):
 
 
 def get_s3():
-    """Get S3 client"""
+    """Get S3 client, shared by the requests of this worker"""
     try:
-        s3 = boto3.client('s3',
-                          region_name=app.config['AWS_REGION_NAME'],
-                          config=Config(signature_version='s3v4'))
+        s3 = aws_clients.client('s3', signature_version='s3v4')
     except ClientError as e:
         return errortmp("Connect to S3 failed.", e)
 
@@ -62,9 +68,9 @@ def get_s3():
 
 
 def get_dynamodb_table():
-    """Get DynamoDB table"""
+    """Get DynamoDB table, on the DynamoDB resource of this thread"""
     try:
-        dynamodb = boto3.resource('dynamodb', region_name=app.config['AWS_REGION_NAME'])
+        dynamodb = aws_clients.resource('dynamodb')
         table = dynamodb.Table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
     except ClientError as e:
         return errortmp("Connect to DynamoDB failed.", e)
@@ -72,21 +78,75 @@ def get_dynamodb_table():
     return table
 
 
+def get_sns():
+    """Get SNS client, shared by the requests of this worker"""
+    return aws_clients.client('sns')
+
+
+def load_job_item(job_id):
+    """Job item from DynamoDB by job_id, None if there is no such job"""
+    table = get_dynamodb_table()
+    db_response = table.query(KeyConditionExpression=Key('job_id').eq(job_id))
+    if 'Items' not in db_response or not db_response['Items']:
+        return None
+    return db_response['Items'][0]
+
+
+"""Cached job items of this worker; the jobs the archive and thaw utilities
+change are logged in AWS_DYNAMODB_CACHE_VERSION_TABLE and dropped from it
+"""
+job_cache = JobCache(
+    load_job_item,
+    max_items=app.config['JOB_CACHE_SIZE'],
+    ttl=app.config['JOB_CACHE_TTL'],
+    active_ttl=app.config['JOB_CACHE_ACTIVE_TTL'],
+    changes=DynamoDBJobChanges(app.config['AWS_DYNAMODB_CACHE_VERSION_TABLE'],
+                               app.config['AWS_REGION_NAME']))
+
+
+def bad_request(message, status=400):
+    """JSON error response of an invalid API request"""
+    return Response(response=json.dumps({'code': str(status),
+                                         'status': 'error',
+                                         'message': message}),
+                    status=status,
+                    mimetype='application/json')
+
+
+def sign_upload_key(s3_key):
+    """Signature of an S3 input key handed out by annotate_batch, which
+    create_annotation_job_requests checks before it creates a job of it"""
+    return hmac.new(app.config['SECRET_KEY'].encode(), s3_key.encode(),
+                    hashlib.sha256).hexdigest()
+
+
+def new_job_item(s3_key, bucket_name, submit_time):
+    """Job item of a PENDING job, from the S3 key of its uploaded input file,
+    <prefix>/<user id>/<job id>~<file name>"""
+    _, user_id, full_filename = s3_key.split("/")
+    job_id, input_file_name = full_filename.split("~")
+    return {
+        'job_id': job_id,
+        'user_id': user_id,
+        'input_file_name': input_file_name,
+        's3_inputs_bucket': bucket_name,
+        's3_key_input_file': s3_key,
+        'submit_time': submit_time,
+        'job_status': 'PENDING'
+    }
+
+
 def get_job_info_from_dynamodb(job_id):
-    """Get job info from DynamoDB by job_id"""
+    """Get job info by job_id, from the job cache or DynamoDB"""
     try:
-        table = get_dynamodb_table()
-        db_response = table.query(KeyConditionExpression=Key('job_id').eq(job_id))
+        curr_job = job_cache.get(job_id)
     except ClientError as e:
         return errortmp("Get job info by job id from DynamoDB failed.", e)
 
     # check if invalid job_id
-    if 'Items' not in db_response or not db_response['Items']:
+    if curr_job is None:
         return errortmp("Invalid job id.")
 
-    # get current job information
-    curr_job = db_response['Items'][0]
-
     # check if job id belongs to the current user
     if curr_job['user_id'] != session['primary_identity']:
         app.logger.error(f"Not authorized to view this job")
@@ -95,6 +155,147 @@ def get_job_info_from_dynamodb(job_id):
     return curr_job
 
 
+def trim_partial_utf8(data):
+    """data without an incomplete UTF-8 character at its end, so the next
+    range starts with the whole character"""
+    for back in range(1, min(4, len(data)) + 1):
+        byte = data[-back]
+        # continuation bytes are 10xxxxxx
+        if byte & 0xC0 == 0x80:
+            continue
+        length = 4 if byte >= 0xF0 else 3 if byte >= 0xE0 else 2 if byte >= 0xC0 else 1
+        return data[:-back] if length > back else data
+    return data
+
+
+def get_log_range(s3_key, offset, length):
+    """Up to length bytes of a log file in S3 from offset, ending on a whole
+    UTF-8 character, and the size of the file; no bytes past its end"""
+    # reference:
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#S3.Client.get_object
+    try:
+        s3_response = get_s3().get_object(Bucket=app.config['AWS_S3_RESULTS_BUCKET'],
+                                          Key=s3_key,
+                                          Range=f'bytes={offset}-{offset + length - 1}')
+    except ClientError as e:
+        # the range starts at or past the end of the file
+        if e.response['Error']['Code'] == 'InvalidRange':
+            return b'', int(e.response['Error'].get('ActualObjectSize', offset))
+        raise
+    data = s3_response['Body'].read()
+    # Content-Range: bytes <first>-<last>/<size>
+    log_size = int(s3_response['ContentRange'].rsplit('/', 1)[1])
+    if offset + len(data) < log_size:
+        data = trim_partial_utf8(data)
+    return data, log_size
+
+
+def load_job_statuses(job_ids):
+    """Status items of jobs by job id, read from DynamoDB in one batch; jobs
+    DynamoDB did not return this time are left out"""
+    # reference:
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb.html#DynamoDB.ServiceResource.batch_get_item
+    table_name = app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE']
+    dynamodb = aws_clients.resource('dynamodb')
+    db_response = dynamodb.batch_get_item(RequestItems={table_name: {
+        'Keys': [{'job_id': job_id} for job_id in job_ids],
+        'ProjectionExpression': 'job_id, job_status, progress, complete_time'
+    }})
+    return {item['job_id']: item for item in db_response['Responses'].get(table_name, [])}
+
+
+"""Status events of the jobs browsers are waiting on, one poller per worker
+"""
+job_events = JobEvents(load_job_statuses, poll_seconds=app.config['JOB_EVENTS_POLL_SECONDS'])
+
+"""Event streams each hold a thread of the worker, so at most
+JOB_EVENTS_MAX_STREAMS of them are open at once
+"""
+job_event_streams = threading.BoundedSemaphore(app.config['JOB_EVENTS_MAX_STREAMS'])
+
+
+def json_default(value):
+    """Numbers of DynamoDB items in JSON"""
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def status_event(item, event_id):
+    """Server-sent event of a job status item"""
+    return f"event: status\nid: {event_id}\ndata: {json.dumps(item, default=json_default)}\n\n"
+
+
+def encode_cursor(last_evaluated_key):
+    """Opaque page cursor of a query's LastEvaluatedKey"""
+    key = {name: int(value) if name == 'submit_time' else value
+           for name, value in last_evaluated_key.items()}
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """ExclusiveStartKey of a page cursor, None if it is not valid"""
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        return None
+    if not isinstance(key, dict) or set(key) != {'job_id', 'user_id', 'submit_time'}:
+        return None
+    return key
+
+
+def query_annotations(user_id, page_size, status=None, newest_first=True,
+                      since=None, until=None, cursor=None):
+    """
+    One page of a user's annotations, and the cursor of the next page (None
+    on the last page). The user_id/submit_time index sorts and limits by
+    submit time; the status filter runs in DynamoDB, which may return short
+    pages for it, so pages are queried until full
+    """
+    # reference:
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb.html#DynamoDB.Table.query
+    key_condition = Key('user_id').eq(user_id)
+    if since is not None and until is not None:
+        key_condition = key_condition & Key('submit_time').between(since, until)
+    elif since is not None:
+        key_condition = key_condition & Key('submit_time').gte(since)
+    elif until is not None:
+        key_condition = key_condition & Key('submit_time').lte(until)
+    query = {
+        'IndexName': app.config['AWS_DYNAMODB_ANNOTATIONS_SUBMIT_TIME_INDEX'],
+        'KeyConditionExpression': key_condition,
+        'ProjectionExpression': 'job_id, submit_time, input_file_name, job_status',
+        'ScanIndexForward': not newest_first
+    }
+    if status:
+        query['FilterExpression'] = Attr('job_status').eq(status)
+
+    table = get_dynamodb_table()
+    annotations = []
+    start_key = decode_cursor(cursor) if cursor else None
+    # a cursor of another user's listing starts over
+    if start_key is not None and start_key['user_id'] != user_id:
+        start_key = None
+    while True:
+        if start_key is not None:
+            query['ExclusiveStartKey'] = start_key
+        db_response = table.query(Limit=page_size - len(annotations), **query)
+        annotations.extend(db_response['Items'])
+        start_key = db_response.get('LastEvaluatedKey')
+        if start_key is None or len(annotations) >= page_size:
+            break
+
+    return annotations, encode_cursor(start_key) if start_key is not None else None
+
+
+def parse_date(value):
+    """Epoch seconds of a YYYY-MM-DD date (UTC), None if empty or invalid"""
+    try:
+        return int((datetime.strptime(value, '%Y-%m-%d') - datetime(1970, 1, 1)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
 # ========================== Web Server Routes ==========================
 
 @app.route('/annotate', methods=['GET'])
@@ -164,21 +365,10 @@ def create_annotation_job_request():
     bucket_name = str(request.args.get('bucket'))
     s3_key = str(request.args.get('key'))
 
-    # Extract the job ID from the S3 key
-    _, user_id, full_filename = s3_key.split("/")
-    job_id, input_file_name = full_filename.split("~")
-
     # Persist job to dynamo db
     # gather job information (to put to db)
-    job_data = {
-        'job_id': job_id,
-        'user_id': user_id,
-        'input_file_name': input_file_name,
-        's3_inputs_bucket': bucket_name,
-        's3_key_input_file': s3_key,
-        'submit_time': submit_time,
-        'job_status': 'PENDING'
-    }
+    job_data = new_job_item(s3_key, bucket_name, submit_time)
+    job_id = job_data['job_id']
 
     # reference:
     # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb.html#DynamoDB.Client.put_item
@@ -192,7 +382,7 @@ def create_annotation_job_request():
     # https://docs.aws.amazon.com/sns/latest/api/API_Publish.html
     # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sns.html#SNS.Client.publish
     try:
-        sns = boto3.client('sns', region_name=app.config['AWS_REGION_NAME'])
+        sns = get_sns()
         sns.publish(TopicArn=app.config['AWS_SNS_JOB_REQUEST_TOPIC'],
                     Message=json.dumps({'default': json.dumps(job_data)}),
                     MessageStructure='json')
@@ -202,31 +392,153 @@ def create_annotation_job_request():
     return render_template('annotate_confirm.html', job_id=job_id)
 
 
-"""List all annotations for the user"""
+"""
+Batch submission, for many input files at once:
+1. POST /annotate/batch with {"files": [file names]} returns a presigned
+   S3 POST, the S3 key and its signature for each file
+2. the browser uploads the files to S3
+3. POST /annotate/batch/jobs with {"uploads": [{"key", "signature"}]}
+   checks the keys were handed out by step 1, creates all the job items in
+   one transaction, unless one of them exists already, and publishes the
+   job requests with SNS PublishBatch, 10 at a time; the jobs whose request
+   could not be published are deleted, so their uploads can be submitted again
+"""
+
+
+@app.route('/annotate/batch', methods=['GET', 'POST'])
+@authenticated
+def annotate_batch():
+    if request.method == 'GET':
+        return render_template('annotate_batch.html',
+                               max_files=app.config['ANNOTATE_BATCH_MAX_FILES'])
+
+    file_names = (request.get_json(silent=True) or {}).get('files')
+    if not isinstance(file_names, list) or not file_names or \
+            len(file_names) > app.config['ANNOTATE_BATCH_MAX_FILES']:
+        return bad_request(f"Expected 1 to {app.config['ANNOTATE_BATCH_MAX_FILES']} file names.")
+    # the S3 key is split on '/' and '~' into user, job ID and file name
+    if any(not isinstance(name, str) or not name or '/' in name or '~' in name
+           for name in file_names):
+        return bad_request("File names must not be empty or contain '/' or '~'.")
+
+    # presigned posts are signed locally, without calls to S3
+    # reference:
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#S3.Client.generate_presigned_post
+    s3 = get_s3()
+    user_id = session['primary_identity']
+    encryption = app.config['AWS_S3_ENCRYPTION']
+    acl = app.config['AWS_S3_ACL']
+    fields = {
+        "success_action_status": "201",
+        "x-amz-server-side-encryption": encryption,
+        "acl": acl
+    }
+    conditions = [
+        {"success_action_status": "201"},
+        {"x-amz-server-side-encryption": encryption},
+        {"acl": acl}
+    ]
+    uploads = []
+    try:
+        for file_name in file_names:
+            key_name = app.config['AWS_S3_KEY_PREFIX'] + user_id + '/' + \
+                       str(uuid.uuid4()) + '~' + file_name
+            uploads.append({'file': file_name,
+                            'key': key_name,
+                            'signature': sign_upload_key(key_name),
+                            's3_post': s3.generate_presigned_post(
+                                Bucket=app.config['AWS_S3_INPUTS_BUCKET'],
+                                Key=key_name,
+                                Fields=fields,
+                                Conditions=conditions,
+                                ExpiresIn=app.config['AWS_BATCH_SIGNED_REQUEST_EXPIRATION'])})
+    except ClientError as e:
+        return errortmp("Generate presigned upload posts failed.", e)
+
+    return Response(response=json.dumps({'uploads': uploads}), mimetype='application/json')
+
+
+@app.route('/annotate/batch/jobs', methods=['POST'])
+@authenticated
+def create_annotation_job_requests():
+    submit_time = int(time.time())
+    uploads = (request.get_json(silent=True) or {}).get('uploads')
+    if not isinstance(uploads, list) or not uploads or \
+            len(uploads) > app.config['ANNOTATE_BATCH_MAX_FILES']:
+        return bad_request(f"Expected 1 to {app.config['ANNOTATE_BATCH_MAX_FILES']} uploads.")
+    # only keys annotate_batch handed out, of the user's own uploads
+    user_prefix = app.config['AWS_S3_KEY_PREFIX'] + session['primary_identity'] + '/'
+    for upload in uploads:
+        s3_key = upload.get('key') if isinstance(upload, dict) else None
+        signature = upload.get('signature') if isinstance(upload, dict) else None
+        if not isinstance(s3_key, str) or not isinstance(signature, str) or \
+                not hmac.compare_digest(signature, sign_upload_key(s3_key)) or \
+                not s3_key.startswith(user_prefix) or \
+                s3_key.count('/') != 2 or s3_key.count('~') != 1:
+            return bad_request("Unexpected S3 key.")
+
+    jobs = [new_job_item(s3_key, app.config['AWS_S3_INPUTS_BUCKET'], submit_time)
+            for s3_key in dict.fromkeys(upload['key'] for upload in uploads)]
+
+    # jobs are only created once: a batch with an existing job ID is rejected;
+    # the jobs whose request could not be published are deleted again
+    try:
+        failed = submit_jobs(aws_clients.client('dynamodb'), get_sns(),
+                             app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'],
+                             app.config['AWS_SNS_JOB_REQUEST_TOPIC'], jobs)
+    except ClientError as e:
+        return errortmp("Persist job info to DynamoDB failed.", e)
+    if failed is None:
+        return bad_request("Jobs of these uploads were already submitted.", status=409)
+    if failed:
+        return errortmp(f"Publish notification messages of jobs {', '.join(failed)} failed, "
+                        "their uploads can be submitted again.")
+
+    return Response(response=json.dumps({'job_ids': [job_data['job_id'] for job_data in jobs]}),
+                    mimetype='application/json')
+
+
+# job statuses the annotation list can be filtered by
+ANNOTATION_STATUSES = ('PENDING', 'RUNNING', 'COMPLETED', 'FAILED')
+
+
+"""List the user's annotations, a page at a time"""
 
 
 @app.route('/annotations', methods=['GET'])
 @authenticated
 def annotations_list():
-    # Get list of annotations to display
+    # Get one page of annotations to display, sorted and filtered by
+    # submit time and status in DynamoDB
     user_id = session['primary_identity']
-    # reference:
-    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb.html#DynamoDB.Client.query
+    status = request.args.get('status', '')
+    if status not in ANNOTATION_STATUSES:
+        status = ''
+    order = 'oldest' if request.args.get('order') == 'oldest' else 'newest'
+    since_date = request.args.get('since', '')
+    until_date = request.args.get('until', '')
+    since = parse_date(since_date)
+    until = parse_date(until_date)
+    # the until date is inclusive
+    if until is not None:
+        until += 24 * 60 * 60 - 1
+    cursor = request.args.get('cursor')
+
     try:
-        table = get_dynamodb_table()
-        db_response = table.query(
-            IndexName='user_id_index',
-            KeyConditionExpression=Key('user_id').eq(user_id)
-        )
+        annotations, next_cursor = query_annotations(
+            user_id, app.config['ANNOTATIONS_PAGE_SIZE'], status=status,
+            newest_first=(order == 'newest'), since=since, until=until, cursor=cursor)
     except ClientError as e:
         return errortmp("Get annotation list failed.", e)
 
-    annotations = db_response['Items']
     # change int type submit_time back to timestamp
     for annotation in annotations:
         annotation['submit_time'] = datetime.utcfromtimestamp(annotation['submit_time'])
 
-    return render_template('annotations.html', annotations=annotations)
+    filters = {'status': status, 'order': order, 'since': since_date, 'until': until_date}
+    return render_template('annotations.html', annotations=annotations,
+                           statuses=ANNOTATION_STATUSES, filters=filters,
+                           next_cursor=next_cursor, paged=bool(cursor))
 
 
 """Display details of a specific annotation job"""
@@ -237,6 +549,13 @@ def annotations_list():
 def annotation_details(id):
     curr_job = get_job_info_from_dynamodb(id)
 
+    # estimate the completion time of unfinished jobs from the annotator's pre-scan
+    if curr_job['job_status'] != 'COMPLETED' and 'size_estimate' in curr_job:
+        estimated_seconds = int(curr_job['size_estimate']['estimated_variants']) * \
+                            app.config['ANNOTATION_SECONDS_PER_VARIANT']
+        curr_job['estimated_complete_time'] = \
+            datetime.utcfromtimestamp(int(curr_job['submit_time']) + int(estimated_seconds))
+
     # translate submit_time into human-readable format
     curr_job['submit_time'] = datetime.utcfromtimestamp(curr_job['submit_time'])
 
@@ -262,7 +581,7 @@ def annotation_details(id):
         # translate complete_time into human-readable format
         curr_job['complete_time'] = datetime.utcfromtimestamp(curr_job['complete_time'])
 
-        user_type = get_profile(session['primary_identity']).role
+        user_type = profile_cache.get(session['primary_identity'])['role']
 
         # free user whose results files are in Glacier (=5 minutes after job completion)
         if user_type == 'free_user' and 'available_in_glacier' in curr_job and curr_job['available_in_glacier']:
@@ -292,24 +611,171 @@ def annotation_details(id):
                            free_access_expired=free_access_expired)
 
 
-"""Display the log file contents for an annotation job"""
+"""Display one page of the log file of an annotation job, read with a
+ranged GET from S3; offset is the page's first byte
+"""
 
 
 @app.route('/annotations/<id>/log', methods=['GET'])
 @authenticated
 def annotation_log(id):
+    curr_job = get_job_info_from_dynamodb(id)
+    page_bytes = app.config['LOG_PAGE_BYTES']
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    try:
+        log_page, log_size = get_log_range(curr_job['s3_key_log_file'], offset, page_bytes)
+    except ClientError as e:
+        return errortmp("Get job log from S3 failed.", e)
+
+    return render_template('view_log.html', job_id=id,
+                           log_file_contents=log_page.decode(errors='replace'),
+                           offset=offset, next_offset=offset + len(log_page),
+                           previous_offset=max(offset - page_bytes, 0),
+                           last_offset=max(log_size - page_bytes, 0),
+                           log_size=log_size)
+
+
+"""Tail an annotation job's log: the bytes after offset, up to a page, as
+JSON with the offset to ask for next
+"""
+
+
+@app.route('/annotations/<id>/log/tail', methods=['GET'])
+@authenticated
+def annotation_log_tail(id):
+    curr_job = get_job_info_from_dynamodb(id)
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    try:
+        log_bytes, log_size = get_log_range(curr_job['s3_key_log_file'], offset,
+                                            app.config['LOG_PAGE_BYTES'])
+    except ClientError as e:
+        return errortmp("Get job log from S3 failed.", e)
+
+    return Response(response=json.dumps({'offset': offset,
+                                         'next_offset': offset + len(log_bytes),
+                                         'size': log_size,
+                                         'text': log_bytes.decode(errors='replace')}),
+                    mimetype='application/json')
+
+
+"""Download an annotation job's whole log, streamed from S3 without
+holding it in memory
+"""
+
+
+@app.route('/annotations/<id>/log/raw', methods=['GET'])
+@authenticated
+def annotation_log_raw(id):
     curr_job = get_job_info_from_dynamodb(id)
     # reference:
     # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#S3.Client.get_object
     try:
-        s3 = get_s3()
-        s3_response = s3.get_object(Bucket=app.config['AWS_S3_RESULTS_BUCKET'],
-                                    Key=curr_job['s3_key_log_file'])
-        log_file_contents = s3_response['Body'].read().decode()
+        s3_response = get_s3().get_object(Bucket=app.config['AWS_S3_RESULTS_BUCKET'],
+                                          Key=curr_job['s3_key_log_file'])
     except ClientError as e:
         return errortmp("Get job log from S3 failed.", e)
 
-    return render_template('view_log.html', job_id=id, log_file_contents=log_file_contents)
+    def stream(body):
+        try:
+            for chunk in body.iter_chunks(chunk_size=app.config['LOG_STREAM_CHUNK_BYTES']):
+                yield chunk
+        finally:
+            body.close()
+
+    return Response(stream(s3_response['Body']), mimetype='text/plain',
+                    headers={'Content-Length': str(s3_response['ContentLength'])})
+
+
+"""
+Stream the status of the user's annotation jobs as server-sent events,
+instead of the browser reloading the page: a 'status' event with the
+job_id, job_status and progress of a job whenever they change, and a 'done'
+event once every job has finished. Streams end after
+JOB_EVENTS_STREAM_SECONDS; browsers reconnect by themselves. The event ids
+are the time of the last change, so when none of the jobs has changed for
+JOB_EVENTS_IDLE_SECONDS, across reconnects, the stream ends with a 'done'
+event listing the idle jobs, and the browser stops watching them. With
+JOB_EVENTS_MAX_STREAMS streams open, the worker answers 503
+"""
+
+
+@app.route('/annotations/events', methods=['GET'])
+@authenticated
+def annotation_events():
+    job_ids = request.args.getlist('id')[:app.config['ANNOTATIONS_PAGE_SIZE']]
+    user_id = session['primary_identity']
+    finished = []
+    running = set()
+    for job_id in job_ids:
+        try:
+            curr_job = job_cache.get(job_id)
+        except ClientError as e:
+            return errortmp("Get job info by job id from DynamoDB failed.", e)
+        if curr_job is None or curr_job['user_id'] != user_id:
+            return abort(404)
+        if curr_job['job_status'] in FINISHED_STATUSES:
+            finished.append({name: curr_job[name] for name in ('job_id', 'job_status', 'complete_time')
+                             if name in curr_job})
+        else:
+            running.add(job_id)
+
+    retry = f"retry: {app.config['JOB_EVENTS_RETRY_MILLISECONDS']}\n\n"
+    if not job_event_streams.acquire(blocking=False):
+        return Response(retry, status=503, mimetype='text/event-stream',
+                        headers={'Retry-After': str(app.config['JOB_EVENTS_RETRY_MILLISECONDS'] // 1000)})
+
+    # a reconnecting browser sends the time of the last change it saw; the
+    # statuses sent again on subscribing are no change
+    try:
+        last_change = float(request.headers['Last-Event-ID'])
+        replayed = set(running)
+    except (KeyError, ValueError):
+        last_change = time.time()
+        replayed = set()
+
+    def stream():
+        nonlocal last_change
+        events = queue.Queue()
+        for job_id in running:
+            job_events.subscribe(job_id, events)
+        try:
+            yield f"id: {last_change}\n{retry}"
+            for item in finished:
+                yield status_event(item, last_change)
+            deadline = time.time() + app.config['JOB_EVENTS_STREAM_SECONDS']
+            while running and time.time() < deadline:
+                idle_seconds = last_change + app.config['JOB_EVENTS_IDLE_SECONDS'] - time.time()
+                if idle_seconds <= 0:
+                    yield f"event: done\ndata: {json.dumps({'idle': sorted(running)})}\n\n"
+                    return
+                try:
+                    item = events.get(timeout=min(app.config['JOB_EVENTS_HEARTBEAT_SECONDS'],
+                                                  idle_seconds))
+                except queue.Empty:
+                    # a comment line, which also finds disconnected browsers
+                    yield ": keep-alive\n\n"
+                    continue
+                if item['job_id'] in replayed:
+                    replayed.discard(item['job_id'])
+                else:
+                    last_change = time.time()
+                yield status_event(item, last_change)
+                if item['job_status'] in FINISHED_STATUSES:
+                    job_events.unsubscribe(item['job_id'], events)
+                    running.discard(item['job_id'])
+                    # the cached item predates the job's results
+                    job_cache.invalidate(item['job_id'])
+            if not running:
+                yield "event: done\ndata: {}\n\n"
+        finally:
+            for job_id in running:
+                job_events.unsubscribe(job_id, events)
+
+    response = Response(stream(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # also called when the browser left before the stream started
+    response.call_on_close(job_event_streams.release)
+    return response
 
 
 """Subscription management handler"""
@@ -332,15 +798,16 @@ def subscribe():
             role="premium_user"
         )
 
-        # Update role in the session
+        # Update role in the session, and in the profile caches
         session['role'] = "premium_user"
+        profile_cache.invalidate(session['primary_identity'])
 
         # Request restoration of the user's data from Glacier
         # reference:
         # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sns.html#SNS.Client.publish
         restore_start_notification = {'user_id': session['primary_identity']}
         try:
-            sns_restore_start = boto3.client('sns', region_name=app.config['AWS_REGION_NAME'])
+            sns_restore_start = get_sns()
             sns_restore_start.publish(TopicArn=app.config['AWS_SNS_RESTORE_START_TOPIC'],
                                       Message=json.dumps({'default': json.dumps(restore_start_notification)}),
                                       MessageStructure='json')
@@ -362,6 +829,7 @@ def unsubscribe():
         identity_id=session['primary_identity'],
         role="free_user"
     )
+    profile_cache.invalidate(session['primary_identity'])
     return redirect(url_for('profile'))
 
 